@@ -0,0 +1,478 @@
+# benchmark.py
+# load generator + benchmark harness for the hot paths: crypto, message store, network routing
+# and the websocket API. every stage reports throughput and p50/p99/p999 latency, results are
+# written as JSON so two runs can be compared.
+#
+#   python benchmark.py                                   # every stage, default sizes
+#   python benchmark.py route websocket --peers 200 --messages 20000 --output run.json
+#   python benchmark.py --compare baseline.json run.json  # exit code 1 on a regression
+#
+# runs happen in a throwaway directory, so keys/ and encrypted/ of a real server are untouched.
+# stdout only ever carries the JSON (or the --compare report), the table, progress and the
+# engine's own prints go to stderr --> `python benchmark.py > run.json` works.
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+STAGES = ("crypto", "store", "route", "websocket")
+# a regression is a p99 this much higher, or a throughput this much lower, than the baseline
+DEFAULT_TOLERANCE = 0.10
+
+
+class LatencyRecorder:
+    """latencies of one stage, in seconds"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.samples: List[float] = []
+        self.errors = 0
+        self.started = 0.0
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.started
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def result(self, payload_bytes: int = 0) -> Dict[str, Any]:
+        samples = sorted(self.samples)
+        count = len(samples)
+        result = {
+            "count": count,
+            "errors": self.errors,
+            "seconds": round(self.elapsed, 6),
+            "throughput": round(count / self.elapsed, 2) if self.elapsed else 0.0,
+        }
+        if payload_bytes:
+            result["mb_per_second"] = round(count * payload_bytes / self.elapsed / 1e6, 3) if self.elapsed else 0.0
+        for label, q in (("p50", 0.50), ("p99", 0.99), ("p999", 0.999)):
+            result[f"{label}_ms"] = round(percentile(samples, q) * 1000, 4)
+        result["mean_ms"] = round(sum(samples) / count * 1000, 4) if count else 0.0
+        result["max_ms"] = round(samples[-1] * 1000, 4) if count else 0.0
+        return result
+
+
+def percentile(sorted_samples: List[float], q: float) -> float:
+    """nearest-rank percentile of an already sorted list"""
+    if not sorted_samples:
+        return 0.0
+    rank = max(1, min(len(sorted_samples), int(q * len(sorted_samples) + 0.999999)))
+    return sorted_samples[rank - 1]
+
+
+def payload(size: int) -> str:
+    # printable and not very compressible, closer to real chat text than "xxxx"
+    return "".join(random.choice("abcdefghijklmnopqrstuvwxyz0123456789 ") for _ in range(size))
+
+
+async def drive(count: int, rate: float, concurrency: int, op: Callable[[int], Awaitable[None]],
+                recorder: LatencyRecorder):
+    """run op(0..count-1) closed loop (rate 0, `concurrency` at a time) or open loop at `rate`/s
+
+    in open loop latency is measured from each operation's scheduled start, so a stall also
+    shows up in the operations that had to wait behind it (no coordinated omission).
+    """
+    async def timed(i: int, scheduled: float):
+        try:
+            await op(i)
+            recorder.add(time.perf_counter() - scheduled)
+        except Exception:
+            recorder.errors += 1
+
+    with recorder:
+        if rate <= 0:
+            next_index = 0
+
+            async def worker():
+                nonlocal next_index
+                while next_index < count:
+                    i = next_index
+                    next_index += 1
+                    await timed(i, time.perf_counter())
+            await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+            return
+        start = time.perf_counter()
+        tasks = []
+        for i in range(count):
+            scheduled = start + i / rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(timed(i, scheduled)))
+        await asyncio.gather(*tasks)
+
+
+def bench_crypto(args) -> Dict[str, Any]:
+    from p2p_crypto import create_peer_session
+
+    alice = create_peer_session("bench_alice", "bench_bob")
+    bob = create_peer_session("bench_bob", "bench_alice")
+    alice.establish_session(bob.get_my_public_key())
+    bob.establish_session(alice.get_my_public_key())
+    messages = [payload(args.message_size) for _ in range(min(args.messages, 1000))]
+    encrypt = LatencyRecorder("crypto.encrypt")
+    packets = []
+    with encrypt:
+        for i in range(args.messages):
+            t = time.perf_counter()
+            packets.append(alice.send_message(messages[i % len(messages)]))
+            encrypt.add(time.perf_counter() - t)
+    decrypt = LatencyRecorder("crypto.decrypt")
+    with decrypt:
+        for packet in packets:
+            t = time.perf_counter()
+            bob.receive_message(packet)
+            decrypt.add(time.perf_counter() - t)
+    # batch api: one sample per batch
+    batch = LatencyRecorder("crypto.encrypt_many")
+    batch_size = max(1, args.batch_size)
+    with batch:
+        for start in range(0, args.messages, batch_size):
+            chunk = [messages[i % len(messages)] for i in range(start, min(args.messages, start + batch_size))]
+            t = time.perf_counter()
+            alice.encrypt_many(chunk)
+            batch.add(time.perf_counter() - t)
+    return {
+        "crypto.encrypt": encrypt.result(args.message_size),
+        "crypto.decrypt": decrypt.result(args.message_size),
+        f"crypto.encrypt_many[{batch_size}]": batch.result(args.message_size * batch_size),
+    }
+
+
+def bench_store(args) -> Dict[str, Any]:
+    from file_store import create_message_store
+    from p2p_crypto import create_peer_session
+    from p2p_packet import encode_packet
+
+    alice = create_peer_session("bench_alice", "bench_bob")
+    bob = create_peer_session("bench_bob", "bench_alice")
+    alice.establish_session(bob.get_my_public_key())
+    bob.establish_session(alice.get_my_public_key())
+    text = payload(args.message_size)
+    wire_packets = [encode_packet(alice.send_message(text)) for _ in range(min(args.messages, 1000))]
+    results = {}
+    for backend in args.backends:
+        store = create_message_store(os.path.join("encrypted", backend), backend)
+        conversations = [f"bench<->{i}" for i in range(max(1, args.peers))]
+        save = LatencyRecorder(f"store.{backend}.save")
+        message_ids = []
+        with save:
+            for i in range(args.messages):
+                t = time.perf_counter()
+                message_ids.append(store.save_message(wire_packets[i % len(wire_packets)], conversations[i % len(conversations)]))
+                save.add(time.perf_counter() - t)
+        load = LatencyRecorder(f"store.{backend}.load")
+        with load:
+            for message_id in random.sample(message_ids, min(len(message_ids), args.messages)):
+                t = time.perf_counter()
+                if store.load_message(message_id) is None:
+                    load.errors += 1
+                load.add(time.perf_counter() - t)
+        query = LatencyRecorder(f"store.{backend}.query")
+        with query:
+            for conversation in conversations:
+                before = None
+                while True:
+                    t = time.perf_counter()
+                    page, before = store.query(conversation, before, 50)
+                    query.add(time.perf_counter() - t)
+                    if before is None or not page:
+                        break
+        store.close()
+        results[save.name] = save.result(args.message_size)
+        results[load.name] = load.result(args.message_size)
+        results[query.name] = query.result()
+    return results
+
+
+async def bench_route(args) -> Dict[str, Any]:
+    from p2p_engine import P2PNetworkSimulator
+
+    network = P2PNetworkSimulator(storage_backend=args.backends[0], transport=args.transport)
+    names = [f"peer{i}" for i in range(max(2, args.peers))]
+    for name in names:
+        network.create_peer(name)
+        if args.transport == "tcp":
+            await network.listen(name)
+    # ring: everyone has two neighbours, so the pairs below are always directly connected
+    for i, name in enumerate(names):
+        network.connect_peers(name, names[(i + 1) % len(names)])
+    delivered = asyncio.Event()
+    received = 0
+
+    async def on_event(event):
+        nonlocal received
+        received += 1
+        if received >= args.messages:
+            delivered.set()
+    network.set_event_handler(on_event)
+    text = payload(args.message_size)
+
+    async def send(i: int):
+        sender = names[i % len(names)]
+        await network.route_message(sender, names[(i + 1) % len(names)], text)
+
+    route = LatencyRecorder("route.route_message")
+    await drive(args.messages, args.rate, args.concurrency, send, route)
+    # tcp sends return once written, the receiving side finishes asynchronously
+    try:
+        await asyncio.wait_for(delivered.wait(), timeout=30)
+    except asyncio.TimeoutError:
+        route.errors += args.messages - received
+    results = {f"route.route_message[{args.transport}]": route.result(args.message_size)}
+
+    bulk = LatencyRecorder("route.route_messages")
+    batch_size = max(1, args.batch_size)
+
+    async def send_batch(i: int):
+        items = [
+            (names[j % len(names)], names[(j + 1) % len(names)], text)
+            for j in range(i * batch_size, (i + 1) * batch_size)
+        ]
+        result = await network.route_messages(items)
+        if result["failed"]:
+            raise Exception(f"{result['failed']} messages failed")
+    await drive(max(1, args.messages // batch_size), 0, 1, send_batch, bulk)
+    results[f"route.route_messages[{args.transport},{batch_size}]"] = bulk.result(args.message_size * batch_size)
+    await network.close_transports()
+    if network.store_writer is not None:
+        network.store_writer.close()
+    return results
+
+
+async def bench_websocket(args) -> Dict[str, Any]:
+    import websockets
+    from ws_codec import SUBPROTOCOL_MSGPACK, encode_frame, decode_frame
+
+    server = None
+    url = args.url
+    if url is None:
+        import main as app
+        server = await app.start_server("localhost", 0)
+        url = f"ws://localhost:{server.sockets[0].getsockname()[1]}"
+    protocol = SUBPROTOCOL_MSGPACK if args.protocol == "msgpack" else None
+    names = [f"wspeer{i}" for i in range(max(2, args.peers))]
+    clients = []
+    for _ in range(max(1, args.clients)):
+        clients.append(await websockets.connect(
+            url, subprotocols=[protocol] if protocol else None, max_size=None,
+            compression="deflate" if args.deflate else None,
+        ))
+    # responses and events come back on the same socket, a reader per client sorts them out
+    pending: Dict[Any, asyncio.Future] = {}
+    sent_at: Dict[str, float] = {}
+    event = LatencyRecorder("websocket.event")
+    next_id = 0
+
+    async def reader(ws):
+        async for frame in ws:
+            data = decode_frame(frame)
+            if data.get("type") == "response":
+                future = pending.pop(data.get("request_id"), None)
+                if future is not None and not future.done():
+                    future.set_result(data["data"])
+            elif data.get("type") == "new_message":
+                started = sent_at.pop(data["data"]["message"], None)
+                if started is not None:
+                    event.add(time.perf_counter() - started)
+    readers = [asyncio.create_task(reader(ws)) for ws in clients]
+
+    async def call(ws, action: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        nonlocal next_id
+        next_id += 1
+        request_id = next_id
+        future = asyncio.get_running_loop().create_future()
+        pending[request_id] = future
+        await ws.send(encode_frame({"action": action, "payload": body, "request_id": request_id}, protocol))
+        return await future
+
+    for name in names:
+        await call(clients[0], "create_peer", {"name": name})
+    for i, name in enumerate(names):
+        await call(clients[0], "connect_peers", {"peer1": name, "peer2": names[(i + 1) % len(names)]})
+    # every client watches a slice of the peers, an event counts once (first client to see it)
+    for i, ws in enumerate(clients):
+        await call(ws, "subscribe", {"peers": names[i::len(clients)]})
+    text = payload(max(0, args.message_size - 12))
+
+    async def send(i: int):
+        # the message body doubles as the key to match the event back to its send time
+        message = f"{i:010d} {text}"
+        sent_at[message] = time.perf_counter()
+        response = await call(clients[i % len(clients)], "send_message", {
+            "from": names[i % len(names)], "to": names[(i + 1) % len(names)], "message": message,
+        })
+        if not response.get("success"):
+            raise Exception(response.get("error"))
+
+    request = LatencyRecorder("websocket.send_message")
+    event.started = time.perf_counter()
+    await drive(args.messages, args.rate, args.concurrency, send, request)
+    # let the last events arrive
+    deadline = time.perf_counter() + 10
+    while sent_at and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    event.elapsed = time.perf_counter() - event.started
+    event.errors = len(sent_at)
+    stats = await call(clients[0], "stats", {})
+    for ws in clients:
+        await ws.close()
+    for task in readers:
+        task.cancel()
+    if server is not None:
+        server.close()
+        await server.wait_closed()
+    label = f"{args.protocol}{'+deflate' if args.deflate else ''}"
+    return {
+        f"websocket.send_message[{label}]": request.result(args.message_size),
+        f"websocket.event[{label}]": event.result(args.message_size),
+        "websocket.delivery": stats.get("stats", {}).get("delivery"),
+    }
+
+
+def run_stages(args) -> Dict[str, Any]:
+    results: Dict[str, Any] = {}
+    for stage in args.stages:
+        print(f"[bench] {stage} ...", file=sys.stderr)
+        random.seed(args.seed)
+        if stage == "crypto":
+            results.update(bench_crypto(args))
+        elif stage == "store":
+            results.update(bench_store(args))
+        elif stage == "route":
+            results.update(asyncio.run(bench_route(args)))
+        elif stage == "websocket":
+            results.update(asyncio.run(bench_websocket(args)))
+    return results
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5,
+        ).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], tolerance: float) -> List[str]:
+    """human-readable regressions of current vs baseline (p99 up / throughput down by > tolerance)"""
+    regressions = []
+    for name, now in current["results"].items():
+        before = baseline["results"].get(name)
+        if not isinstance(now, dict) or not isinstance(before, dict) or "p99_ms" not in now:
+            continue
+        if before["p99_ms"] and now["p99_ms"] > before["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {before['p99_ms']}ms -> {now['p99_ms']}ms")
+        if before["throughput"] and now["throughput"] < before["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {before['throughput']}/s -> {now['throughput']}/s")
+    return regressions
+
+
+def print_table(results: Dict[str, Any]):
+    print(f"{'stage':44} {'count':>8} {'ops/s':>11} {'p50 ms':>9} {'p99 ms':>9} {'p999 ms':>9} {'errors':>7}",
+          file=sys.stderr)
+    for name, result in results.items():
+        if isinstance(result, dict) and "p50_ms" in result:
+            print(f"{name:44} {result['count']:>8} {result['throughput']:>11} {result['p50_ms']:>9} "
+                  f"{result['p99_ms']:>9} {result['p999_ms']:>9} {result['errors']:>7}", file=sys.stderr)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="P2P engine / websocket benchmark")
+    parser.add_argument("stages", nargs="*", metavar="stage", help=f"stages to run: {', '.join(STAGES)} (default: all)")
+    parser.add_argument("--messages", type=int, default=2000, help="operations per stage")
+    parser.add_argument("--message-size", type=int, default=256, help="plaintext bytes per message")
+    parser.add_argument("--peers", type=int, default=20, help="peers (route/websocket) or conversations (store)")
+    parser.add_argument("--clients", type=int, default=4, help="websocket client connections")
+    parser.add_argument("--rate", type=float, default=0, help="open-loop sends per second, 0 = as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=1, help="closed-loop operations in flight")
+    parser.add_argument("--batch-size", type=int, default=100, help="messages per encrypt_many/route_messages call")
+    parser.add_argument("--backends", default="log", help="comma separated store backends (log,compact,sqlite)")
+    parser.add_argument("--transport", choices=("loopback", "tcp"), default="loopback")
+    parser.add_argument("--protocol", choices=("json", "msgpack"), default="json")
+    parser.add_argument("--deflate", action="store_true", help="negotiate permessage-deflate")
+    parser.add_argument("--url", help="benchmark a running server instead of an in-process one")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON results here (default: stdout)")
+    parser.add_argument("--compare", nargs="+", metavar="JSON",
+                        help="BASELINE [CURRENT]: compare two result files (or baseline vs this run)")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv)
+    args.backends = [b.strip() for b in args.backends.split(",") if b.strip()]
+    args.stages = args.stages or list(STAGES)
+    unknown = [stage for stage in args.stages if stage not in STAGES]
+    if unknown:
+        parser.error(f"unknown stage(s): {', '.join(unknown)}")
+
+    if args.compare and len(args.compare) == 2:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            current = json.load(f)
+    else:
+        workdir = tempfile.mkdtemp(prefix="p2p-bench-")
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            started = time.time()
+            # the engine logs with print(), keep that out of the JSON on stdout
+            with contextlib.redirect_stdout(sys.stderr):
+                results = run_stages(args)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(workdir, ignore_errors=True)
+        config = {k: v for k, v in vars(args).items() if k not in ("output", "compare", "tolerance")}
+        current = {
+            "meta": {
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "duration_seconds": round(time.time() - started, 3),
+                "git_revision": git_revision(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "config": config,
+            },
+            "results": results,
+        }
+        print_table(results)
+        text = json.dumps(current, indent=2)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(text + "\n")
+            print(f"results written to {args.output}", file=sys.stderr)
+        elif not args.compare:
+            print(text)
+        baseline = None
+        if args.compare:
+            with open(args.compare[0]) as f:
+                baseline = json.load(f)
+    if args.compare:
+        regressions = compare(baseline, current, args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if not regressions:
+            print(f"no regressions (tolerance {args.tolerance:.0%})")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
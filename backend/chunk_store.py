@@ -0,0 +1,190 @@
+# chunk_store.py
+# content-addressed chunk store --> file attachment data is kept once per distinct chunk.
+#
+# chunks live at  <root>/<aa>/<blake2b hex>  and every stored file is a manifest (itself a chunk,
+# the concatenated raw digests of its chunks) so identical files share the manifest as well.
+# reference counts are in memory: MessageStore rebuilds them from its index on open.
+#
+# chunks are addressed by their (encrypted) bytes. send_file seals every chunk with a key derived
+# from its plaintext (see p2p_crypto, file stream v2), so resends and the same file sent to many
+# peers produce the same chunks and are stored once. only the small per-send key frame differs.
+import os
+import hashlib
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+DIGEST_SIZE = 32
+MANIFEST_SUFFIX = ".manifest"
+
+
+def chunk_digest(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).hexdigest()
+
+
+class ChunkStore:
+    """deduplicated, reference-counted chunk storage for file data"""
+
+    def __init__(self, root: str):
+        self.root = root
+        self._lock = threading.RLock()
+        self._refs: Dict[str, int] = {}
+        os.makedirs(root, exist_ok=True)
+        # counters for stats / benchmarks
+        self.chunks_written = 0
+        self.chunks_deduplicated = 0
+
+    def chunk_path(self, digest: str, suffix: str = "") -> str:
+        return os.path.join(self.root, digest[:2], digest + suffix)
+
+    def manifest_path(self, manifest: str) -> str:
+        return self.chunk_path(manifest, MANIFEST_SUFFIX)
+
+    def manifest_from_path(self, path: Optional[str]) -> Optional[str]:
+        """manifest digest of a chunk-store file_path, None for legacy plain files
+
+        matched on the <aa>/<digest>.manifest shape rather than the root so entries keep
+        working after the store directory is restored somewhere else.
+        """
+        if not path or not path.endswith(MANIFEST_SUFFIX):
+            return None
+        digest = os.path.basename(path)[:-len(MANIFEST_SUFFIX)]
+        if len(digest) != DIGEST_SIZE * 2 or os.path.basename(os.path.dirname(path)) != digest[:2]:
+            return None
+        return digest
+
+    def _write_once(self, path: str, data: bytes) -> bool:
+        if os.path.exists(path):
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return True
+
+    def put_chunk(self, data: bytes) -> str:
+        """store one chunk (unless an identical one exists) and take a reference on it"""
+        digest = chunk_digest(data)
+        with self._lock:
+            if self._write_once(self.chunk_path(digest), data):
+                self.chunks_written += 1
+            else:
+                self.chunks_deduplicated += 1
+            self._refs[digest] = self._refs.get(digest, 0) + 1
+        return digest
+
+    def commit_file(self, digests: List[str]) -> str:
+        """write the manifest for chunks already taken with put_chunk, returns its digest
+
+        the chunk references move to the manifest: a manifest that already existed keeps
+        one set of chunk references, so the duplicates taken by put_chunk are dropped again.
+        """
+        data = b"".join(bytes.fromhex(digest) for digest in digests)
+        manifest = chunk_digest(data)
+        with self._lock:
+            self._write_once(self.manifest_path(manifest), data)
+            refs = self._refs.get(manifest + MANIFEST_SUFFIX, 0)
+            self._refs[manifest + MANIFEST_SUFFIX] = refs + 1
+            if refs:
+                self._drop_chunks(digests)
+        return manifest
+
+    def put_file(self, chunks: Iterable[bytes]) -> Tuple[str, int]:
+        """store a whole file, returns (manifest digest, size)"""
+        digests: List[str] = []
+        size = 0
+        try:
+            for chunk in chunks:
+                digests.append(self.put_chunk(chunk))
+                size += len(chunk)
+        except BaseException:
+            self.abort_file(digests)
+            raise
+        return self.commit_file(digests), size
+
+    def abort_file(self, digests: List[str]):
+        """give back the chunk references of a file that was never committed"""
+        with self._lock:
+            self._drop_chunks(digests)
+
+    def read_manifest(self, manifest: str) -> List[str]:
+        with open(self.manifest_path(manifest), 'rb') as f:
+            data = f.read()
+        return [data[i:i + DIGEST_SIZE].hex() for i in range(0, len(data), DIGEST_SIZE)]
+
+    def iter_file(self, manifest: str) -> Iterator[bytes]:
+        """yield the chunks of a stored file one at a time"""
+        for digest in self.read_manifest(manifest):
+            with open(self.chunk_path(digest), 'rb') as f:
+                yield f.read()
+
+    def retain(self, manifest: str):
+        """take one more reference to a live stored file (e.g. to pin it during a backup)"""
+        with self._lock:
+            key = manifest + MANIFEST_SUFFIX
+            self._refs[key] = self._refs.get(key, 0) + 1
+
+    def release(self, manifest: str):
+        """drop one reference to a file, chunks nobody references anymore are deleted"""
+        with self._lock:
+            key = manifest + MANIFEST_SUFFIX
+            refs = self._refs.get(key, 0) - 1
+            if refs > 0:
+                self._refs[key] = refs
+                return
+            self._refs.pop(key, None)
+            try:
+                digests = self.read_manifest(manifest)
+            except FileNotFoundError:
+                return
+            self._drop_chunks(digests)
+            self._remove(self.manifest_path(manifest))
+
+    def _drop_chunks(self, digests: List[str]):
+        for digest in digests:
+            refs = self._refs.get(digest, 0) - 1
+            if refs > 0:
+                self._refs[digest] = refs
+            else:
+                self._refs.pop(digest, None)
+                self._remove(self.chunk_path(digest))
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def recover(self, manifests: Iterable[str]):
+        """rebuild reference counts from the live manifests and delete unreferenced chunks"""
+        with self._lock:
+            self._refs.clear()
+            for manifest in manifests:
+                key = manifest + MANIFEST_SUFFIX
+                self._refs[key] = self._refs.get(key, 0) + 1
+                if self._refs[key] > 1:
+                    continue
+                try:
+                    digests = self.read_manifest(manifest)
+                except FileNotFoundError:
+                    print(f"Missing file manifest {manifest}")
+                    continue
+                for digest in digests:
+                    self._refs[digest] = self._refs.get(digest, 0) + 1
+            # leftovers from files that were never committed or released before a crash
+            for shard in os.listdir(self.root):
+                shard_dir = os.path.join(self.root, shard)
+                if not os.path.isdir(shard_dir):
+                    continue
+                for name in os.listdir(shard_dir):
+                    if name not in self._refs:
+                        self._remove(os.path.join(shard_dir, name))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "objects": len(self._refs),
+                "chunks_written": self.chunks_written,
+                "chunks_deduplicated": self.chunks_deduplicated,
+            }
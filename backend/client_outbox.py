@@ -0,0 +1,144 @@
+# client_outbox.py
+# per-connection outbound queue --> one slow websocket client can't hold back delivery to the others.
+#
+# every connection gets a bounded queue drained by its own writer task, producers never await a send.
+import asyncio
+import json
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Optional, Tuple, Union
+
+# what happens when a client's queue is full
+POLICY_DROP_OLDEST = "drop_oldest"  # oldest queued event goes, newest is kept, its conversation gets a resync notice
+POLICY_COALESCE = "coalesce"        # queued events of the same conversation fold into one resync notice
+POLICY_DISCONNECT = "disconnect"    # client is closed, it reconnects and reloads its history
+OVERFLOW_POLICIES = (POLICY_DROP_OLDEST, POLICY_COALESCE, POLICY_DISCONNECT)
+
+# close code sent to clients dropped by POLICY_DISCONNECT ("try again later")
+CLOSE_SLOW_CONSUMER = 1013
+
+
+class ClientOutbox:
+    """bounded outbound event queue + writer task for one websocket connection"""
+
+    def __init__(self, websocket, max_queue: int = 256, policy: str = POLICY_DROP_OLDEST,
+                 encode: Callable[[Dict[str, Any]], Union[str, bytes]] = json.dumps):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.websocket = websocket
+        self.max_queue = max_queue
+        self.policy = policy
+        # serializer of the connection's sub-protocol, used for resync notices
+        self.encode = encode
+        # (coalesce key, frame) --> frame is the serialized event (str or bytes) or a resync dict still to be serialized
+        self._queue: Deque[Tuple[Optional[str], Any]] = deque()
+        # conversation --> its resync notice still waiting in the queue, so there's only ever one
+        self._notices: Dict[str, Dict[str, Any]] = {}
+        self._ready = asyncio.Event()
+        self._closed = False
+        # metrics
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self._task = asyncio.create_task(self._run())
+
+    def put(self, frame: Union[str, bytes], key: Optional[str] = None) -> bool:
+        """queue one serialized event (key = its conversation), returns False if it was dropped"""
+        if self._closed:
+            return False
+        if len(self._queue) >= self.max_queue:
+            if self.policy == POLICY_DISCONNECT:
+                self.dropped += len(self._queue) + 1
+                self.close(slow=True)
+                return False
+            if self.policy == POLICY_COALESCE and key is not None and self._coalesce(key):
+                return True
+            self._drop_oldest()
+        self._queue.append((key, frame))
+        self.max_depth = max(self.max_depth, len(self._queue))
+        self._ready.set()
+        return True
+
+    def _drop_oldest(self):
+        """make room for one event by dropping the oldest queued one
+
+        its conversation gets a resync notice (or its pending one counts up) so the client
+        refetches it with get_history. notices are never dropped and don't count against
+        max_queue, there's at most one per conversation.
+        """
+        if len(self._queue) - len(self._notices) >= self.max_queue:
+            index = next(i for i, (_key, frame) in enumerate(self._queue) if not isinstance(frame, dict))
+            key, _frame = self._queue[index]
+            del self._queue[index]
+            self.dropped += 1
+            if key is None:
+                return
+            notice = self._notices.get(key)
+            if notice is not None:
+                notice["dropped"] += 1
+            else:
+                notice = self._notices[key] = {"type": "resync", "conversation": key, "dropped": 1}
+                self._queue.append((key, notice))
+
+    def _coalesce(self, key: str) -> bool:
+        """fold the queued events of a conversation (plus the new one) into one resync notice"""
+        folded = 0
+        skipped = 1
+        kept: Deque[Tuple[Optional[str], Any]] = deque()
+        for queued_key, frame in self._queue:
+            if queued_key != key:
+                kept.append((queued_key, frame))
+            elif isinstance(frame, dict):
+                skipped += frame["dropped"]
+            else:
+                folded += 1
+                skipped += 1
+        if len(kept) == len(self._queue):
+            return False
+        # the client refetches the conversation with get_history when it sees the notice
+        notice = self._notices[key] = {"type": "resync", "conversation": key, "dropped": skipped}
+        kept.append((key, notice))
+        self._queue = kept
+        self.coalesced += folded + 1
+        self._ready.set()
+        return True
+
+    async def _run(self):
+        try:
+            while True:
+                await self._ready.wait()
+                while self._queue:
+                    key, frame = self._queue.popleft()
+                    if isinstance(frame, dict):
+                        self._notices.pop(key, None)
+                        frame = self.encode(frame)
+                    await self.websocket.send(frame)
+                    self.sent += 1
+                self._ready.clear()
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            # connection went away, handler cleanup follows
+            self._closed = True
+
+    def close(self, slow: bool = False):
+        """stop the writer, slow=True also closes the connection"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.clear()
+        self._notices.clear()
+        self._task.cancel()
+        if slow:
+            asyncio.create_task(self.websocket.close(code=CLOSE_SLOW_CONSUMER, reason="slow consumer"))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "depth": len(self._queue),
+            "max_depth": self.max_depth,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "policy": self.policy,
+            "closed": self._closed,
+        }
@@ -1,162 +1,511 @@
 import os
 import json
 import base64
+import asyncio
+import struct
+import threading
+import time
+import hashlib
+import shutil
+import sys
+from bisect import bisect_left, insort
+from collections import OrderedDict
 from datetime import datetime
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Union, Iterable, Iterator, AsyncIterable, Tuple, BinaryIO
 import msgpack
 from datetime import datetime, timezone
+from p2p_packet import encode_packet, decode_packet, decode_header, is_encoded_packet, timestamp_to_us
+from segment_log import SegmentLog, DEFAULT_SEGMENT_BYTES
+from chunk_store import ChunkStore
+from p2p_crypto import FILE_CHUNK_SIZE
 
-class MessageStore:
-    """handles storage and retrieval of encrypted messages and files"""
+# record payload = meta length u32 | meta JSON | binary packet (empty for tombstones)
+RECORD_META = struct.Struct(">I")
+INDEX_LOG_FILE = "index.log"
+# segments are also rolled at day boundaries so retention can drop whole days
+PARTITION_US = 24 * 3600 * 1_000_000
+# index.log is rewritten once dead lines outnumber live ones by this much
+INDEX_COMPACT_SLACK = 1000
+
+# per-peer secondary index entry: stored_us | segment | offset | length
+PEER_ENTRY = struct.Struct(">qIQI")
+PEER_INDEX_DIR = "peers"
+# open append handles kept for the most recently written peers
+PEER_INDEX_OPEN_FILES = 64
+
+# (stored_us, segment, offset, length), sorts by time then log position
+PeerKey = Tuple[int, int, int, int]
+
+def encode_cursor(key: PeerKey) -> str:
+    """opaque paging cursor for a secondary index position"""
+    return f"{key[0]}.{key[1]}.{key[2]}"
+
+def decode_cursor(cursor: str) -> Tuple[int, int, int]:
+    try:
+        stored_us, segment, offset = (int(part) for part in cursor.split("."))
+    except ValueError:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return stored_us, segment, offset
+
+class PeerIndex:
+    """time-ordered secondary index per peer, persisted as one fixed-size-entry file per peer"""
+    def __init__(self, index_dir: str):
+        self.index_dir = index_dir
+        os.makedirs(index_dir, exist_ok=True)
+        self._entries: Dict[str, List[PeerKey]] = {}
+        self._files: "OrderedDict[str, BinaryIO]" = OrderedDict()
+
+    def path(self, peer_name: str) -> str:
+        # hashed so any peer name maps to a safe, collision-free filename
+        digest = hashlib.blake2b(peer_name.encode('utf-8'), digest_size=12).hexdigest()
+        return os.path.join(self.index_dir, f"{digest}.idx")
+
+    def load(self, peer_name: str) -> List[PeerKey]:
+        """read a peer's index file into memory"""
+        entries: List[PeerKey] = []
+        path = self.path(peer_name)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+            usable = len(data) - len(data) % PEER_ENTRY.size
+            entries = list(PEER_ENTRY.iter_unpack(data[:usable]))
+            entries.sort()
+        self._entries[peer_name] = entries
+        return entries
+
+    def entries(self, peer_name: str) -> List[PeerKey]:
+        return self._entries.get(peer_name, [])
+
+    def peers(self) -> List[str]:
+        return list(self._entries)
+
+    def add(self, peer_name: str, key: PeerKey):
+        """insert in time order and append to the peer's file"""
+        self.add_many(peer_name, [key])
+
+    def add_many(self, peer_name: str, keys: List[PeerKey]):
+        """insert several keys for one peer with a single file append"""
+        entries = self._entries.setdefault(peer_name, [])
+        for key in keys:
+            if not entries or entries[-1] <= key:
+                entries.append(key)
+            else:
+                insort(entries, key)
+        f = self._files.pop(peer_name, None)
+        if f is None:
+            f = open(self.path(peer_name), 'ab')
+            if len(self._files) >= PEER_INDEX_OPEN_FILES:
+                _old_peer, old_file = self._files.popitem(last=False)
+                old_file.close()
+        self._files[peer_name] = f
+        f.write(b"".join(PEER_ENTRY.pack(*key) for key in keys))
+        f.flush()
+
+    def replace(self, peer_name: str, keys: List[PeerKey]):
+        """rewrite a peer's index with exactly these entries"""
+        f = self._files.pop(peer_name, None)
+        if f is not None:
+            f.close()
+        keys = sorted(keys)
+        path = self.path(peer_name)
+        if not keys:
+            self._entries.pop(peer_name, None)
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(b"".join(PEER_ENTRY.pack(*key) for key in keys))
+        os.replace(tmp_path, path)
+        self._entries[peer_name] = keys
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+
+class BaseMessageStore:
+    """backend-agnostic half of the store API --> message ids, packet normalisation, file
+    messages through the chunk store and cursors. MessageStore and SQLiteMessageStore only
+    implement the storage itself (_finish_file_message, iter_file_data, _message_key, ...).
+    """
+
+    chunks: ChunkStore
+
+    def save_message(self, message_packet: Union[Dict[str, Any], bytes], peer_name: str) -> str:
+        """saving encrypted message & returns its message_id
+
+        message_packet is either a packet dict or an already encoded binary packet
+        (p2p_packet), the stored record holds the binary packet as-is.
+        """
+        return self.save_messages([(message_packet, peer_name)])[0]
+
+    def save_messages(self, items: Iterable[Tuple[Union[Dict[str, Any], bytes], str]], sync: bool = False) -> List[str]:
+        raise NotImplementedError
+
+    def _packet_and_id(self, message_packet: Union[Dict[str, Any], bytes]) -> Tuple[bytes, str]:
+        # binary packet to store + its message_id (generated when the packet has none)
+        if is_encoded_packet(message_packet):
+            packet_bytes = bytes(message_packet)
+            message_id = decode_header(packet_bytes)["message_id"]
+        else:
+            packet_bytes = encode_packet(message_packet)
+            message_id = message_packet.get("message_id")
+        if not message_id:
+            message_id = self._generate_message_id(decode_header(packet_bytes))
+        return packet_bytes, message_id
+
+    @staticmethod
+    def _stored_at(stored_us: int) -> str:
+        return datetime.fromtimestamp(stored_us / 1_000_000, timezone.utc).isoformat()
+
+    def save_file_message(self, file_data: bytes, filename: str, message_packet: Union[Dict[str, Any], bytes], peer_name: str) -> str:
+        """save encrypted file message & returns as message_id"""
+        # split like a streamed file so equal data shares its chunks
+        chunks = (file_data[i:i + FILE_CHUNK_SIZE] for i in range(0, len(file_data), FILE_CHUNK_SIZE))
+        return self.save_file_stream(chunks, filename, message_packet, peer_name)
+
+    def save_file_stream(
+            self,
+            encrypted_chunks: Iterable[bytes],
+            filename: str,
+            message_packet: Union[Dict[str, Any], bytes],
+            peer_name: str) -> str:
+        """save a file message chunk by chunk into the chunk store, memory stays at one chunk"""
+        message_id = self._file_message_id(message_packet)
+        manifest, file_size = self.chunks.put_file(encrypted_chunks)
+        return self._finish_file_message(message_id, message_packet, manifest, filename, file_size, peer_name)
+
+    async def save_file_stream_async(
+            self,
+            encrypted_chunks: AsyncIterable[bytes],
+            filename: str,
+            message_packet: Union[Dict[str, Any], bytes],
+            peer_name: str) -> str:
+        """async-iterator version of save_file_stream, disk writes run off the event loop"""
+        message_id = self._file_message_id(message_packet)
+        digests: List[str] = []
+        file_size = 0
+        try:
+            async for chunk in encrypted_chunks:
+                digests.append(await asyncio.to_thread(self.chunks.put_chunk, chunk))
+                file_size += len(chunk)
+            manifest = await asyncio.to_thread(self.chunks.commit_file, digests)
+        except BaseException:
+            self.chunks.abort_file(digests)
+            raise
+        return await asyncio.to_thread(
+            self._finish_file_message, message_id, message_packet, manifest, filename, file_size, peer_name
+        )
+
+    def _file_message_id(self, message_packet: Union[Dict[str, Any], bytes]) -> str:
+        if is_encoded_packet(message_packet):
+            message_packet = decode_packet(message_packet)
+        return message_packet.get("message_id") or self._generate_message_id(message_packet)
+
+    def _finish_file_message(
+            self,
+            message_id: str,
+            message_packet: Union[Dict[str, Any], bytes],
+            manifest: str,
+            filename: str,
+            file_size: int,
+            peer_name: str) -> str:
+        """store the metadata record once the file chunks are on disk"""
+        raise NotImplementedError
+
+    def load_file_data(self, message_id: str) -> Optional[bytes]:
+        """load encrypted file data by message ID"""
+        blocks = self.iter_file_data(message_id)
+        if blocks is None:
+            return None
+        try:
+            return b"".join(blocks)
+        except FileNotFoundError:
+            return None
+
+    def iter_file_data(self, message_id: str, block_size: int = 64 * 1024) -> Optional[Iterator[bytes]]:
+        raise NotImplementedError
+
+    def get_cursor(self, message_id: str) -> Optional[str]:
+        """paging cursor pointing at a stored message"""
+        key = self._message_key(message_id)
+        return encode_cursor(key) if key is not None else None
+
+    def _message_key(self, message_id: str) -> Optional[PeerKey]:
+        # secondary (peer/time) key of a stored message, None when it isn't stored
+        raise NotImplementedError
+
+    def _generate_message_id(self, message_packet: Dict[str, Any]) -> str:
+        """generate unique message ID"""
+        timestamp = datetime.now(timezone.utc).isoformat()
+        data = f"{message_packet.get('from', '')}{message_packet.get('to', '')}{timestamp}"
+        return base64.b64encode(data.encode()).decode()[:16]
+
+class MessageStore(BaseMessageStore):
+    """handles storage and retrieval of encrypted messages and files
+
+    messages are appended as records to a SegmentLog under encrypted/log/, the offset
+    index (message_id --> segment/offset/length + metadata) lives in memory and is
+    persisted as the append-only encrypted/log/index.log. file data itself still goes
+    to encrypted/files/.
+    """
     
-    def __init__(self, encrypted_dir: str = "encrypted"):
+    # on-disk layout, overridden by CompactMessageStore
+    LOG_SUBDIR = "log"
+    INDEX_FILE = INDEX_LOG_FILE
+    SEGMENT_PREFIX = "seg-"
+    SEGMENT_SUFFIX = ".log"
+
+    def __init__(self, encrypted_dir: str = "encrypted", max_segment_bytes: int = DEFAULT_SEGMENT_BYTES):
         self.encrypted_dir = encrypted_dir
+        self.log_dir = os.path.join(encrypted_dir, self.LOG_SUBDIR)
         self.ensure_directories()
+        self._lock = threading.RLock()
+        self._index: Dict[str, Dict[str, Any]] = {}
+        self._index_lines = 0
+        self.log = SegmentLog(self.log_dir, max_segment_bytes, self.SEGMENT_PREFIX, self.SEGMENT_SUFFIX)
+        self.peer_index = PeerIndex(os.path.join(self.log_dir, PEER_INDEX_DIR))
+        # (segment, offset) of every live record --> message_id, filters stale secondary entries
+        self._live: Dict[Tuple[int, int], str] = {}
+        # per-segment partition bookkeeping for retention
+        self._segment_live: Dict[int, set] = {}
+        self._segment_max_us: Dict[int, int] = {}
+        self._active_bucket: Optional[int] = None
+        # running totals over the live index --> O(1) get_storage_stats
+        self._stats: Dict[str, Any] = {"text": 0, "file": 0, "bytes": 0, "peers": {}}
+        self._index_path = os.path.join(self.log_dir, self.INDEX_FILE)
+        # attachment data, deduplicated by content --> references are rebuilt from the index
+        self.chunks = ChunkStore(os.path.join(self.log_dir, "chunks"))
+        self._chunks_ready = False
+        self._load_index()
+        self.chunks.recover(
+            manifest for manifest in map(self._manifest, self._index.values()) if manifest is not None
+        )
+        self._chunks_ready = True
+        active_max = self._segment_max_us.get(self.log.active_segment)
+        self._active_bucket = active_max // PARTITION_US if active_max is not None else None
+        self._index_file = open(self._index_path, 'ab')
     def ensure_directories(self):
         """create necessary directories"""
         dirs = [
             self.encrypted_dir,
-            os.path.join(self.encrypted_dir, "messages"),
             os.path.join(self.encrypted_dir, "files"),
-            os.path.join(self.encrypted_dir, "metadata")
+            self.log_dir
         ]
         for dir_path in dirs:
             if not os.path.exists(dir_path):
                 os.makedirs(dir_path)
-    def save_message(self, message_packet: Dict[str, Any], peer_name: str) -> str:
-        """saving encrypted message to file & returns ass message_id"""
-        message_id = message_packet.get("message_id")
-        if not message_id:
-            message_id = self._generate_message_id(message_packet)
-        
-        # createion of message file path
-        timestamp = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")
-        filename = f"{peer_name}_{timestamp}_{message_id[:8]}.msg"
-        file_path = os.path.join(self.encrypted_dir, "messages", filename)
-        
-        # Add storage metadata
-        storage_data = {
-            "stored_at": datetime.now(timezone.utc).isoformat(),
-            "file_path": file_path,
-            "message_packet": message_packet,
-            "peer_name": peer_name,
-            "message_type": "text"
-        }
-        # save to file
-        with open(file_path, 'w') as f:
-            json.dump(storage_data, f, indent=2)
-        # update metadata index
-        self.update_message_index(message_id, file_path, peer_name, "text")
-        print(f"Message saved: {file_path}")
-        return message_id
+    def save_messages(self, items: Iterable[Tuple[Union[Dict[str, Any], bytes], str]], sync: bool = False) -> List[str]:
+        """save a batch of (message_packet, peer_name) with one log write, one index write
+        and, with sync=True, one fsync for the whole batch; returns the message_ids"""
+        metas: List[Dict[str, Any]] = []
+        payloads: List[bytes] = []
+        for message_packet, peer_name in items:
+            packet_bytes, message_id = self._packet_and_id(message_packet)
+            stored_us = time.time_ns() // 1000
+            metas.append({
+                "op": "put",
+                "message_id": message_id,
+                "peer_name": peer_name,
+                "message_type": "text",
+                "stored_at": self._stored_at(stored_us),
+                "stored_us": stored_us,
+            })
+            payloads.append(packet_bytes)
+        self._append_many(metas, payloads, sync)
+        return [meta["message_id"] for meta in metas]
     
-    def save_file_message(self, file_data: bytes, filename: str, message_packet: Dict[str, Any], peer_name: str) -> str:
-        """save encrypted file message & returns as message_id"""
-        message_id = message_packet.get("message_id")
-        if not message_id:
-            message_id = self._generate_message_id(message_packet)
-        # create file paths
-        timestamp = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")
-        safe_filename = self._safe_filename(filename)
-        # save encrypted file data
-        file_path = os.path.join(self.encrypted_dir, "files", f"{peer_name}_{timestamp}_{safe_filename}")
-        with open(file_path, 'wb') as f:
-            f.write(file_data)
-        # save message metadata
-        metadata_file = os.path.join(self.encrypted_dir, "metadata", f"{message_id}.json")
-        metadata = {
+    def _finish_file_message(
+            self,
+            message_id: str,
+            message_packet: Union[Dict[str, Any], bytes],
+            manifest: str,
+            filename: str,
+            file_size: int,
+            peer_name: str) -> str:
+        """append the metadata record once the file chunks are on disk"""
+        packet_bytes = bytes(message_packet) if is_encoded_packet(message_packet) else encode_packet(message_packet)
+        stored_us = time.time_ns() // 1000
+        # file_path is the chunk manifest, the references taken while writing now belong to this entry
+        file_path = self.chunks.manifest_path(manifest)
+        meta = {
+            "op": "put",
             "message_id": message_id,
-            "stored_at": datetime.now(timezone.utc).isoformat(),
-            "file_path": file_path,
-            "original_filename": filename,
-            "file_size": len(file_data),
-            "message_packet": message_packet,
             "peer_name": peer_name,
-            "message_type": "file"
+            "message_type": "file",
+            "stored_at": self._stored_at(stored_us),
+            "stored_us": stored_us,
+            "file_path": file_path,
+            "filename": filename,
+            "file_size": file_size,
         }
-        with open(metadata_file, 'w') as f:
-            json.dump(metadata, f, indent=2)
-        # update message index
-        self.update_message_index(message_id, file_path, peer_name, "file", filename)
+        try:
+            self._append(meta, packet_bytes)
+        except Exception:
+            self.chunks.release(manifest)
+            raise
         print(f"File message saved: {file_path}")
         return message_id
     
     def load_message(self, message_id: str) -> Optional[Dict[str, Any]]:
-        #load message by ID
-        index = self._load_message_index()
-        if message_id not in index:
+        #load message by ID --> one in-memory index lookup + one positioned read
+        entry = self._index.get(message_id)
+        if entry is None:
             return None
-        entry = index[message_id]
-        if entry["message_type"] == "text":
-            # load text message
-            try:
-                with open(entry["file_path"], 'r') as f:
-                    return json.load(f)
-            except FileNotFoundError:
-                return None
-        elif entry["message_type"] == "file":
-            # load file message metadata
-            metadata_file = os.path.join(self.encrypted_dir, "metadata", f"{message_id}.json")
-            try:
-                with open(metadata_file, 'r') as f:
-                    return json.load(f)
-            except FileNotFoundError:
+        return self._load_entry(entry)
+
+    def _load_entry(self, entry: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        message_id = entry["message_id"]
+        try:
+            payload = self.log.read(tuple(entry["location"]))
+        except Exception as e:
+            print(f"Error loading message {message_id}: {e}")
+            return None
+        # packet is parsed in place, ciphertext stays a view into the record
+        _meta, packet_view = self._decode_record(payload)
+        message_packet = decode_packet(packet_view)
+        cursor = encode_cursor(self._peer_key(entry))
+        if entry["message_type"] == "file":
+            return {
+                "message_id": message_id,
+                "stored_at": entry["stored_at"],
+                "file_path": entry["file_path"],
+                "original_filename": entry["filename"],
+                "file_size": entry["file_size"],
+                "message_packet": message_packet,
+                "peer_name": entry["peer_name"],
+                "message_type": "file",
+                "cursor": cursor
+            }
+        return {
+            "stored_at": entry["stored_at"],
+            "file_path": entry["file_path"],
+            "message_packet": message_packet,
+            "peer_name": entry["peer_name"],
+            "message_type": "text",
+            "cursor": cursor
+        }
+
+    def _message_key(self, message_id: str) -> Optional[PeerKey]:
+        entry = self._index.get(message_id)
+        return self._peer_key(entry) if entry else None
+
+    def iter_file_data(self, message_id: str, block_size: int = 64 * 1024) -> Optional[Iterator[bytes]]:
+        """lazily read encrypted file data by message ID, one chunk (or block) at a time"""
+        entry = self._index.get(message_id)
+        if entry is None or entry["message_type"] != "file":
+            return None
+        manifest = self._manifest(entry)
+        if manifest is not None:
+            if not os.path.exists(self.chunks.manifest_path(manifest)):
                 return None
-        return None
-    
-    def load_file_data(self, message_id: str) -> Optional[bytes]:
-        """load encrypted file data by message ID"""
-        message_data = self.load_message(message_id)
-        if not message_data or message_data.get("message_type") != "file":
+            return self.chunks.iter_file(manifest)
+        # plain file written before the chunk store
+        file_path = entry["file_path"]
+        if not os.path.exists(file_path):
             return None
-        try:
-            with open(message_data["file_path"], 'rb') as f:
-                return f.read()
-        except FileNotFoundError:
+
+        def blocks() -> Iterator[bytes]:
+            with open(file_path, 'rb') as f:
+                while True:
+                    block = f.read(block_size)
+                    if not block:
+                        return
+                    yield block
+        return blocks()
+
+    def _manifest(self, entry: Dict[str, Any]) -> Optional[str]:
+        if entry["message_type"] != "file":
             return None
+        return self.chunks.manifest_from_path(entry.get("file_path"))
+
+    def _release_file(self, entry: Dict[str, Any]):
+        """drop an index entry's hold on its file data"""
+        if entry["message_type"] != "file":
+            return
+        manifest = self._manifest(entry)
+        if manifest is not None:
+            self.chunks.release(manifest)
+        elif os.path.exists(entry["file_path"]):
+            os.remove(entry["file_path"])
+
     def get_messages_by_peer(self, peer_name: str) -> List[Dict[str, Any]]:
-        """gettting all messages from/to a specific peer"""
-        index = self._load_message_index()
+        """gettting all messages from/to a specific peer (oldest first, via the secondary index)"""
         peer_messages = []
-        for message_id, entry in index.items():
-            if entry["peer_name"] == peer_name:
-                message_data = self.load_message(message_id)
-                if message_data:
-                    peer_messages.append(message_data)
-        # sort by timestamp
-        peer_messages.sort(key=lambda x: x.get("stored_at", ""))
+        with self._lock:
+            keys = list(self.peer_index.entries(peer_name))
+        for key in keys:
+            message_id = self._live.get((key[1], key[2]))
+            if message_id is None:
+                continue
+            message_data = self._load_entry(self._index[message_id])
+            if message_data:
+                peer_messages.append(message_data)
         return peer_messages
+
+    def _peer_entries(self, peer_name: str, before: Optional[str]) -> Iterator[Dict[str, Any]]:
+        """newest-first live index entries of a peer strictly older than `before`, nothing is read"""
+        with self._lock:
+            # writer threads insert into the live list, walk a copy of the part we need
+            entries = self.peer_index.entries(peer_name)
+            end = len(entries) if before is None else bisect_left(entries, decode_cursor(before))
+            entries = entries[:end]
+        for i in range(end - 1, -1, -1):
+            key = entries[i]
+            message_id = self._live.get((key[1], key[2]))
+            entry = self._index.get(message_id) if message_id is not None else None
+            if entry is not None:
+                yield entry
+
+    def iter_peer(self, peer_name: str, before: Optional[str] = None) -> Iterator[Tuple[PeerKey, Dict[str, Any]]]:
+        """newest-first (key, message) pairs for a peer, strictly older than `before`; reads lazily"""
+        for entry in self._peer_entries(peer_name, before):
+            message_data = self._load_entry(entry)
+            if message_data:
+                yield self._peer_key(entry), message_data
+
+    def query(self, peer_name: str, before: Optional[str] = None, limit: int = 50) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """one page of a peer's messages older than `before` (oldest first) + cursor for the next page
+
+        only the records on the returned page are read from disk, the next cursor is None
+        once no older entry is left in the index.
+        """
+        page: List[Dict[str, Any]] = []
+        older = False
+        for entry in self._peer_entries(peer_name, before):
+            # the page is full and another entry is left --> only then is there a next page
+            if len(page) >= limit:
+                older = True
+                break
+            message_data = self._load_entry(entry)
+            if message_data:
+                page.append(message_data)
+        page.reverse()
+        next_cursor = page[0]["cursor"] if page and older else None
+        return page, next_cursor
     
     def get_recent_messages(self, limit: int = 50) -> List[Dict[str, Any]]:
         """get recent messages (all peers)"""
-        index = self._load_message_index()
+        # newest entries first straight from the index, only `limit` records are read
+        with self._lock:
+            entries = sorted(self._index.values(), key=lambda e: e.get("stored_us", 0), reverse=True)
         all_messages = []
-        for message_id in index:
-            message_data = self.load_message(message_id)
+        for entry in entries[:limit]:
+            message_data = self.load_message(entry["message_id"])
             if message_data:
                 all_messages.append(message_data)
-        # sort by timestamp (newest first)
-        all_messages.sort(key=lambda x: x.get("stored_at", ""), reverse=True)
-        return all_messages[:limit]
+        return all_messages
     
     def delete_message(self, message_id: str) -> bool:
         """delete a message and its files"""
-        index = self._load_message_index()
-        if message_id not in index:
+        entry = self._index.get(message_id)
+        if entry is None:
             return False
-        entry = index[message_id]
         try:
-            # delete main file
-            if os.path.exists(entry["file_path"]):
-                os.remove(entry["file_path"])
-            # delete metadata file for file messages
-            if entry["message_type"] == "file":
-                metadata_file = os.path.join(self.encrypted_dir, "metadata", f"{message_id}.json")
-                if os.path.exists(metadata_file):
-                    os.remove(metadata_file)
-            # remove from index
-            del index[message_id]
-            self._save_message_index(index)
+            # tombstone in the log + one index line, record space goes when its segment is dropped
+            # (file data loses its reference when the tombstone is applied)
+            self._append({"op": "del", "message_id": message_id}, b"")
             print(f"Message {message_id} deleted")
             return True
         except Exception as e:
@@ -164,170 +513,575 @@ class MessageStore:
             return False
     
     def get_storage_stats(self) -> Dict[str, Any]:
-        #get storage statistics
-        index = self._load_message_index() 
-        total_messages = len(index)
-        text_messages = sum(1 for entry in index.values() if entry["message_type"] == "text")
-        file_messages = sum(1 for entry in index.values() if entry["message_type"] == "file")
-        # calculate total storage size
-        total_size = 0
-        for entry in index.values():
-            try:
-                if os.path.exists(entry["file_path"]):
-                    total_size += os.path.getsize(entry["file_path"])
-            except:
-                pass
-        #get peer statistics
-        peer_stats = {}
-        for entry in index.values():
-            peer_name = entry["peer_name"]
-            if peer_name not in peer_stats:
-                peer_stats[peer_name] = {"text": 0, "file": 0}
-            peer_stats[peer_name][entry["message_type"]] += 1
+        """storage statistics from the running counters (no index or file scan)"""
+        with self._lock:
+            stats = self._stats
+            total_size = stats["bytes"]
+            peer_stats = {peer: dict(counts) for peer, counts in stats["peers"].items()}
+            text_messages, file_messages = stats["text"], stats["file"]
         return {
-            "total_messages": total_messages,
+            "total_messages": text_messages + file_messages,
             "text_messages": text_messages,
             "file_messages": file_messages,
             "total_size_bytes": total_size,
             "total_size_mb": round(total_size / (1024 * 1024), 2),
             "peer_statistics": peer_stats,
+            "chunk_store": self.chunks.stats(),
             "last_updated": datetime.now(timezone.utc).isoformat()
         }
-    
+
+    def _count(self, entry: Dict[str, Any], sign: int):
+        """add (sign=1) or remove (sign=-1) one index entry from the running stats"""
+        size = entry["location"][2]
+        if entry["message_type"] == "file":
+            size += entry.get("file_size") or 0
+        peers = self._stats["peers"]
+        counts = peers.get(entry["peer_name"])
+        if counts is None:
+            counts = peers[entry["peer_name"]] = {"text": 0, "file": 0, "bytes": 0}
+        counts[entry["message_type"]] += sign
+        counts["bytes"] += sign * size
+        self._stats[entry["message_type"]] += sign
+        self._stats["bytes"] += sign * size
+        if counts["text"] == 0 and counts["file"] == 0:
+            del peers[entry["peer_name"]]
+
     def cleanup_old_messages(self, days_old: int = 30) -> int:
-        """removing messages older than specified days"""
-        index = self._load_message_index()
-        cutoff_date = datetime.now(timezone.utc).timestamp() - (days_old * 24 * 3600)
-        messages_to_delete = []
-        for message_id, entry in index.items():
-            try:
-                stored_at = datetime.fromisoformat(entry["stored_at"].replace('Z', '+00:00'))
-                if stored_at.timestamp() < cutoff_date:
-                    messages_to_delete.append(message_id)
-            except:
-                continue
+        """removing messages older than specified days
+
+        segments never span two days, so expiry drops whole segments (plus segments holding
+        only deleted/overwritten records) and rewrites the index once. a segment goes when
+        its newest record is past the cutoff, i.e. retention is exact to the day.
+        """
+        cutoff_us = time.time_ns() // 1000 - days_old * PARTITION_US
         deleted_count = 0
-        for message_id in messages_to_delete:
-            if self.delete_message(message_id):
-                deleted_count += 1
+        with self._lock:
+            active = self.log.active_segment
+            if self._segment_live.get(active) and self._segment_max_us.get(active, 0) < cutoff_us:
+                # the active segment is expired as a whole, start a fresh one so it can go
+                self.log.roll()
+                self._active_bucket = None
+            expired = [
+                seg for seg in list(self.log.segments)
+                if seg != self.log.active_segment
+                and (not self._segment_live.get(seg) or self._segment_max_us.get(seg, 0) < cutoff_us)
+            ]
+            if not expired:
+                print("Cleaned up 0 old messages")
+                return 0
+            for seg in expired:
+                for message_id in self._segment_live.pop(seg, set()):
+                    entry = self._index.pop(message_id)
+                    self._count(entry, -1)
+                    self._live.pop((entry["location"][0], entry["location"][1]), None)
+                    self._release_file(entry)
+                    deleted_count += 1
+                self._segment_max_us.pop(seg, None)
+                self.log.delete_segment(seg)
+            # one index rewrite for the whole purge (secondary indexes included)
+            self.compact_index()
         print(f"Cleaned up {deleted_count} old messages")
         return deleted_count
     
-    def _generate_message_id(self, message_packet: Dict[str, Any]) -> str:
-        """generate unique message ID"""
-        timestamp = datetime.now(timezone.utc).isoformat()
-        data = f"{message_packet.get('from', '')}{message_packet.get('to', '')}{timestamp}"
-        return base64.b64encode(data.encode()).decode()[:16]
-    
     def _safe_filename(self, filename: str) -> str:
         """create safe filname"""
         import re
         safe = re.sub(r'[^\w\-_\.]', '_', filename)
         return safe[:100]
-    
-    def update_message_index(
-            self, 
-            message_id: str, 
-            file_path: str, 
-            peer_name: str, 
-            message_type: str, 
-            filename: str |None=None):
-        """update the message index"""
-        index = self._load_message_index()
-        index[message_id] = {
-            "message_id": message_id,
-            "file_path": file_path,
-            "peer_name": peer_name,
-            "message_type": message_type,
-            "stored_at": datetime.now(timezone.utc).isoformat(),
-            "filename": filename
-        }
-        self._save_message_index(index)
+
+    def _append(self, meta: Dict[str, Any], packet_bytes: bytes):
+        """append one record to the log and apply it to the offset index"""
+        self._append_many([meta], [packet_bytes])
+
+    def _append_many(self, metas: List[Dict[str, Any]], packets: List[bytes], sync: bool = False):
+        """append records to the log and apply them to the indexes, batched per file"""
+        records = [self._encode_record(meta, packet_bytes) for meta, packet_bytes in zip(metas, packets)]
+        with self._lock:
+            # day partitions: a new day starts a new segment, also in the middle of a batch
+            # (tombstones carry no time and stay in the segment they're written to)
+            locations: List[Tuple[int, int, int]] = []
+            start = 0
+            while start < len(records):
+                if self._active_bucket is None:
+                    self._active_bucket = time.time_ns() // 1000 // PARTITION_US
+                bucket = self._bucket_of(metas[start], self._active_bucket)
+                end = start + 1
+                while end < len(records) and self._bucket_of(metas[end], bucket) == bucket:
+                    end += 1
+                if bucket != self._active_bucket and self.log.active_size > 0:
+                    self.log.roll()
+                self._active_bucket = bucket
+                locations.extend(self.log.append_many(records[start:end], sync))
+                start = end
+            peer_keys: Dict[str, List[PeerKey]] = {}
+            for meta, location in zip(metas, locations):
+                key = self._apply(meta, location)
+                if key is not None:
+                    peer_keys.setdefault(meta["peer_name"], []).append(key)
+            for peer_name, keys in peer_keys.items():
+                self.peer_index.add_many(peer_name, keys)
+            self._write_index_lines(metas, locations, sync)
+
+    @staticmethod
+    def _bucket_of(meta: Dict[str, Any], default: int) -> int:
+        stored_us = meta.get("stored_us")
+        return default if stored_us is None else stored_us // PARTITION_US
+
+    def _apply(self, meta: Dict[str, Any], location: Tuple[int, int, int]) -> Optional[PeerKey]:
+        """apply a put/del record to the in-memory index, returns the secondary key of a put"""
+        old = self._index.pop(meta["message_id"], None)
+        if old is not None:
+            self._live.pop((old["location"][0], old["location"][1]), None)
+            self._segment_live.get(old["location"][0], set()).discard(meta["message_id"])
+            self._count(old, -1)
+            if self._chunks_ready:
+                self._release_file(old)
+        if meta["op"] == "del":
+            return None
+        entry = {k: v for k, v in meta.items() if k != "op"}
+        entry.setdefault("file_path", self.log.segment_path(location[0]))
+        entry.setdefault("filename", None)
+        if "stored_us" not in entry:
+            entry["stored_us"] = timestamp_to_us(entry["stored_at"])
+        entry["location"] = list(location)
+        self._index[meta["message_id"]] = entry
+        self._count(entry, 1)
+        self._live[(location[0], location[1])] = meta["message_id"]
+        self._segment_live.setdefault(location[0], set()).add(meta["message_id"])
+        if entry["stored_us"] > self._segment_max_us.get(location[0], -1):
+            self._segment_max_us[location[0]] = entry["stored_us"]
+        return self._peer_key(entry)
+
+    @staticmethod
+    def _peer_key(entry: Dict[str, Any]) -> PeerKey:
+        segment, offset, length = entry["location"]
+        return (entry["stored_us"], segment, offset, length)
+
+    def _sync_peer_index(self, rewrite_all: bool = False):
+        """check the persisted secondary index against the primary one, rewrite peers that drifted"""
+        expected: Dict[str, List[PeerKey]] = {}
+        for entry in self._index.values():
+            expected.setdefault(entry["peer_name"], []).append(self._peer_key(entry))
+        for peer_name in set(self.peer_index.peers()) - set(expected):
+            self.peer_index.replace(peer_name, [])
+        for peer_name, keys in expected.items():
+            if rewrite_all:
+                self.peer_index.replace(peer_name, keys)
+                continue
+            loaded = self.peer_index.load(peer_name)
+            live = {key for key in loaded if self._live.get((key[1], key[2])) is not None}
+            if live != set(keys):
+                self.peer_index.replace(peer_name, keys)
+
+    def _write_index_lines(self, metas: List[Dict[str, Any]], locations: List[Tuple[int, int, int]], sync: bool = False):
+        lines = [self._encode_index_entry(meta, location) for meta, location in zip(metas, locations)]
+        self._index_file.write(b"".join(lines))
+        self._index_file.flush()
+        if sync:
+            os.fsync(self._index_file.fileno())
+        self._index_lines += len(lines)
+        if self._index_lines - len(self._index) > max(len(self._index), INDEX_COMPACT_SLACK):
+            self.compact_index()
+
+    def _load_index(self):
+        """replay the index file, or rebuild it from the segments if it is missing"""
+        if not os.path.exists(self._index_path):
+            self._rebuild_index()
+            return
+        with open(self._index_path, 'rb') as f:
+            data = f.read()
+        for meta, location in self._decode_index_entries(data):
+            self._apply(meta, location)
+            self._index_lines += 1
+        self._sync_peer_index()
+
+    def _rebuild_index(self):
+        """recover the offset index by scanning every segment record"""
+        for location, payload in self.log.scan():
+            meta, _packet_view = self._decode_record(payload)
+            self._apply(meta, location)
+        self._write_index_snapshot()
+        self._sync_peer_index(rewrite_all=True)
+
+    def compact_index(self):
+        """rewrite the index file with only live entries"""
+        with self._lock:
+            self._index_file.close()
+            self._write_index_snapshot()
+            self._index_file = open(self._index_path, 'ab')
+            # drop stale secondary entries along with the dead index lines
+            self._sync_peer_index(rewrite_all=True)
+
+    def _write_index_snapshot(self):
+        tmp_path = self._index_path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            for entry in self._index.values():
+                meta = dict(entry)
+                meta["op"] = "put"
+                f.write(self._encode_index_entry(meta, tuple(entry["location"])))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._index_path)
+        self._index_lines = len(self._index)
+
+    # record / index encodings --> JSON here, msgpack + binary in CompactMessageStore
+    def _encode_record(self, meta: Dict[str, Any], packet_bytes: bytes) -> bytes:
+        meta_bytes = json.dumps(meta, separators=(',', ':')).encode('utf-8')
+        return RECORD_META.pack(len(meta_bytes)) + meta_bytes + packet_bytes
+
+    def _decode_record(self, payload: bytes) -> Tuple[Dict[str, Any], memoryview]:
+        (meta_len,) = RECORD_META.unpack_from(payload)
+        view = memoryview(payload)
+        meta = json.loads(bytes(view[RECORD_META.size:RECORD_META.size + meta_len]))
+        return meta, view[RECORD_META.size + meta_len:]
+
+    def _encode_index_entry(self, meta: Dict[str, Any], location: Tuple[int, int, int]) -> bytes:
+        line = dict(meta)
+        if meta["op"] == "put":
+            line["location"] = list(location)
+        return (json.dumps(line, separators=(',', ':')) + "\n").encode('utf-8')
+
+    def _decode_index_entries(self, data: bytes) -> Iterator[Tuple[Dict[str, Any], Tuple[int, int, int]]]:
+        for line in data.splitlines():
+            try:
+                meta = json.loads(line)
+            except ValueError:
+                # torn last line, the record itself is still in the log
+                continue
+            yield meta, tuple(meta.get("location", (0, 0, 0)))
 
     def _load_message_index(self) -> Dict[str, Any]:
-        """load message index from file"""
-        index_file = os.path.join(self.encrypted_dir, "message_index.json")
-        if not os.path.exists(index_file):
-            return {}
+        """message index (in-memory, kept in sync with index.log)"""
+        return self._index
+
+    def snapshot_files(self) -> Tuple[List[Tuple[str, BinaryIO, int, bool]], List[str]]:
+        """point-in-time view of the store for backups
+
+        returns open handles as (path relative to encrypted_dir, file, size, immutable) plus the
+        chunk manifests that were live at that point. the lock is held only while opening the
+        log files: the handles keep dropped/replaced files readable and the manifests are pinned
+        in the chunk store. the caller closes the handles and releases the manifests.
+        """
+        handles: List[Tuple[str, BinaryIO, int, bool]] = []
+        manifests: List[str] = []
+
+        def add(path: str, size: Optional[int] = None, immutable: bool = True):
+            f = open(path, 'rb')
+            handles.append((self._relpath(path), f, os.fstat(f.fileno()).st_size if size is None else size, immutable))
+
         try:
-            with open(index_file, 'r') as f:
-                return json.load(f)
-        except:
-            return {}
-    
-    def _save_message_index(self, index: Dict[str, Any]):
-        """save message index to file"""
-        index_file = os.path.join(self.encrypted_dir, "message_index.json")
-        with open(index_file, 'w') as f:
-            json.dump(index, f, indent=2)
-
-class CompactMessageStore:
-    """alt storage system using MessagePack for compact binary storage"""
-    def __init__(self, encrypted_dir: str = "encrypted"):
-        self.encrypted_dir = encrypted_dir
-        self.compact_dir = os.path.join(encrypted_dir, "compact")
-        self.ensure_directories()
-    def ensure_directories(self):
-        """createion of compact storage directory"""
-        if not os.path.exists(self.compact_dir):
-            os.makedirs(self.compact_dir)
+            legacy_files = []
+            with self._lock:
+                for seg in self.log.segments:
+                    active = seg == self.log.active_segment
+                    add(self.log.segment_path(seg), self.log.active_size if active else None, not active)
+                add(self._index_path, immutable=False)
+                for entry in self._index.values():
+                    manifest = self._manifest(entry)
+                    if manifest is not None:
+                        self.chunks.retain(manifest)
+                        manifests.append(manifest)
+                    elif entry["message_type"] == "file":
+                        legacy_files.append(entry["file_path"])
+            # plain files from before the chunk store, may be deleted meanwhile
+            for path in legacy_files:
+                try:
+                    add(path)
+                except FileNotFoundError:
+                    continue
+            # content-addressed chunks never change and stay around while pinned
+            seen = set()
+            for manifest in manifests:
+                if manifest in seen:
+                    continue
+                seen.add(manifest)
+                add(self.chunks.manifest_path(manifest))
+                for digest in self.chunks.read_manifest(manifest):
+                    if digest not in seen:
+                        seen.add(digest)
+                        add(self.chunks.chunk_path(digest))
+        except Exception:
+            for _relpath, f, _size, _immutable in handles:
+                f.close()
+            for manifest in manifests:
+                self.chunks.release(manifest)
+            raise
+        return handles, manifests
+
+    def _relpath(self, path: str) -> str:
+        return os.path.relpath(path, self.encrypted_dir)
+
+    def close(self):
+        with self._lock:
+            self._index_file.close()
+            self.peer_index.close()
+            self.log.close()
+
+# compact index entry: op | type | segment | offset | length | stored_us | file_size
+#                      | id len | peer len | filename len | file path len, then those strings
+COMPACT_INDEX_ENTRY = struct.Struct(">BBIQIqQHHHH")
+_COMPACT_OPS = {"put": 1, "del": 2}
+_COMPACT_OP_NAMES = {v: k for k, v in _COMPACT_OPS.items()}
+_COMPACT_TYPES = {"text": 1, "file": 2}
+_COMPACT_TYPE_NAMES = {v: k for k, v in _COMPACT_TYPES.items()}
+# short msgpack keys for record metadata
+_COMPACT_KEYS = {
+    "op": "o", "message_id": "i", "peer_name": "n", "message_type": "t",
+    "stored_us": "u", "file_path": "f", "filename": "fn", "file_size": "s",
+}
+_COMPACT_KEY_NAMES = {v: k for k, v in _COMPACT_KEYS.items()}
+
+class CompactMessageStore(MessageStore):
+    """alt storage system using MessagePack for compact binary storage
+
+    same API as MessageStore: records are msgpack maps (raw packet bytes, short keys) in
+    encrypted/compact/pack-*.pack and the offset index is an append-only binary file.
+    """
+    LOG_SUBDIR = "compact"
+    INDEX_FILE = "index.bin"
+    SEGMENT_PREFIX = "pack-"
+    SEGMENT_SUFFIX = ".pack"
+
+    def __init__(self, encrypted_dir: str = "encrypted", max_segment_bytes: int = DEFAULT_SEGMENT_BYTES):
+        super().__init__(encrypted_dir, max_segment_bytes)
+        self.compact_dir = self.log_dir
+
     def save_message_compact(self, message_packet: Dict[str, Any], peer_name: str) -> str:
         """save message using MessagePack (binary, compact)"""
-        message_id = message_packet.get("message_id", self._generate_message_id(message_packet))
-        # create compact storage data
-        compact_data = {
-            "id": message_id,
-            "peer": peer_name,
-            "stored": datetime.now(timezone.utc).timestamp(),
-            "packet": message_packet
-        }
-        # save using MessagePack
-        filename = f"{peer_name}_{message_id[:8]}.msgpack"
-        file_path = os.path.join(self.compact_dir, filename)
-        with open(file_path, 'wb') as f:
-            msgpack.dump(compact_data, f)
-        print(f"Compact message saved: {file_path}")
-        return message_id
+        return self.save_message(message_packet, peer_name)
     
     def load_message_compact(self, message_id: str, peer_name: str) -> Optional[Dict[str, Any]]:
         """load message from compact storage"""
-        filename = f"{peer_name}_{message_id[:8]}.msgpack"
-        file_path = os.path.join(self.compact_dir, filename)
-        if not os.path.exists(file_path):
-            return None
-        try:
-            with open(file_path, 'rb') as f:
-                result = msgpack.load(f, raw=False)
-            if isinstance(result, dict):
-                return result
-            else:
-                return None
-        except:
+        message_data = self.load_message(message_id)
+        if message_data is None or message_data["peer_name"] != peer_name:
             return None
-    
-    def _generate_message_id(self, message_packet: Dict[str, Any]) -> str:
-        """generation of unique message ID"""
-        timestamp = datetime.now(timezone.utc).isoformat()
-        data = f"{message_packet.get('from', '')}{message_packet.get('to', '')}{timestamp}"
-        return base64.b64encode(data.encode()).decode()[:16]
+        return message_data
+
+    def _encode_record(self, meta: Dict[str, Any], packet_bytes: bytes) -> bytes:
+        compact_meta = {_COMPACT_KEYS[k]: v for k, v in meta.items() if k in _COMPACT_KEYS}
+        return msgpack.packb({"m": compact_meta, "p": packet_bytes}, use_bin_type=True)
+
+    def _decode_record(self, payload: bytes) -> Tuple[Dict[str, Any], memoryview]:
+        record = msgpack.unpackb(payload, raw=False)
+        meta = {_COMPACT_KEY_NAMES[k]: v for k, v in record["m"].items()}
+        if "stored_us" in meta:
+            meta["stored_at"] = self._stored_at(meta["stored_us"])
+        return meta, memoryview(record["p"])
+
+    def _encode_index_entry(self, meta: Dict[str, Any], location: Tuple[int, int, int]) -> bytes:
+        message_id = meta["message_id"].encode('utf-8')
+        if meta["op"] == "del":
+            return COMPACT_INDEX_ENTRY.pack(_COMPACT_OPS["del"], 0, 0, 0, 0, 0, 0, len(message_id), 0, 0, 0) + message_id
+        peer = meta["peer_name"].encode('utf-8')
+        filename = (meta.get("filename") or "").encode('utf-8')
+        file_path = (meta.get("file_path") or "").encode('utf-8') if meta["message_type"] == "file" else b""
+        header = COMPACT_INDEX_ENTRY.pack(
+            _COMPACT_OPS["put"], _COMPACT_TYPES[meta["message_type"]], location[0], location[1], location[2],
+            meta["stored_us"], meta.get("file_size") or 0,
+            len(message_id), len(peer), len(filename), len(file_path)
+        )
+        return b"".join((header, message_id, peer, filename, file_path))
+
+    def _decode_index_entries(self, data: bytes) -> Iterator[Tuple[Dict[str, Any], Tuple[int, int, int]]]:
+        view = memoryview(data)
+        offset = 0
+        while offset + COMPACT_INDEX_ENTRY.size <= len(view):
+            (op, message_type, segment, record_offset, length, stored_us, file_size,
+             id_len, peer_len, name_len, path_len) = COMPACT_INDEX_ENTRY.unpack_from(view, offset)
+            start = offset + COMPACT_INDEX_ENTRY.size
+            end = start + id_len + peer_len + name_len + path_len
+            if end > len(view) or op not in _COMPACT_OP_NAMES:
+                # torn tail entry
+                return
+            fields = []
+            for field_len in (id_len, peer_len, name_len, path_len):
+                fields.append(str(view[start:start + field_len], 'utf-8'))
+                start += field_len
+            offset = end
+            meta: Dict[str, Any] = {"op": _COMPACT_OP_NAMES[op], "message_id": fields[0]}
+            if meta["op"] == "put":
+                meta.update({
+                    "peer_name": fields[1],
+                    "message_type": _COMPACT_TYPE_NAMES.get(message_type, "text"),
+                    "stored_us": stored_us,
+                    "stored_at": self._stored_at(stored_us),
+                })
+                if meta["message_type"] == "file":
+                    meta.update({"filename": fields[2], "file_path": fields[3], "file_size": file_size})
+            yield meta, (segment, record_offset, length)
 
 # use cases functionings
-def create_message_store(encrypted_dir: str = "encrypted") -> MessageStore:
-    """create a new message store"""
-    return MessageStore(encrypted_dir)
+# storage engines selectable through create_message_store
+STORE_BACKENDS = {
+    "log": MessageStore,
+    "compact": CompactMessageStore,
+    "sqlite": None,  # sqlite_store.SQLiteMessageStore, imported on first use (it imports this module)
+}
+
+_STORES: Dict[Tuple[str, str], BaseMessageStore] = {}
+_STORES_LOCK = threading.Lock()
+
+def create_message_store(encrypted_dir: str = "encrypted", backend: str = "log") -> BaseMessageStore:
+    """message store for a directory --> one engine per directory, the log allows a single writer"""
+    if backend not in STORE_BACKENDS:
+        raise ValueError(f"Unknown storage backend: {backend}")
+    key = (os.path.abspath(encrypted_dir), backend)
+    with _STORES_LOCK:
+        store = _STORES.get(key)
+        if store is None or not os.path.exists(store.log_dir):
+            store_class = STORE_BACKENDS[backend]
+            if store_class is None:
+                from sqlite_store import SQLiteMessageStore
+                store_class = STORE_BACKENDS[backend] = SQLiteMessageStore
+            store = _STORES[key] = store_class(encrypted_dir)
+        return store
+
+# backups --> <backup_path>/<snapshot id>/ holds the files of one snapshot plus manifest.json,
+# files unchanged since the previous snapshot are hard-linked (or, with link=False, only referenced)
+BACKUP_MANIFEST = "manifest.json"
+BACKUP_COPY_BLOCK = 1024 * 1024
 
-def backup_messages(store: MessageStore, backup_path: str) -> bool:
-    """create backup of all messages"""
+def list_backups(backup_path: str) -> List[str]:
+    """completed snapshot ids, oldest first"""
+    if not os.path.isdir(backup_path):
+        return []
+    return sorted(
+        name for name in os.listdir(backup_path)
+        if os.path.exists(os.path.join(backup_path, name, BACKUP_MANIFEST))
+    )
+
+def load_backup_manifest(backup_path: str, snapshot_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """manifest of a snapshot, the latest one by default"""
+    if snapshot_id is None:
+        snapshots = list_backups(backup_path)
+        if not snapshots:
+            return None
+        snapshot_id = snapshots[-1]
     try:
-        import shutil
-        shutil.copytree(store.encrypted_dir, backup_path)
-        print(f"Messages backed up to: {backup_path}")
-        return True
+        with open(os.path.join(backup_path, snapshot_id, BACKUP_MANIFEST), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def _copy_hashed(src: BinaryIO, size: int, dst_path: str) -> str:
+    """copy the first size bytes of src to dst_path, returns their blake2b"""
+    digest = hashlib.blake2b(digest_size=32)
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    with open(dst_path, 'wb') as dst:
+        offset = 0
+        while offset < size:
+            block = os.pread(src.fileno(), min(BACKUP_COPY_BLOCK, size - offset), offset)
+            if not block:
+                raise Exception(f"{dst_path}: source shrank during backup")
+            digest.update(block)
+            dst.write(block)
+            offset += len(block)
+        dst.flush()
+        os.fsync(dst.fileno())
+    return digest.hexdigest()
+
+def backup_messages(store: MessageStore, backup_path: str, link: bool = True) -> Optional[str]:
+    """incremental backup of a message store, returns the new snapshot id
+
+    only files that changed since the last snapshot are copied: sealed segments and chunks
+    are immutable so a matching size means unchanged, the active segment and the index are
+    copied up to the snapshot point. writes keep going while the copy runs.
+    """
+    previous = load_backup_manifest(backup_path)
+    previous_files = previous["files"] if previous else {}
+    snapshot_id = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+    partial_dir = os.path.join(backup_path, snapshot_id + ".partial")
+    handles, manifests = store.snapshot_files()
+    files: Dict[str, Dict[str, Any]] = {}
+    copied_bytes = 0
+    try:
+        os.makedirs(partial_dir)
+        for relpath, f, size, immutable in handles:
+            dst_path = os.path.join(partial_dir, relpath)
+            old = previous_files.get(relpath)
+            if immutable and old is not None and old["size"] == size:
+                if not link:
+                    files[relpath] = old
+                    continue
+                try:
+                    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+                    os.link(os.path.join(backup_path, old["snapshot"], relpath), dst_path)
+                    files[relpath] = dict(old, snapshot=snapshot_id)
+                    continue
+                except OSError:
+                    pass  # other filesystem / pruned snapshot --> copy instead
+            files[relpath] = {"size": size, "blake2b": _copy_hashed(f, size, dst_path), "snapshot": snapshot_id}
+            copied_bytes += size
+        manifest = {
+            "snapshot": snapshot_id,
+            "parent": previous["snapshot"] if previous else None,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "store": type(store).__name__,
+            "copied_bytes": copied_bytes,
+            "files": files,
+        }
+        with open(os.path.join(partial_dir, BACKUP_MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(partial_dir, os.path.join(backup_path, snapshot_id))
+        print(f"Messages backed up to: {os.path.join(backup_path, snapshot_id)} ({len(files)} files, {copied_bytes} bytes copied)")
+        return snapshot_id
     except Exception as e:
+        shutil.rmtree(partial_dir, ignore_errors=True)
         print(f"Backup failed: {e}")
+        return None
+    finally:
+        for _relpath, f, _size, _immutable in handles:
+            f.close()
+        for manifest_digest in manifests:
+            store.chunks.release(manifest_digest)
+
+async def backup_messages_async(store: MessageStore, backup_path: str, link: bool = True) -> Optional[str]:
+    """backup_messages off the event loop"""
+    return await asyncio.to_thread(backup_messages, store, backup_path, link)
+
+def restore_messages(backup_path: str, encrypted_dir: str, snapshot_id: Optional[str] = None) -> bool:
+    """restore a snapshot (latest by default) into an empty encrypted_dir, checking every hash"""
+    manifest = load_backup_manifest(backup_path, snapshot_id)
+    if manifest is None:
+        print(f"No backup found in {backup_path}")
+        return False
+    if os.path.isdir(encrypted_dir) and os.listdir(encrypted_dir):
+        print(f"Restore target {encrypted_dir} is not empty")
+        return False
+    partial_dir = encrypted_dir.rstrip(os.sep) + ".restoring"
+    try:
+        for relpath, entry in manifest["files"].items():
+            with open(os.path.join(backup_path, entry["snapshot"], relpath), 'rb') as src:
+                digest = _copy_hashed(src, entry["size"], os.path.join(partial_dir, relpath))
+            if digest != entry["blake2b"]:
+                raise Exception(f"{relpath}: checksum mismatch")
+        if os.path.isdir(encrypted_dir):
+            os.rmdir(encrypted_dir)
+        os.replace(partial_dir, encrypted_dir)
+        print(f"Snapshot {manifest['snapshot']} restored to {encrypted_dir}")
+        return True
+    except Exception as e:
+        shutil.rmtree(partial_dir, ignore_errors=True)
+        print(f"Restore failed: {e}")
         return False
 
-if __name__ == "__main__":
+if __name__ == "__main__" and len(sys.argv) > 1:
+    # python file_store.py backup <backup dir> [encrypted dir] [backend]
+    # python file_store.py restore <backup dir> <encrypted dir> [snapshot id]
+    command, args = sys.argv[1], sys.argv[2:]
+    if command == "backup" and args:
+        store = create_message_store(args[1] if len(args) > 1 else "encrypted", args[2] if len(args) > 2 else "log")
+        ok = backup_messages(store, args[0]) is not None
+        store.close()
+    elif command == "restore" and len(args) >= 2:
+        ok = restore_messages(args[0], args[1], args[2] if len(args) > 2 else None)
+    else:
+        print("usage: file_store.py backup <backup dir> [encrypted dir] [backend] | restore <backup dir> <encrypted dir> [snapshot]")
+        ok = False
+    sys.exit(0 if ok else 1)
+elif __name__ == "__main__":
     # test the message store
     print("Testing Message Store...")
     store = create_message_store()
@@ -1,15 +1,56 @@
 # main.py
 import asyncio
+import io
 import websockets
-import json
 import os
 import shutil
-from p2p_engine import P2PNetworkSimulator
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+from p2p_engine import P2PNetworkSimulator, conversation_key
+from peer_transport import TRANSPORT_LOOPBACK, TRANSPORT_TCP
+from p2p_crypto import reset_keyrings
+from client_outbox import ClientOutbox, POLICY_DROP_OLDEST
+from ws_codec import SUBPROTOCOLS, encode_frame, decode_frame, payload_bytes
+from shard_network import ShardedNetwork
 
+# how packets travel between peers: in-process (loopback) or over real tcp sockets
+PEER_TRANSPORT = TRANSPORT_LOOPBACK
 # single global connection
-NETWORK = P2PNetworkSimulator()
+NETWORK = P2PNetworkSimulator(transport=PEER_TRANSPORT)
+# sharded mode --> SHARD_COUNT > 0 partitions the peers across that many worker processes,
+# NETWORK is then unused in this (front) process and every worker runs its own
+SHARD_COUNT = 0
+SHARDS = None
+# actions run on the shard owning the peer named by this payload field
+SHARD_ROUTED_ACTIONS = {
+    "create_peer": "name",
+    "send_message": "from",
+    "get_history": "peer_a",
+    "send_file": "from",
+    "get_file": "peer_a",
+    "get_peer_card": "name",
+    "connect_remote": "peer",
+}
 CONNECTED_CLIENTS = set()
+# targeted delivery: subscription key (peer name or conversation_key) --> subscribed connections
+SUBSCRIPTIONS = {}
+CLIENT_SUBSCRIPTIONS = {}
+# per-connection outbound event queues --> a slow client only ever delays itself
+OUTBOXES = {}
+OUTBOX_MAX_QUEUE = 256
+OUTBOX_POLICY = POLICY_DROP_OLDEST  # or "coalesce" / "disconnect", see client_outbox
 SHUTDOWN_EVENT = asyncio.Event()
+# largest incoming frame, file uploads come in one send_file request
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+# permessage-deflate --> clients may still ask for smaller windows / no context takeover in their offer
+DEFLATE_ENABLED = True
+DEFLATE_LEVEL = 6
+DEFLATE_MEM_LEVEL = 5
+DEFLATE_MAX_WINDOW_BITS = 12
+# upper bound for one send_messages request
+MAX_BULK_MESSAGES = 10000
+# retention --> stored messages older than this are dropped (whole day partitions)
+RETENTION_DAYS = 30
+RETENTION_INTERVAL_SECONDS = 3600
 #API handler --> works now. 10/6/25
 
 async def handle_create_peer(payload):
@@ -17,14 +58,35 @@ async def handle_create_peer(payload):
     if not name:
         return {"success": False, "error": "Peer name is required."}
     NETWORK.create_peer(name)
+    if NETWORK.transport == TRANSPORT_TCP:
+        await NETWORK.listen(name)
     return {"success": True, "message": f"Peer '{name}' created."}
 
+async def handle_get_peer_card(payload):
+    # name, public key and tcp address of a peer --> what connect_remote on another server needs
+    name = payload.get("name")
+    if name not in NETWORK.peers:
+        return {"success": False, "error": "Unknown peer."}
+    return {"success": True, "card": NETWORK.peers[name].get_qr_data()}
+
+async def handle_connect_remote(payload):
+    peer = payload.get("peer")
+    card = payload.get("card")
+    if peer not in NETWORK.peers or not isinstance(card, dict):
+        return {"success": False, "error": "A local peer and a peer card are required."}
+    if not NETWORK.peers[peer].connect_remote(card):
+        return {"success": False, "error": "Failed to connect to remote peer."}
+    return {"success": True, "message": f"{peer} connected to {card['peer_name']}."}
+
 async def handle_connect_peers(payload):
     peer1 = payload.get("peer1")
     peer2 = payload.get("peer2")
     if not all([peer1, peer2]):
         return {"success": False, "error": "Both peer names are required."}
-    success = NETWORK.connect_peers(peer1, peer2)
+    if SHARDS is not None:
+        success = await SHARDS.connect_peers(peer1, peer2)
+    else:
+        success = NETWORK.connect_peers(peer1, peer2)
     if success:
         return {"success": True, "message": f"Connection between {peer1} and {peer2} established."}
     return {"success": False, "error": "Failed to connect peers."}
@@ -40,14 +102,89 @@ async def handle_send_message(payload):
     # on_message_received callback sends a push & receiver gets the message via a server push.
     return {"success": True}
 
+async def handle_send_messages(payload):
+    # bulk send: {"messages": [{"from", "to", "message"}, ...]} --> one aggregated ack
+    messages = payload.get("messages")
+    if not isinstance(messages, list) or not messages:
+        return {"success": False, "error": "messages must be a non-empty list."}
+    if len(messages) > MAX_BULK_MESSAGES:
+        return {"success": False, "error": f"At most {MAX_BULK_MESSAGES} messages per request."}
+    items = []
+    for entry in messages:
+        if not isinstance(entry, dict) or not all(entry.get(k) for k in ("from", "to", "message")):
+            return {"success": False, "error": "Every message needs from, to and message."}
+        items.append((entry["from"], entry["to"], entry["message"]))
+    network = SHARDS if SHARDS is not None else NETWORK
+    result = await network.route_messages(items)
+    return {"success": result["failed"] == 0, **result}
+
+async def handle_send_file(payload):
+    # data is raw bytes on msgpack connections, base64 on JSON ones
+    sender = payload.get("from")
+    recipient = payload.get("to")
+    filename = payload.get("filename")
+    if not all([sender, recipient, filename]) or sender not in NETWORK.peers:
+        return {"success": False, "error": "Sender, recipient and filename are required."}
+    data = payload_bytes(payload.get("data", b""))
+    message_id = await asyncio.to_thread(NETWORK.peers[sender].send_file, recipient, io.BytesIO(data), filename)
+    if message_id is None:
+        return {"success": False, "error": "Failed to send file."}
+    return {"success": True, "message_id": message_id, "size": len(data)}
+
+async def handle_get_file(payload):
+    peer_a = payload.get("peer_a")
+    peer_b = payload.get("peer_b")
+    message_id = payload.get("message_id")
+    if not all([peer_a, peer_b, message_id]) or peer_a not in NETWORK.peers:
+        return {"success": False, "error": "Invalid file lookup."}
+    def read():
+        chunks = NETWORK.peers[peer_a].read_file(peer_b, message_id)
+        return None if chunks is None else b"".join(chunks)
+    data = await asyncio.to_thread(read)
+    if data is None:
+        return {"success": False, "error": "File not found."}
+    return {"success": True, "message_id": message_id, "data": data}
+
 async def handle_get_history(payload):
     peer_a = payload.get("peer_a")
     peer_b = payload.get("peer_b")
     if not all([peer_a, peer_b]) or peer_a not in NETWORK.peers:
         return {"success": False, "error": "Invalid peers for history lookup."}
     
-    history = NETWORK.peers[peer_a].get_conversation_history(peer_b)
-    return {"success": True, "history": history}
+    # optional paging: "before" is the next_cursor of a previous page
+    before = payload.get("before")
+    try:
+        limit = max(1, min(int(payload.get("limit", 50)), 500))
+    except (TypeError, ValueError):
+        return {"success": False, "error": "limit must be an integer."}
+    try:
+        history, next_cursor = await NETWORK.peers[peer_a].get_conversation_page_async(peer_b, before, limit)
+    except ValueError as e:
+        return {"success": False, "error": str(e)}
+    return {"success": True, "history": history, "next_cursor": next_cursor}
+
+async def handle_stats(payload):
+    # counters only, cheap enough to poll
+    stats = await SHARDS.get_storage_stats() if SHARDS is not None else NETWORK.get_storage_stats()
+    outboxes = [outbox.stats() for outbox in OUTBOXES.values()]
+    stats["delivery"] = {
+        "clients": len(outboxes),
+        "queued": sum(o["depth"] for o in outboxes),
+        "max_depth": max((o["max_depth"] for o in outboxes), default=0),
+        "sent": sum(o["sent"] for o in outboxes),
+        "dropped": sum(o["dropped"] for o in outboxes),
+        "coalesced": sum(o["coalesced"] for o in outboxes),
+        "policy": OUTBOX_POLICY,
+        "protocols": protocol_counts(),
+    }
+    return {"success": True, "stats": stats}
+
+def protocol_counts():
+    counts = {}
+    for websocket in OUTBOXES:
+        protocol = websocket.subprotocol or "json"
+        counts[protocol] = counts.get(protocol, 0) + 1
+    return counts
 
 # handler for shutdown command
 async def handle_shutdown(payload):
@@ -56,68 +193,215 @@ async def handle_shutdown(payload):
     SHUTDOWN_EVENT.set() # Trigger global shutdown event
     return {"success": True, "message": "Server is shutting down."}
 
+def subscription_keys(payload):
+    """routing keys of a subscribe/unsubscribe payload: {"peers": [...], "conversations": [[a, b], ...]}"""
+    keys = set()
+    for peer in payload.get("peers") or []:
+        keys.add(str(peer))
+    for pair in payload.get("conversations") or []:
+        if not isinstance(pair, (list, tuple)) or len(pair) != 2:
+            raise ValueError("conversations must be [peer_a, peer_b] pairs")
+        keys.add(conversation_key(str(pair[0]), str(pair[1])))
+    return keys
+
+async def handle_subscribe(websocket, payload):
+    keys = subscription_keys(payload)
+    if not keys:
+        return {"success": False, "error": "Nothing to subscribe to."}
+    for key in keys:
+        SUBSCRIPTIONS.setdefault(key, set()).add(websocket)
+    CLIENT_SUBSCRIPTIONS.setdefault(websocket, set()).update(keys)
+    return {"success": True, "subscriptions": sorted(CLIENT_SUBSCRIPTIONS[websocket])}
+
+async def handle_unsubscribe(websocket, payload):
+    # no peers/conversations --> drop every subscription of this connection
+    keys = subscription_keys(payload) or set(CLIENT_SUBSCRIPTIONS.get(websocket, ()))
+    remove_subscriptions(websocket, keys)
+    return {"success": True, "subscriptions": sorted(CLIENT_SUBSCRIPTIONS.get(websocket, ()))}
+
+def remove_subscriptions(websocket, keys):
+    for key in keys:
+        subscribers = SUBSCRIPTIONS.get(key)
+        if subscribers is not None:
+            subscribers.discard(websocket)
+            if not subscribers:
+                del SUBSCRIPTIONS[key]
+    remaining = CLIENT_SUBSCRIPTIONS.get(websocket)
+    if remaining is not None:
+        remaining.difference_update(keys)
+        if not remaining:
+            del CLIENT_SUBSCRIPTIONS[websocket]
+
 #WebSocket Server Logic --> finally runs: 9/6/25
-async def broadcast(message):
-    #sends a message to all clients.
-    if CONNECTED_CLIENTS:
-        tasks = [client.send(message) for client in CONNECTED_CLIENTS]
-        await asyncio.gather(*tasks)
+def event_targets(event):
+    """connections subscribed to the sender, the recipient or their conversation + the conversation key"""
+    data = event.get("data", {})
+    sender, recipient = data.get("from"), data.get("to")
+    keys = [sender, recipient]
+    conversation = None
+    if sender and recipient:
+        conversation = conversation_key(sender, recipient)
+        keys.append(conversation)
+    targets = set()
+    for key in keys:
+        targets.update(SUBSCRIPTIONS.get(key, ()))
+    return targets, conversation
 
 async def event_handler(event):
     """Callback for events from the P2P engine."""
     print(f"P2P Engine Event: {event}")
-    await broadcast(json.dumps(event))
+    targets, conversation = event_targets(event)
+    if targets:
+        # serialized once per sub-protocol, queued per client --> never waits on a socket
+        frames = {}
+        for client in targets:
+            outbox = OUTBOXES.get(client)
+            if outbox is not None:
+                protocol = client.subprotocol
+                if protocol not in frames:
+                    frames[protocol] = encode_frame(event, protocol)
+                outbox.put(frames[protocol], conversation)
+
+# action --> handler, every handler takes the payload dict and returns the response data
+HANDLERS = {
+    "create_peer": handle_create_peer,
+    "connect_peers": handle_connect_peers,
+    "send_message": handle_send_message,
+    "send_messages": handle_send_messages,
+    "send_file": handle_send_file,
+    "get_file": handle_get_file,
+    "get_peer_card": handle_get_peer_card,
+    "connect_remote": handle_connect_remote,
+    "get_history": handle_get_history,
+    "stats": handle_stats,
+    "shutdown": handle_shutdown,
+}
+# handlers that act on the calling connection, called with (websocket, payload)
+CONNECTION_HANDLERS = {
+    "subscribe": handle_subscribe,
+    "unsubscribe": handle_unsubscribe,
+}
+# requests of one connection handled at the same time, reading pauses once this many are in flight
+MAX_INFLIGHT_PER_CONNECTION = 32
+
+async def dispatch(websocket, data, inflight):
+    """run one request and send its response (tagged with the client's request_id, if any)"""
+    action = data.get("action")
+    request_id = data.get("request_id")
+    try:
+        payload = data.get("payload") or {}
+        try:
+            if SHARDS is not None and action in SHARD_ROUTED_ACTIONS:
+                response = await SHARDS.forward(action, payload, payload.get(SHARD_ROUTED_ACTIONS[action]) or "")
+            elif action in HANDLERS:
+                response = await HANDLERS[action](payload)
+            elif action in CONNECTION_HANDLERS:
+                response = await CONNECTION_HANDLERS[action](websocket, payload)
+            else:
+                response = {"success": False, "error": "Unknown action"}
+        except Exception as e:
+            response = {"success": False, "error": str(e)}
+        reply = {"type": "response", "action": action, "data": response}
+        if request_id is not None:
+            reply["request_id"] = request_id
+        await websocket.send(encode_frame(reply, websocket.subprotocol))
+    except websockets.ConnectionClosed:
+        pass
+    finally:
+        inflight.release()
 
 async def handler(websocket, path):
     #main WebSocket connection handler
     CONNECTED_CLIENTS.add(websocket)
-    print(f"Client connected. Total clients: {len(CONNECTED_CLIENTS)}")
+    protocol = websocket.subprotocol
+    OUTBOXES[websocket] = ClientOutbox(
+        websocket, OUTBOX_MAX_QUEUE, OUTBOX_POLICY, lambda frame: encode_frame(frame, protocol)
+    )
+    print(f"Client connected ({protocol or 'json'}). Total clients: {len(CONNECTED_CLIENTS)}")
     
     #network event handler to async broadcast function --> final implementation: 7/6/25
     NETWORK.set_event_handler(event_handler)
 
+    # requests run concurrently and may answer out of order, clients match them by request_id
+    inflight = asyncio.Semaphore(MAX_INFLIGHT_PER_CONNECTION)
+    pending = set()
     try:
         async for message in websocket:
             try:
-                data = json.loads(message)
-                action = data.get("action")
-                payload = data.get("payload", {})
-                
-                response = {"success": False, "error": "Unknown action"}
-
-                if action == "create_peer":
-                    response = await handle_create_peer(payload)
-                elif action == "connect_peers":
-                    response = await handle_connect_peers(payload)
-                elif action == "send_message":
-                    response = await handle_send_message(payload)
-                elif action == "get_history":
-                    response = await handle_get_history(payload)
-                elif action == "shutdown":
-                    response = await handle_shutdown(payload)
-                # send response backto client (requests)
-                await websocket.send(json.dumps({"type": "response", "action": action, "data": response}))
-
-            except json.JSONDecodeError:
-                await websocket.send(json.dumps({"success": False, "error": "Invalid JSON"}))
-            except Exception as e:
-                await websocket.send(json.dumps({"success": False, "error": str(e)}))
+                data = decode_frame(message)
+            except ValueError as e:
+                await websocket.send(encode_frame({"success": False, "error": str(e)}, protocol))
+                continue
+            await inflight.acquire()
+            task = asyncio.create_task(dispatch(websocket, data, inflight))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
     finally:
         CONNECTED_CLIENTS.remove(websocket)
+        OUTBOXES.pop(websocket).close()
+        remove_subscriptions(websocket, set(CLIENT_SUBSCRIPTIONS.get(websocket, ())))
+        for task in pending:
+            task.cancel()
         print(f"Client disconnected. Total clients: {len(CONNECTED_CLIENTS)}")
 
+async def retention_task():
+    """periodically expire old messages, the store work runs off the event loop"""
+    while not SHUTDOWN_EVENT.is_set():
+        try:
+            await asyncio.wait_for(SHUTDOWN_EVENT.wait(), timeout=RETENTION_INTERVAL_SECONDS)
+            break
+        except asyncio.TimeoutError:
+            pass
+        try:
+            if SHARDS is not None:
+                await SHARDS.expire_messages(RETENTION_DAYS)
+                continue
+            removed = await asyncio.to_thread(NETWORK.expire_messages, RETENTION_DAYS)
+            if removed:
+                NETWORK.invalidate_history()
+        except Exception as e:
+            print(f"Retention pass failed: {e}")
+
+async def start_server(host, port):
+    # msgpack for clients that ask for it, plain JSON for everyone else (the browser frontend)
+    extensions = []
+    if DEFLATE_ENABLED:
+        extensions.append(ServerPerMessageDeflateFactory(
+            server_max_window_bits=DEFLATE_MAX_WINDOW_BITS,
+            client_max_window_bits=DEFLATE_MAX_WINDOW_BITS,
+            compress_settings={"level": DEFLATE_LEVEL, "memLevel": DEFLATE_MEM_LEVEL},
+        ))
+    return await websockets.serve(
+        handler, host, port,
+        subprotocols=SUBPROTOCOLS,
+        extensions=extensions,
+        compression=None,
+        max_size=MAX_FRAME_SIZE,
+    )
+
 async def main():
+    global SHARDS
     # reset old data
     if os.path.exists("keys"): shutil.rmtree("keys")
     if os.path.exists("encrypted"): shutil.rmtree("encrypted")
     os.makedirs("keys", exist_ok=True)
+    reset_keyrings()
     os.makedirs("encrypted", exist_ok=True)
     port = 8765
-    server = await websockets.serve(handler, "localhost", port)
+    if SHARD_COUNT > 0:
+        SHARDS = ShardedNetwork(SHARD_COUNT, transport=PEER_TRANSPORT)
+        SHARDS.set_event_handler(event_handler)
+        await SHARDS.start()
+    server = await start_server("localhost", port)
     print(f"WebSocket server started on ws://localhost:{port}")
+    retention = asyncio.create_task(retention_task())
     await SHUTDOWN_EVENT.wait()
+    retention.cancel()
     server.close()
     await server.wait_closed()
+    if SHARDS is not None:
+        await SHARDS.close()
+    await NETWORK.close_transports()
     print("WebSocket server has shut down.")
 
 if __name__ == "__main__":
@@ -0,0 +1,109 @@
+# mesh_routing.py
+# overlay routing for P2PNetworkSimulator --> peers that aren't directly connected reach each
+# other through relays along a shortest path of the link graph.
+#
+# routes are kept per destination: one BFS from the destination gives every peer's distance and
+# next hop towards it, so forwarding is one dict lookup per hop. trees are computed on first use,
+# cached (LRU) and patched in place when connect_peers adds a link instead of being recomputed.
+from collections import OrderedDict, deque
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+
+class RoutingTable:
+    """link graph + cached shortest-path next hops (unweighted, hop count)"""
+
+    def __init__(self, max_destinations: int = 4096):
+        self.max_destinations = max_destinations
+        self.links: Dict[str, Set[str]] = {}
+        # destination --> (hops to destination, next hop towards destination) per reachable peer
+        self._trees: "OrderedDict[str, Tuple[Dict[str, int], Dict[str, str]]]" = OrderedDict()
+        # metrics
+        self.hits = 0
+        self.misses = 0
+        self.updates = 0
+
+    def add_peer(self, peer: str):
+        self.links.setdefault(peer, set())
+
+    def linked(self, peer_a: str, peer_b: str) -> bool:
+        return peer_b in self.links.get(peer_a, ())
+
+    def add_link(self, peer_a: str, peer_b: str):
+        """add an undirected link and patch every cached tree it shortens"""
+        if peer_a == peer_b or self.linked(peer_a, peer_b):
+            return
+        self.links.setdefault(peer_a, set()).add(peer_b)
+        self.links.setdefault(peer_b, set()).add(peer_a)
+        for distances, next_hops in self._trees.values():
+            self._relax(distances, next_hops, peer_a, peer_b)
+            self._relax(distances, next_hops, peer_b, peer_a)
+
+    def _relax(self, distances: Dict[str, int], next_hops: Dict[str, str], via: str, peer: str):
+        # a new link only ever shortens paths: re-run BFS from the peer that got closer, and
+        # only as far as distances actually improve
+        if via not in distances or distances[via] + 1 >= distances.get(peer, float("inf")):
+            return
+        self.updates += 1
+        distances[peer] = distances[via] + 1
+        next_hops[peer] = via
+        queue = deque([peer])
+        while queue:
+            current = queue.popleft()
+            hops = distances[current] + 1
+            for neighbour in self.links[current]:
+                if hops < distances.get(neighbour, float("inf")):
+                    distances[neighbour] = hops
+                    next_hops[neighbour] = current
+                    queue.append(neighbour)
+
+    def _tree(self, destination: str) -> Tuple[Dict[str, int], Dict[str, str]]:
+        tree = self._trees.get(destination)
+        if tree is not None:
+            self._trees.move_to_end(destination)
+            self.hits += 1
+            return tree
+        self.misses += 1
+        distances = {destination: 0}
+        next_hops: Dict[str, str] = {}
+        queue = deque([destination])
+        while queue:
+            current = queue.popleft()
+            hops = distances[current] + 1
+            for neighbour in self.links.get(current, ()):
+                if neighbour not in distances:
+                    distances[neighbour] = hops
+                    next_hops[neighbour] = current
+                    queue.append(neighbour)
+        tree = self._trees[destination] = (distances, next_hops)
+        while len(self._trees) > self.max_destinations:
+            self._trees.popitem(last=False)
+        return tree
+
+    def next_hop(self, peer: str, destination: str) -> Optional[str]:
+        """neighbour of peer to forward a packet for destination to, None if unreachable"""
+        return self._tree(destination)[1].get(peer)
+
+    def path(self, source: str, destination: str) -> Optional[List[str]]:
+        """[source, relays..., destination], None if unreachable"""
+        if source == destination:
+            return [source]
+        _distances, next_hops = self._tree(destination)
+        if source not in next_hops:
+            return None
+        path = [source]
+        while path[-1] != destination:
+            path.append(next_hops[path[-1]])
+        return path
+
+    def invalidate(self):
+        self._trees.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "peers": len(self.links),
+            "links": sum(len(neighbours) for neighbours in self.links.values()) // 2,
+            "cached_destinations": len(self._trees),
+            "hits": self.hits,
+            "misses": self.misses,
+            "incremental_updates": self.updates,
+        }
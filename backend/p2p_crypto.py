@@ -1,24 +1,180 @@
 import os
+import time
 import base64
 import json
+import struct
+import threading
 from datetime import datetime
-from typing import Tuple, Optional, Dict, Any
+from typing import Tuple, Optional, Dict, Any, Union, List, Sequence, Callable, Iterable, Iterator, AsyncIterable, AsyncIterator, BinaryIO
+from concurrent.futures import ThreadPoolExecutor
 import nacl.secret
 import nacl.public
 import nacl.utils
+import nacl.bindings
 from nacl.public import PrivateKey, PublicKey, Box
 from nacl.secret import SecretBox
-from nacl.encoding import Base64Encoder
+from nacl.encoding import Base64Encoder, RawEncoder
 from nacl.hash import blake2b
 from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
 from datetime import datetime, timezone
+from p2p_packet import decode_packet, is_encoded_packet
+
+NONCE_SIZE = 24
+ALGORITHM = "XChaCha20-Poly1305"
+# batches smaller than this stay on the calling thread, thread hand-off costs more than it saves
+PARALLEL_BATCH_THRESHOLD = 256
+
+# streamed file encryption, header = magic | version | chunk size, then length-prefixed frames
+#   v1: secretstream header after the header, one frame per chunk, the last one carries TAG_FINAL
+#       (still read, no longer written)
+#   v2: a key frame (nonce | the chunk keys sealed with the session's file key), then one frame
+#       per chunk sealed with its own key = keyed BLAKE2b of the chunk's plaintext. the same chunk
+#       always encrypts to the same frame, so the chunk store keeps it once whoever it went to.
+FILE_STREAM_MAGIC = b"P2F"
+FILE_STREAM_VERSION = 2
+FILE_CHUNK_SIZE = 64 * 1024
+FILE_STREAM_HEADER = struct.Struct(">3sBI")
+FILE_FRAME_HEADER = struct.Struct(">I")
+_SS_HEADERBYTES = nacl.bindings.crypto_secretstream_xchacha20poly1305_HEADERBYTES
+_SS_ABYTES = nacl.bindings.crypto_secretstream_xchacha20poly1305_ABYTES
+_SS_TAG_MESSAGE = nacl.bindings.crypto_secretstream_xchacha20poly1305_TAG_MESSAGE
+_SS_TAG_FINAL = nacl.bindings.crypto_secretstream_xchacha20poly1305_TAG_FINAL
+# v2 chunk keys are only ever used for one plaintext, so a fixed nonce is safe
+_CHUNK_KEY_SIZE = 32
+_CHUNK_NONCE = bytes(NONCE_SIZE)
+# node-wide secret the chunk keys are derived with (kept next to the keystore)
+CONVERGENCE_KEY_FILE = "convergence.key"
+
+KEYSTORE_FILE = "keystore.jsonl"
+
+class KeyRing:
+    """process-wide identity cache backed by one append-only keystore file per keys dir
+
+    every identity is read from disk once, its PrivateKey object and base64 public key
+    stay cached. a later line for the same peer replaces the earlier one (key rotation).
+    """
+    def __init__(self, keys_dir: str = "keys"):
+        self.keys_dir = keys_dir
+        self.keystore_path = os.path.join(keys_dir, KEYSTORE_FILE)
+        self._lock = threading.RLock()
+        self._private_keys: Dict[str, str] = {}
+        self._key_objects: Dict[str, PrivateKey] = {}
+        self._public_keys: Dict[str, str] = {}
+        self.load()
+
+    def load(self):
+        """(re)read the keystore file into memory"""
+        with self._lock:
+            self._private_keys.clear()
+            self._key_objects.clear()
+            self._public_keys.clear()
+            if not os.path.exists(self.keystore_path):
+                return
+            with open(self.keystore_path, 'r') as f:
+                for line in f:
+                    try:
+                        key_data = json.loads(line)
+                        self._cache(key_data["peer_name"], key_data["private_key"])
+                    except Exception:
+                        # torn last line after a crash, everything before it is intact
+                        continue
+
+    def _cache(self, peer_name: str, private_key_b64: str) -> PrivateKey:
+        private_key = PrivateKey(base64.b64decode(private_key_b64))
+        self._private_keys[peer_name] = private_key_b64
+        self._key_objects[peer_name] = private_key
+        self._public_keys[peer_name] = base64.b64encode(private_key.public_key.encode()).decode('utf-8')
+        return private_key
+
+    def add(self, peer_name: str, private_key_b64: str):
+        """append an identity to the keystore and cache it"""
+        with self._lock:
+            key_data = {
+                "peer_name": peer_name,
+                "private_key": private_key_b64,
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "key_type": "ECDH_X25519"
+            }
+            os.makedirs(self.keys_dir, exist_ok=True)
+            with open(self.keystore_path, 'a') as f:
+                f.write(json.dumps(key_data) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._cache(peer_name, private_key_b64)
+
+    def get_private_key(self, peer_name: str) -> Optional[str]:
+        with self._lock:
+            if peer_name not in self._private_keys:
+                self._migrate_legacy_key(peer_name)
+            return self._private_keys.get(peer_name)
+
+    def get_private_key_object(self, peer_name: str) -> Optional[PrivateKey]:
+        with self._lock:
+            if peer_name not in self._key_objects:
+                self._migrate_legacy_key(peer_name)
+            return self._key_objects.get(peer_name)
+
+    def get_public_key(self, peer_name: str) -> Optional[str]:
+        with self._lock:
+            if peer_name not in self._public_keys:
+                self._migrate_legacy_key(peer_name)
+            return self._public_keys.get(peer_name)
+
+    def get_or_create(self, peer_name: str) -> Tuple[str, str]:
+        """(private_key_b64, public_key_b64), generating the identity on first use"""
+        with self._lock:
+            private_key_b64 = self.get_private_key(peer_name)
+            if private_key_b64 is None:
+                private_key = PrivateKey.generate()
+                private_key_b64 = base64.b64encode(private_key.encode()).decode('utf-8')
+                self.add(peer_name, private_key_b64)
+                print(f"Private key saved for {peer_name}: {self.keystore_path}")
+            return private_key_b64, self._public_keys[peer_name]
+
+    def _migrate_legacy_key(self, peer_name: str):
+        """pick up an old keys/<peer>_private.key file once and move it into the keystore"""
+        key_file = os.path.join(self.keys_dir, f"{peer_name}_private.key")
+        if not os.path.exists(key_file):
+            return
+        try:
+            with open(key_file, 'r') as f:
+                key_data = json.load(f)
+            self.add(peer_name, key_data["private_key"])
+        except Exception as e:
+            print(f"Error loading private key --> {peer_name}: {e}")
+
+_KEYRINGS: Dict[str, KeyRing] = {}
+_CRYPTO_MANAGERS: Dict[str, "CryptoManager"] = {}
+_REGISTRY_LOCK = threading.Lock()
+
+def get_keyring(keys_dir: str = "keys") -> KeyRing:
+    """shared KeyRing for a keys dir, loaded from disk only the first time"""
+    path = os.path.abspath(keys_dir)
+    with _REGISTRY_LOCK:
+        keyring = _KEYRINGS.get(path)
+        if keyring is None:
+            keyring = _KEYRINGS[path] = KeyRing(keys_dir)
+        return keyring
+
+def reset_keyrings():
+    """forget cached identities, e.g. after the keys dir was wiped"""
+    with _REGISTRY_LOCK:
+        _KEYRINGS.clear()
 
 class CryptoManager:
     #XChaCha20= encryption+decryption,Poly1305=ECDH key exchange & generation & storage
     
     def __init__(self, keys_dir: str = "keys"):
         self.keys_dir = keys_dir
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_workers = 0
+        self._convergence_secret: Optional[bytes] = None
         self.ensure_keys_directory()
+
+    @property
+    def keyring(self) -> KeyRing:
+        # looked up per access so reset_keyrings() is honoured by long-lived managers
+        return get_keyring(self.keys_dir)
         
     def ensure_keys_directory(self):
         #creating keys directory --> for storing per keys.
@@ -40,36 +196,27 @@ class CryptoManager:
         return private_key_b64, public_key_b64
     
     def save_private_key(self, peer_name: str, private_key_b64: str):
-        #saving private key to keys/ directory
-        key_file = os.path.join(self.keys_dir, f"{peer_name}_private.key")
-        key_data = {
-            "peer_name": peer_name,
-            "private_key": private_key_b64,
-            "created_at": datetime.now(timezone.utc).isoformat(),
-            "key_type": "ECDH_X25519"
-        }
-        with open(key_file, 'w') as f:
-            json.dump(key_data, f, indent=2)
-        print(f"Private key saved for {peer_name}: {key_file}")
+        #saving private key to the keystore in keys/ directory
+        self.keyring.add(peer_name, private_key_b64)
+        print(f"Private key saved for {peer_name}: {self.keyring.keystore_path}")
     
     def load_private_key(self, peer_name: str) -> Optional[str]:
-        #will load private key from keys dir --> solved on 8/6/25.
-        key_file = os.path.join(self.keys_dir, f"{peer_name}_private.key")
-        if not os.path.exists(key_file):
-            return None 
-        try:
-            with open(key_file, 'r') as f:
-                key_data = json.load(f)
-            return key_data["private_key"]
-        except Exception as e:
-            print(f"Error loading private key --> {peer_name}: {e}")
-            return None
+        #will load private key from keys dir --> served from the in-memory keyring after the first read.
+        return self.keyring.get_private_key(peer_name)
+
+    def get_identity(self, peer_name: str) -> Tuple[PrivateKey, str]:
+        """cached (PrivateKey, public_key_b64) for a peer, generated on first use"""
+        _private_key_b64, public_key_b64 = self.keyring.get_or_create(peer_name)
+        private_key = self.keyring.get_private_key_object(peer_name)
+        assert private_key is not None
+        return private_key, public_key_b64
     
-    def derive_shared_secret(self, my_private_key_b64: str, peer_public_key_b64: str) -> bytes:
+    def derive_shared_secret(self, my_private_key: Union[str, PrivateKey], peer_public_key_b64: str) -> bytes:
         """shared secret using ECDH"""
         try:
-            # decoding Base64 keys
-            my_private_key = PrivateKey(base64.b64decode(my_private_key_b64))
+            # decoding Base64 keys (already decoded PrivateKey objects are used as-is)
+            if not isinstance(my_private_key, PrivateKey):
+                my_private_key = PrivateKey(base64.b64decode(my_private_key))
             peer_public_key = PublicKey(base64.b64decode(peer_public_key_b64))
             # boxing for ECDH
             box = Box(my_private_key, peer_public_key)
@@ -79,41 +226,222 @@ class CryptoManager:
         except Exception as e:
             raise Exception(f"Failed to derive shared secret keys: {e}")
     
-    def encrypt_message(self, message: str, shared_secret: bytes) -> Dict[str, Any]:
-        """encryptinng message using XChaCha20-Poly1305"""
+    def create_cipher(self, shared_secret: bytes) -> SecretBox:
+        """build a reusable cipher for a shared secret (see P2PSession.cipher)"""
+        return nacl.secret.SecretBox(shared_secret)
+
+    def encrypt_message(
+            self,
+            message: str,
+            shared_secret: bytes,
+            cipher: Optional[SecretBox] = None,
+            binary: bool = False) -> Dict[str, Any]:
+        """encryptinng message using XChaCha20-Poly1305
+
+        binary=True keeps nonce/ciphertext as raw bytes and the timestamp as integer
+        microseconds, ready for p2p_packet.encode_packet.
+        """
         try:
             # random nonce (24 bytes for XChaCha20)
             nonce = nacl.utils.random(24)
-            # secretBoxy with shared secret
-            box = nacl.secret.SecretBox(shared_secret)
+            # secretBoxy with shared secret, unless caller already holds one
+            box = cipher if cipher is not None else nacl.secret.SecretBox(shared_secret)
             # eencrypt message
             message_bytes = message.encode('utf-8')
             encrypted = box.encrypt(message_bytes, nonce)
             # extract ciphertext
-            ciphertext = encrypted.ciphertext
-            return {
-                "ciphertext": base64.b64encode(ciphertext).decode('utf-8'),
-                "nonce": base64.b64encode(nonce).decode('utf-8'),
-                "timestamp": datetime.now(timezone.utc).isoformat(),
-                "algorithm": "XChaCha20-Poly1305"
-            }
+            return self._encrypted_fields(encrypted.ciphertext, nonce, binary)
         except Exception as e:
             raise Exception(f"Encryption failed: {e}")
+
+    def _encrypted_fields(self, ciphertext: bytes, nonce: bytes, binary: bool) -> Dict[str, Any]:
+        """encrypted_data dict in either raw (binary packet) or base64 (JSON) form"""
+        if binary:
+            return {
+                "ciphertext": ciphertext,
+                "nonce": nonce,
+                "timestamp": time.time_ns() // 1000,
+                "algorithm": ALGORITHM
+            }
+        return {
+            "ciphertext": base64.b64encode(ciphertext).decode('utf-8'),
+            "nonce": base64.b64encode(nonce).decode('utf-8'),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "algorithm": ALGORITHM
+        }
     
-    def decrypt_message(self, encrypted_data: Dict[str, Any], shared_secret: bytes) -> str:
+    def decrypt_message(self, encrypted_data: Dict[str, Any], shared_secret: bytes, cipher: Optional[SecretBox] = None) -> str:
         """decrypting de message using XChaCha20-Poly1305"""
         try:
-            # decode Base64 data
-            ciphertext = base64.b64decode(encrypted_data["ciphertext"])
-            nonce = base64.b64decode(encrypted_data["nonce"])
-            # create SecretBox with shared secret
-            box = nacl.secret.SecretBox(shared_secret)
+            # decode Base64 data (binary packets already carry raw bytes)
+            ciphertext = _field_bytes(encrypted_data["ciphertext"])
+            nonce = _field_bytes(encrypted_data["nonce"])
+            # create SecretBox with shared secret, unless caller already holds one
+            box = cipher if cipher is not None else nacl.secret.SecretBox(shared_secret)
             # decrypt message
             decrypted = box.decrypt(ciphertext, nonce)
             return decrypted.decode('utf-8')
         except Exception as e:
             raise Exception(f"Decryption failed: {e}")
     
+    def encrypt_many(
+            self,
+            messages: Sequence[str],
+            shared_secret: bytes,
+            cipher: Optional[SecretBox] = None,
+            max_workers: int = 0,
+            binary: bool = False) -> Tuple[List[Optional[Dict[str, Any]]], Dict[int, str]]:
+        """encrypting a batch of messages, returns (results, {index: error}) instead of raising"""
+        box = cipher if cipher is not None else nacl.secret.SecretBox(shared_secret)
+        # one RNG call for every nonce in the batch, sliced out of a single buffer
+        nonces = memoryview(nacl.utils.random(NONCE_SIZE * len(messages)))
+
+        def work(start: int, end: int):
+            results: List[Optional[Dict[str, Any]]] = []
+            errors: Dict[int, str] = {}
+            fields = self._encrypted_fields
+            for i in range(start, end):
+                try:
+                    nonce = nonces[i * NONCE_SIZE:(i + 1) * NONCE_SIZE].tobytes()
+                    encrypted = box.encrypt(messages[i].encode('utf-8'), nonce)
+                    results.append(fields(encrypted.ciphertext, nonce, binary))
+                except Exception as e:
+                    results.append(None)
+                    errors[i] = f"Encryption failed: {e}"
+            return results, errors
+
+        return self._run_batch(work, len(messages), max_workers)
+
+    def decrypt_many(
+            self,
+            encrypted_items: Sequence[Dict[str, Any]],
+            shared_secret: bytes,
+            cipher: Optional[SecretBox] = None,
+            max_workers: int = 0) -> Tuple[List[Optional[str]], Dict[int, str]]:
+        """decrypting a batch of encrypted_data dicts, returns (plaintexts, {index: error})"""
+        box = cipher if cipher is not None else nacl.secret.SecretBox(shared_secret)
+        count = len(encrypted_items)
+        # decode every field in one pass before touching the cipher
+        decoded: List[Optional[Tuple[bytes, bytes]]] = [None] * count
+        decode_errors: Dict[int, str] = {}
+        for i, item in enumerate(encrypted_items):
+            try:
+                decoded[i] = (_field_bytes(item["ciphertext"]), _field_bytes(item["nonce"]))
+            except Exception as e:
+                decode_errors[i] = f"Decryption failed: {e}"
+
+        def work(start: int, end: int):
+            results: List[Optional[str]] = []
+            errors: Dict[int, str] = {}
+            for i in range(start, end):
+                fields = decoded[i]
+                if fields is None:
+                    results.append(None)
+                    continue
+                try:
+                    results.append(box.decrypt(fields[0], fields[1]).decode('utf-8'))
+                except Exception as e:
+                    results.append(None)
+                    errors[i] = f"Decryption failed: {e}"
+            return results, errors
+
+        results, errors = self._run_batch(work, count, max_workers)
+        errors.update(decode_errors)
+        return results, errors
+
+    def _run_batch(self, work: Callable[[int, int], Tuple[List[Any], Dict[int, str]]], count: int, max_workers: int):
+        """run work(start, end) over the whole batch, split into slices on a thread pool if worth it"""
+        if max_workers <= 1 or count < PARALLEL_BATCH_THRESHOLD:
+            return work(0, count)
+        # libsodium releases the GIL, so slices really do run in parallel
+        if self._executor is None or self._executor_workers != max_workers:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="crypto-batch")
+            self._executor_workers = max_workers
+        step = max(PARALLEL_BATCH_THRESHOLD // 2, -(-count // max_workers))
+        futures = [self._executor.submit(work, start, min(start + step, count)) for start in range(0, count, step)]
+        results: List[Any] = []
+        errors: Dict[int, str] = {}
+        for future in futures:
+            part_results, part_errors = future.result()
+            results.extend(part_results)
+            errors.update(part_errors)
+        return results, errors
+
+    def derive_file_key(self, shared_secret: bytes) -> bytes:
+        """separate key for file streams so message and file ciphertexts never share a key"""
+        return blake2b(b"p2p-file-stream-v1", key=shared_secret, digest_size=32, encoder=RawEncoder)
+
+    @property
+    def convergence_secret(self) -> bytes:
+        """secret the file chunk keys are derived with, created on first use
+
+        equal chunks only encrypt to equal bytes under the same secret, and without it nobody
+        can confirm a guessed file from the stored chunks.
+        """
+        if self._convergence_secret is None:
+            path = os.path.join(self.keys_dir, CONVERGENCE_KEY_FILE)
+            if not os.path.exists(path):
+                # written aside and linked in --> concurrent processes agree on one secret
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(nacl.utils.random(_CHUNK_KEY_SIZE))
+                try:
+                    os.link(tmp_path, path)
+                except FileExistsError:
+                    pass
+                finally:
+                    os.remove(tmp_path)
+            with open(path, 'rb') as f:
+                self._convergence_secret = f.read()
+        return self._convergence_secret
+
+    def encrypt_stream(self, chunks: Iterable[bytes], shared_secret: bytes, chunk_size: int = FILE_CHUNK_SIZE) -> Iterator[bytes]:
+        """streamed file encryption, yields the header + key frame and then one frame per chunk
+
+        the chunk keys go first, so chunks is read twice (keys, then frames). pass something
+        re-iterable (a list, file_chunks()), a one-shot iterator is buffered in memory.
+        """
+        if iter(chunks) is chunks:
+            chunks = list(chunks)
+        encryptor = FileStreamEncryptor(self.derive_file_key(shared_secret), self.convergence_secret, chunk_size)
+        keys = [encryptor.chunk_key(chunk) for chunk in _rechunk(chunks, chunk_size)]
+        yield encryptor.header(keys)
+        count = 0
+        for chunk in _rechunk(chunks, chunk_size):
+            key = encryptor.chunk_key(chunk)
+            if count >= len(keys) or key != keys[count]:
+                raise Exception("File changed while it was encrypted")
+            yield encryptor.push(chunk, key)
+            count += 1
+        if count != len(keys):
+            raise Exception("File changed while it was encrypted")
+
+    def decrypt_stream(self, blocks: Iterable[bytes], shared_secret: bytes) -> Iterator[bytes]:
+        """streamed file decryption from arbitrary byte blocks, yields plaintext chunks"""
+        decryptor = FileStreamDecryptor(self.derive_file_key(shared_secret))
+        for block in blocks:
+            yield from decryptor.feed(block)
+        decryptor.close()
+
+    async def encrypt_stream_async(self, chunks: AsyncIterable[bytes], shared_secret: bytes, chunk_size: int = FILE_CHUNK_SIZE) -> AsyncIterator[bytes]:
+        """async-iterator version of encrypt_stream (e.g. chunks arriving from a socket)
+
+        the input can only be read once, so it is buffered: the chunk keys go before the frames.
+        """
+        buffered = [data async for data in chunks]
+        for frame in self.encrypt_stream(buffered, shared_secret, chunk_size):
+            yield frame
+
+    async def decrypt_stream_async(self, blocks: AsyncIterable[bytes], shared_secret: bytes) -> AsyncIterator[bytes]:
+        """async-iterator version of decrypt_stream"""
+        decryptor = FileStreamDecryptor(self.derive_file_key(shared_secret))
+        async for block in blocks:
+            for chunk in decryptor.feed(block):
+                yield chunk
+        decryptor.close()
+
     def hash_data(self, data: str) -> str:
         """creating Blake2b hash of data"""
         hash_bytes = blake2b(data.encode('utf-8'), digest_size=32)
@@ -126,6 +454,150 @@ class CryptoManager:
             return calculated_hash == hash_b64
         except:
             return False
+class FileStreamEncryptor:
+    """convergent per-chunk XChaCha20-Poly1305: a chunk's key is the keyed BLAKE2b of its plaintext,
+    the list of chunk keys travels sealed with the session's file key"""
+    def __init__(self, key: bytes, convergence_secret: bytes, chunk_size: int = FILE_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self._key = key
+        self._convergence_secret = convergence_secret
+
+    def chunk_key(self, chunk: bytes) -> bytes:
+        return blake2b(bytes(chunk), key=self._convergence_secret, digest_size=_CHUNK_KEY_SIZE,
+                       person=b"p2p-chunk-key", encoder=RawEncoder)
+
+    def header(self, keys: List[bytes]) -> bytes:
+        """stream header + key frame (fresh nonce, so this part differs per send)"""
+        header = FILE_STREAM_HEADER.pack(FILE_STREAM_MAGIC, FILE_STREAM_VERSION, self.chunk_size)
+        nonce = nacl.utils.random(NONCE_SIZE)
+        sealed = nacl.bindings.crypto_aead_xchacha20poly1305_ietf_encrypt(b"".join(keys), header, nonce, self._key)
+        return header + FILE_FRAME_HEADER.pack(NONCE_SIZE + len(sealed)) + nonce + sealed
+
+    def push(self, chunk: bytes, key: bytes) -> bytes:
+        """encrypt one chunk into a length-prefixed frame, deterministic for equal chunks"""
+        ciphertext = nacl.bindings.crypto_aead_xchacha20poly1305_ietf_encrypt(bytes(chunk), None, _CHUNK_NONCE, key)
+        return FILE_FRAME_HEADER.pack(len(ciphertext)) + ciphertext
+
+class FileStreamDecryptor:
+    """counterpart of FileStreamEncryptor (and of the v1 secretstream format), fed arbitrary
+    byte blocks and yields plaintext chunks"""
+    def __init__(self, key: bytes):
+        self._key = key
+        self._version: Optional[int] = None
+        self._header = b""
+        # v1: secretstream state, v2: chunk keys from the key frame + index of the next chunk
+        self._state = None
+        self._chunk_keys: Optional[List[bytes]] = None
+        self._next = 0
+        self._buffer = bytearray()
+        self.finished = False
+
+    def feed(self, data: bytes) -> Iterator[bytes]:
+        """consume raw stream bytes, yield every plaintext chunk completed so far"""
+        self._buffer += data
+        if self._version is None and not self._read_header():
+            return
+        # buffer never holds more than one partial frame
+        while len(self._buffer) >= FILE_FRAME_HEADER.size:
+            (frame_len,) = FILE_FRAME_HEADER.unpack_from(self._buffer)
+            end = FILE_FRAME_HEADER.size + frame_len
+            if len(self._buffer) < end:
+                return
+            frame = bytes(self._buffer[FILE_FRAME_HEADER.size:end])
+            del self._buffer[:end]
+            chunk = self._open(frame)
+            if chunk is not None:
+                yield chunk
+
+    def _read_header(self) -> bool:
+        if len(self._buffer) < FILE_STREAM_HEADER.size:
+            return False
+        magic, version, _chunk_size = FILE_STREAM_HEADER.unpack_from(self._buffer)
+        if magic != FILE_STREAM_MAGIC or version not in (1, FILE_STREAM_VERSION):
+            raise Exception("Decryption failed: not a file stream")
+        header_size = FILE_STREAM_HEADER.size + (_SS_HEADERBYTES if version == 1 else 0)
+        if len(self._buffer) < header_size:
+            return False
+        if version == 1:
+            self._state = nacl.bindings.crypto_secretstream_xchacha20poly1305_state()
+            nacl.bindings.crypto_secretstream_xchacha20poly1305_init_pull(
+                self._state, bytes(self._buffer[FILE_STREAM_HEADER.size:header_size]), self._key
+            )
+        self._header = bytes(self._buffer[:FILE_STREAM_HEADER.size])
+        self._version = version
+        del self._buffer[:header_size]
+        return True
+
+    def _open(self, frame: bytes) -> Optional[bytes]:
+        """decrypt one frame, None for the v2 key frame"""
+        if self.finished:
+            raise Exception("Decryption failed: data after final chunk")
+        try:
+            if self._version == 1:
+                chunk, tag = nacl.bindings.crypto_secretstream_xchacha20poly1305_pull(self._state, frame, None)
+                self.finished = tag == _SS_TAG_FINAL
+                return chunk
+            if self._chunk_keys is None:
+                keys = nacl.bindings.crypto_aead_xchacha20poly1305_ietf_decrypt(
+                    frame[NONCE_SIZE:], self._header, frame[:NONCE_SIZE], self._key
+                )
+                self._chunk_keys = [keys[i:i + _CHUNK_KEY_SIZE] for i in range(0, len(keys), _CHUNK_KEY_SIZE)]
+                self.finished = not self._chunk_keys
+                return None
+            chunk = nacl.bindings.crypto_aead_xchacha20poly1305_ietf_decrypt(
+                frame, None, _CHUNK_NONCE, self._chunk_keys[self._next]
+            )
+        except Exception as e:
+            raise Exception(f"Decryption failed: {e}")
+        self._next += 1
+        self.finished = self._next == len(self._chunk_keys)
+        return chunk
+
+    def close(self):
+        """a stream that ends without its final chunk has been truncated"""
+        if not self.finished or self._buffer:
+            raise Exception("Decryption failed: file stream truncated")
+
+class _FileChunks:
+    """re-iterable chunks of a path or seekable file object, every pass starts over"""
+    def __init__(self, source: Union[str, BinaryIO], chunk_size: int):
+        self.source = source
+        self.chunk_size = chunk_size
+        self.start = None if isinstance(source, str) else source.tell()
+
+    def __iter__(self) -> Iterator[bytes]:
+        if self.start is not None:
+            self.source.seek(self.start)
+        return iter_file_chunks(self.source, self.chunk_size)
+
+def file_chunks(source: Union[str, BinaryIO], chunk_size: int = FILE_CHUNK_SIZE) -> Iterable[bytes]:
+    """chunks of a path or file object that encrypt_stream can read twice without buffering
+    (pipes and other unseekable files are read once by the caller)"""
+    if isinstance(source, str) or source.seekable():
+        return _FileChunks(source, chunk_size)
+    return iter_file_chunks(source, chunk_size)
+
+def iter_file_chunks(source: Union[str, BinaryIO], chunk_size: int = FILE_CHUNK_SIZE) -> Iterator[bytes]:
+    """read a path or binary file object lazily in chunk_size blocks"""
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            yield from iter_file_chunks(f, chunk_size)
+        return
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+def _field_bytes(value: Any) -> bytes:
+    """ciphertext/nonce field as bytes --> base64 text (JSON packets) or raw buffer (binary packets)"""
+    if isinstance(value, str):
+        return base64.b64decode(value)
+    if isinstance(value, bytes):
+        return value
+    # memoryview slices from p2p_packet.decode_packet, libsodium wants real bytes
+    return bytes(value)
+
 class P2PSession:
     """manages a P2P session between two peers"""
     def __init__(self, my_name: str, peer_name: str, crypto_manager: CryptoManager):
@@ -135,72 +607,185 @@ class P2PSession:
         self.shared_secret = None
         self.my_private_key = None
         self.my_public_key = None
+        # cached per-session state, built once in establish_session and reused per message
+        self.cipher: Optional[SecretBox] = None
+        self.peer_public_key: Optional[str] = None
+        self._private_key_obj: Optional[PrivateKey] = None
         # load my keypair
         self.initialize_keys()
     
     def initialize_keys(self):
         """initialize or load keypair for this peer"""
+        # keyring hands back already decoded key objects, no disk I/O after the first session
+        self._private_key_obj, self.my_public_key = self.crypto_manager.get_identity(self.my_name)
         self.my_private_key = self.crypto_manager.load_private_key(self.my_name)
-        if not self.my_private_key:
-            # generating new keypair
-            self.my_private_key, self.my_public_key = self.crypto_manager.generate_keypair(self.my_name)
-        else:
-            # deriving public key from private key
-            private_key_obj = PrivateKey(base64.b64decode(self.my_private_key))
-            self.my_public_key = base64.b64encode(private_key_obj.public_key.encode()).decode('utf-8')
     
     def establish_session(self, peer_public_key_b64: str):
         """establishing session with peer using their public key"""
+        # same peer key as the live session --> nothing to re-derive
+        if self.cipher is not None and peer_public_key_b64 == self.peer_public_key:
+            return True
         try:
-            assert self.my_private_key is not None, "Private key must be initialized"
+            assert self._private_key_obj is not None, "Private key must be initialized"
             self.shared_secret = self.crypto_manager.derive_shared_secret(
-                self.my_private_key, 
+                self._private_key_obj, 
                 peer_public_key_b64
             )
+            self.cipher = self.crypto_manager.create_cipher(self.shared_secret)
+            self.peer_public_key = peer_public_key_b64
             print(f"Session established between {self.my_name} and {self.peer_name}")
             return True
         except Exception as e:
+            self.invalidate_session()
             print(f"Failed to establish session: {e}")
             return False
+
+    def invalidate_session(self):
+        """drop the shared secret and cached cipher, messages fail until re-established"""
+        self.shared_secret = None
+        self.cipher = None
+        self.peer_public_key = None
+
+    def rekey(self, peer_public_key_b64: str) -> bool:
+        """force a fresh ECDH derivation, e.g. after the peer rotated its keypair"""
+        self.invalidate_session()
+        return self.establish_session(peer_public_key_b64)
     
     def send_message(self, message: str) -> Dict[str, Any]:
         #enccrypting and prepare message for sending
-        if not self.shared_secret:
+        if self.cipher is None or not self.shared_secret:
             raise Exception("Session not established")
-        encrypted_data = self.crypto_manager.encrypt_message(message, self.shared_secret)
+        encrypted_data = self.crypto_manager.encrypt_message(message, self.shared_secret, self.cipher, binary=True)
         
         # adding metadata
         message_packet = {
             "from": self.my_name,
             "to": self.peer_name,
-            "message_id": self.crypto_manager.hash_data(f"{message}{encrypted_data['timestamp']}"),
+            "message_id": self._message_id(message, encrypted_data),
             "encrypted_data": encrypted_data,
             "session_established": True
         }
         return message_packet
     
-    def receive_message(self, message_packet: Dict[str, Any]) -> str:
-        """decrypting received message"""
-        if not self.shared_secret:
+    def _message_id(self, message: str, encrypted_data: Dict[str, Any]) -> str:
+        # the nonce keeps ids apart for equal messages encrypted in the same microsecond (batches)
+        nonce = _field_bytes(encrypted_data["nonce"]).hex()
+        return self.crypto_manager.hash_data(f"{message}{encrypted_data['timestamp']}{nonce}")
+
+    def receive_message(self, message_packet: Union[Dict[str, Any], bytes]) -> str:
+        """decrypting received message (packet dict or binary packet)"""
+        if self.cipher is None or not self.shared_secret:
             raise Exception("Session not established")
+        if is_encoded_packet(message_packet):
+            message_packet = decode_packet(message_packet)
         if message_packet["to"] != self.my_name:
             raise Exception("Message not intended for this peer")
         decrypted_message = self.crypto_manager.decrypt_message(
             message_packet["encrypted_data"], 
-            self.shared_secret
+            self.shared_secret,
+            self.cipher
         )
         return decrypted_message
     
+    def encrypt_many(self, messages: Sequence[str], max_workers: int = 0) -> Tuple[List[Optional[Dict[str, Any]]], Dict[int, str]]:
+        """batch version of send_message, returns (packets, {index: error})"""
+        if self.cipher is None or not self.shared_secret:
+            raise Exception("Session not established")
+        encrypted, errors = self.crypto_manager.encrypt_many(messages, self.shared_secret, self.cipher, max_workers, binary=True)
+        packets: List[Optional[Dict[str, Any]]] = []
+        for message, encrypted_data in zip(messages, encrypted):
+            if encrypted_data is None:
+                packets.append(None)
+                continue
+            packets.append({
+                "from": self.my_name,
+                "to": self.peer_name,
+                "message_id": self._message_id(message, encrypted_data),
+                "encrypted_data": encrypted_data,
+                "session_established": True
+            })
+        return packets, errors
+
+    def decrypt_many(
+            self,
+            message_packets: Sequence[Dict[str, Any]],
+            max_workers: int = 0,
+            include_outgoing: bool = False) -> Tuple[List[Optional[str]], Dict[int, str]]:
+        """batch version of receive_message, returns (plaintexts, {index: error})
+
+        include_outgoing also opens packets we sent to this peer (same shared secret),
+        which is what conversation history needs.
+        """
+        if self.cipher is None or not self.shared_secret:
+            raise Exception("Session not established")
+        # only packets addressed to us go to the cipher, the rest are reported as errors
+        positions: List[int] = []
+        items: List[Dict[str, Any]] = []
+        errors: Dict[int, str] = {}
+        for i, packet in enumerate(message_packets):
+            outgoing = include_outgoing and packet.get("from") == self.my_name and packet.get("to") == self.peer_name
+            if packet.get("to") != self.my_name and not outgoing:
+                errors[i] = "Message not intended for this peer"
+            else:
+                positions.append(i)
+                items.append(packet["encrypted_data"])
+        decrypted, item_errors = self.crypto_manager.decrypt_many(items, self.shared_secret, self.cipher, max_workers)
+        results: List[Optional[str]] = [None] * len(message_packets)
+        for j, i in enumerate(positions):
+            results[i] = decrypted[j]
+        for j, error in item_errors.items():
+            errors[positions[j]] = error
+        return results, errors
+
+    def encrypt_file(self, chunks: Iterable[bytes], chunk_size: int = FILE_CHUNK_SIZE) -> Iterator[bytes]:
+        """stream-encrypt file chunks with this session's shared secret"""
+        if self.cipher is None or not self.shared_secret:
+            raise Exception("Session not established")
+        return self.crypto_manager.encrypt_stream(chunks, self.shared_secret, chunk_size)
+
+    def decrypt_file(self, blocks: Iterable[bytes]) -> Iterator[bytes]:
+        """stream-decrypt a file produced by the peer's encrypt_file"""
+        if self.cipher is None or not self.shared_secret:
+            raise Exception("Session not established")
+        return self.crypto_manager.decrypt_stream(blocks, self.shared_secret)
+
     def get_my_public_key(self) -> str:
         assert self.my_public_key is not None, "public key must be initialized"
         """return my public key for sharing"""
         return self.my_public_key
 
+def _rechunk(chunks: Iterable[bytes], chunk_size: int) -> Iterator[bytes]:
+    """regroup arbitrary-sized blocks into chunk_size chunks (last one may be short)"""
+    buffer = bytearray()
+    for data in chunks:
+        if not buffer and len(data) == chunk_size:
+            yield bytes(data)
+            continue
+        buffer += data
+        while len(buffer) >= chunk_size:
+            yield bytes(buffer[:chunk_size])
+            del buffer[:chunk_size]
+    if buffer:
+        yield bytes(buffer)
+
 # utility functions --> implemented after testing!
+def get_crypto_manager(keys_dir: str = "keys") -> CryptoManager:
+    """one CryptoManager per keys dir, shared by every session"""
+    path = os.path.abspath(keys_dir)
+    with _REGISTRY_LOCK:
+        crypto_manager = _CRYPTO_MANAGERS.get(path)
+        if crypto_manager is None:
+            crypto_manager = _CRYPTO_MANAGERS[path] = CryptoManager(keys_dir)
+    crypto_manager.ensure_keys_directory()
+    return crypto_manager
+
+def get_public_key(peer_name: str, keys_dir: str = "keys") -> str:
+    """public key of a local identity, straight from the keyring"""
+    return get_keyring(keys_dir).get_or_create(peer_name)[1]
+
 def create_peer_session(my_name: str, peer_name: str, keys_dir: str = "keys") -> P2PSession:
     """creating a new P2P session"""
-    crypto_manager = CryptoManager(keys_dir)
-    return P2PSession(my_name, peer_name, crypto_manager)
+    return P2PSession(my_name, peer_name, get_crypto_manager(keys_dir))
 
 def generate_qr_data(peer_name: str, public_key: str, ip_address: str = "192.168.1.100", port: int = 5000) -> Dict[str, Any]:
     """generating data for QR code to bootstrap P2P connection"""
@@ -2,20 +2,181 @@
 
 import json
 import time
-from typing import Dict, Any, List, Callable, Optional, Coroutine
-from p2p_crypto import create_peer_session
+from typing import Dict, Any, List, Callable, Optional, Coroutine, Union, Iterable, Iterator, BinaryIO, Tuple
+from p2p_crypto import create_peer_session, get_public_key, file_chunks, generate_qr_data
 from file_store import create_message_store
-from datetime import datetime
+from store_writer import StoreWriter, DURABILITY_NONE
+from p2p_packet import encode_packet, decode_packet, decode_header, is_encoded_packet
+from peer_transport import PeerTransport, TRANSPORT_LOOPBACK, TRANSPORT_TCP, TRANSPORTS
+from mesh_routing import RoutingTable
+from datetime import datetime, timezone
+from collections import OrderedDict, deque
 import asyncio
 
+# rough per-entry overhead of a history dict on top of its string payloads
+_HISTORY_ENTRY_OVERHEAD = 200
+
+def conversation_key(peer_a: str, peer_b: str) -> str:
+    """store namespace of the conversation between two peers (same for both sides)"""
+    first, second = sorted((peer_a, peer_b))
+    return f"{first}<->{second}"
+
+def peer_statistics(namespace_stats: Dict[str, Dict[str, int]]) -> Dict[str, Dict[str, int]]:
+    """per-namespace store counters --> per-peer totals (a conversation counts for both peers)"""
+    totals: Dict[str, Dict[str, int]] = {}
+    for namespace, counts in namespace_stats.items():
+        for peer in set(namespace.split("<->")):
+            peer_counts = totals.setdefault(peer, {"text": 0, "file": 0, "bytes": 0})
+            for field, value in counts.items():
+                peer_counts[field] = peer_counts.get(field, 0) + value
+    return totals
+
+class ConversationCache:
+    """LRU cache of decrypted history per conversation, bounded by approximate memory use
+
+    a miss loads only the newest max_messages of a conversation from disk, afterwards new
+    messages are appended as they are sent/received. a window that doesn't reach back to
+    the first message is marked partial and only serves requests it fully covers.
+    """
+    def __init__(self, max_bytes: int = 8 * 1024 * 1024, max_messages: int = 1000):
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.total_bytes = 0
+        self._conversations: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        # bumped on every change, a load that raced with one isn't cached (see version())
+        self._versions: Dict[str, int] = {}
+        self._epoch = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _entry_size(entry: Dict[str, Any]) -> int:
+        return _HISTORY_ENTRY_OVERHEAD + sum(len(v) for v in entry.values() if isinstance(v, str))
+
+    def get(self, peer_name: str, limit: int) -> Optional[List[Dict[str, Any]]]:
+        """last `limit` entries, or None when the cache can't answer without the disk"""
+        conversation = self._conversations.get(peer_name)
+        if conversation is None or (not conversation["complete"] and limit > len(conversation["entries"])):
+            self.misses += 1
+            return None
+        self._conversations.move_to_end(peer_name)
+        self.hits += 1
+        entries = conversation["entries"]
+        if limit <= 0:
+            return []
+        start = max(0, len(entries) - limit)
+        return [entries[i][0] for i in range(start, len(entries))]
+
+    def version(self, peer_name: str) -> Tuple[int, int]:
+        """taken before a load that runs off the loop, handed back to put()"""
+        return self._epoch, self._versions.get(peer_name, 0)
+
+    def has_older(self, peer_name: str, count: int) -> bool:
+        """whether messages older than the newest `count` exist (in the cache or, for a partial
+        window, only on disk) --> decides the next_cursor of a first page served from here"""
+        conversation = self._conversations.get(peer_name)
+        return conversation is None or not conversation["complete"] or len(conversation["entries"]) > count
+
+    def put(self, peer_name: str, entries: List[Dict[str, Any]], complete: bool = True,
+            version: Optional[Tuple[int, int]] = None):
+        """store a freshly loaded conversation, complete=False --> only its newest entries
+
+        with a version, the load is dropped if the conversation changed while it was read.
+        """
+        if version is not None and version != self.version(peer_name):
+            return
+        self.invalidate(peer_name)
+        conversation = {"entries": deque(), "bytes": 0, "complete": complete}
+        self._conversations[peer_name] = conversation
+        for entry in entries:
+            self._add(conversation, entry)
+        self._evict()
+
+    def append(self, peer_name: str, entry: Dict[str, Any]):
+        """add a new message to a cached conversation (cold conversations are left to the next load)"""
+        self._versions[peer_name] = self._versions.get(peer_name, 0) + 1
+        conversation = self._conversations.get(peer_name)
+        if conversation is None:
+            return
+        self._add(conversation, entry)
+        self._conversations.move_to_end(peer_name)
+        self._evict()
+
+    def invalidate(self, peer_name: Optional[str] = None):
+        """drop one conversation, or everything"""
+        if peer_name is None:
+            self._epoch += 1
+            self._conversations.clear()
+            self.total_bytes = 0
+            return
+        self._versions[peer_name] = self._versions.get(peer_name, 0) + 1
+        conversation = self._conversations.pop(peer_name, None)
+        if conversation is not None:
+            self.total_bytes -= conversation["bytes"]
+
+    def _add(self, conversation: Dict[str, Any], entry: Dict[str, Any]):
+        size = self._entry_size(entry)
+        conversation["entries"].append((entry, size))
+        conversation["bytes"] += size
+        self.total_bytes += size
+        if len(conversation["entries"]) > self.max_messages:
+            _old, old_size = conversation["entries"].popleft()
+            conversation["bytes"] -= old_size
+            self.total_bytes -= old_size
+            conversation["complete"] = False
+
+    def _evict(self):
+        # whole least-recently-used conversations go first, never the one just touched
+        while self.total_bytes > self.max_bytes and len(self._conversations) > 1:
+            _peer, conversation = self._conversations.popitem(last=False)
+            self.total_bytes -= conversation["bytes"]
+
 class P2PPeer:
-    def __init__(self, name: str, ip_address: str = "127.0.0.1", port: int = 5000):
+    def __init__(
+            self,
+            name: str,
+            ip_address: str = "127.0.0.1",
+            port: int = 5000,
+            storage_backend: str = "log",
+            message_store: Optional[Any] = None):
         self.name = name
         self.ip_address = ip_address
         self.port = port
         self.sessions: Dict[str, Any] = {}
-        self.message_store = create_message_store() 
+        # messages live under conversation_key(self, peer), so one stored copy serves both sides
+        self.message_store = message_store if message_store is not None else create_message_store(backend=storage_backend)
+        self.history_cache = ConversationCache()
+        # set by P2PNetworkSimulator, async paths then commit through it off the event loop
+        self.store_writer: Optional[StoreWriter] = None
         self.on_message_received: Optional[Callable[[Dict], Coroutine[Any, Any, None]]] = None
+        # tcp mode: listening server + pooled connections, and where remote peers listen
+        self.transport: Optional[PeerTransport] = None
+        self.addresses: Dict[str, Tuple[str, int]] = {}
+        # packets forwarded for other peers (mesh routing)
+        self.relayed = 0
+
+    def get_transport(self) -> PeerTransport:
+        # created on first use, sending alone doesn't need a listening server
+        if self.transport is None:
+            self.transport = PeerTransport(self.receive_message)
+        return self.transport
+
+    async def listen(self, host: str = "127.0.0.1", port: int = 0) -> Tuple[str, int]:
+        """accept packets over tcp, port 0 picks a free one --> (host, port) actually bound"""
+        self.ip_address, self.port = await self.get_transport().listen(host, port)
+        return self.ip_address, self.port
+
+    def get_qr_data(self) -> Dict[str, Any]:
+        """what another process needs to reach this peer: name, public key, address"""
+        return generate_qr_data(self.name, get_public_key(self.name), self.ip_address, self.port)
+
+    def connect_remote(self, qr_data: Dict[str, Any]) -> bool:
+        """connect to a peer of another process from its get_qr_data()"""
+        peer_name = qr_data.get("peer_name")
+        if not peer_name or not qr_data.get("public_key"):
+            return False
+        self.addresses[peer_name] = (qr_data["ip_address"], int(qr_data["port"]))
+        return self.connect_to_peer(peer_name, qr_data["public_key"])
 
     def connect_to_peer(self, peer_name: str, peer_public_key: str) -> bool:
         try:
@@ -31,62 +192,239 @@ class P2PPeer:
             return None
         try:
             message_packet = self.sessions[peer_name].send_message(message)
-            self.message_store.save_message(message_packet, peer_name)
+            message_id = self.message_store.save_message(message_packet, conversation_key(self.name, peer_name))
+            self.record_sent(peer_name, message, message_id)
             return message_packet
         except Exception as e:
             print(f"Send message error: {e}")
             return None
 
-    async def receive_message(self, message_packet: Dict[str, Any]):
+    async def send_message_async(self, peer_name: str, message: str, store: bool = True) -> Optional[Dict[str, Any]]:
+        """send_message for the event loop: storage goes through the group-commit writer
+
+        store=False only encrypts, the caller stores the packet once (e.g. on delivery)
+        and reports it back with record_sent.
+        """
+        if peer_name not in self.sessions:
+            return None
+        try:
+            message_packet = self.sessions[peer_name].send_message(message)
+            if store:
+                message_id = await self._store_message(message_packet, peer_name)
+                self.record_sent(peer_name, message, message_id)
+            return message_packet
+        except Exception as e:
+            print(f"Send message error: {e}")
+            return None
+
+    def record_sent(self, peer_name: str, message: str, message_id: str):
+        """add a stored outgoing message to the history cache"""
+        self.history_cache.append(peer_name, {
+            "from": self.name,
+            "to": peer_name,
+            "message": message,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "cursor": self.message_store.get_cursor(message_id),
+        })
+
+    async def _store_message(self, message_packet: Union[Dict[str, Any], bytes], peer_name: str) -> str:
+        namespace = conversation_key(self.name, peer_name)
+        if self.store_writer is not None:
+            return await self.store_writer.save_message(message_packet, namespace)
+        return self.message_store.save_message(message_packet, namespace)
+
+    def send_file(self, peer_name: str, source: Union[str, BinaryIO, Iterable[bytes]], filename: str) -> Optional[str]:
+        """stream a file to encrypted/files/ chunk by chunk, returns the file message_id"""
+        if peer_name not in self.sessions:
+            return None
+        try:
+            session = self.sessions[peer_name]
+            # paths and file objects are read lazily (twice: chunk keys, then data), anything else
+            # is already an iterable of chunks
+            chunks = file_chunks(source) if isinstance(source, str) or hasattr(source, "read") else source
+            # the packet carries the (encrypted) filename, the data itself goes through the stream cipher
+            message_packet = session.send_message(filename)
+            return self.message_store.save_file_stream(
+                session.encrypt_file(chunks), filename, message_packet, conversation_key(self.name, peer_name)
+            )
+        except Exception as e:
+            print(f"Send file error: {e}")
+            return None
+
+    def read_file(self, peer_name: str, message_id: str) -> Optional[Iterator[bytes]]:
+        """stream the decrypted chunks of a stored file message back out"""
+        if peer_name not in self.sessions:
+            return None
+        blocks = self.message_store.iter_file_data(message_id)
+        if blocks is None:
+            return None
+        return self.sessions[peer_name].decrypt_file(blocks)
+
+    async def receive_message(self, message_packet: Union[Dict[str, Any], bytes]) -> Optional[str]:
+        """decrypt, store and announce an incoming packet, returns its message_id once stored"""
+        # binary packets off the wire are parsed in place and stored without re-encoding
+        wire_packet = message_packet if is_encoded_packet(message_packet) else None
+        if wire_packet is not None:
+            try:
+                message_packet = decode_packet(wire_packet)
+            except Exception as e:
+                print(f"Receive message error: {e}")
+                return None
         sender = message_packet.get("from")
         if not isinstance(sender, str) or sender not in self.sessions:
-            return
+            return None
         try:
             decrypted_message = self.sessions[sender].receive_message(message_packet)
-            self.message_store.save_message(message_packet, sender)
-            # creates simple display message format
-            display_msg = {
-                "from": sender,
-                "to": self.name,
-                "message": decrypted_message,
-                "timestamp": datetime.now().isoformat()
-            }
-            # use the callback to notify the higher level (WebSocket server)
-            if self.on_message_received:
-                asyncio.create_task(self.on_message_received(display_msg))
+            message_id = await self._store_message(wire_packet if wire_packet is not None else message_packet, sender)
+            self.record_received(sender, decrypted_message, message_id)
+            return message_id
         except Exception as e:
             print(f"Receive message error: {e}")
+            return None
+
+    def record_received(self, sender: str, message: str, message_id: str, announce: bool = True):
+        """add a stored incoming message to the history cache and announce it (bulk paths
+        pass announce=False and send one notice per conversation instead)"""
+        self.history_cache.append(sender, {
+            "from": sender,
+            "to": self.name,
+            "message": message,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "cursor": self.message_store.get_cursor(message_id),
+        })
+        # creates simple display message format
+        display_msg = {
+            "from": sender,
+            "to": self.name,
+            "message": message,
+            "timestamp": datetime.now().isoformat()
+        }
+        # use the callback to notify the higher level (WebSocket server)
+        if announce and self.on_message_received:
+            asyncio.create_task(self.on_message_received(display_msg))
+
+    def relay_packet(self, wire_packet: bytes) -> str:
+        """forward someone else's packet: only the header is read, returns its destination"""
+        destination = decode_header(wire_packet)["to"]
+        self.relayed += 1
+        return destination
 
     def get_my_public_key(self, peer_name: str) -> Optional[str]:
         if peer_name not in self.sessions:
-            temp_session = create_peer_session(self.name, peer_name)
-            return temp_session.get_my_public_key()
+            # identity is per peer, not per session --> no throwaway session needed
+            return get_public_key(self.name)
         return self.sessions[peer_name].get_my_public_key()
 
     def get_conversation_history(self, peer_name: str, limit: int = 50) -> List[Dict[str, Any]]:
         if peer_name not in self.sessions:
             return []
-        stored_messages = self.message_store.get_messages_by_peer(peer_name)
-        conversation = []
+        cached = self.history_cache.get(peer_name, limit)
+        if cached is not None:
+            return cached
+        # only the tail the cache can hold is read and decrypted, not the whole conversation
+        conversation, next_cursor = self._read_conversation_page(peer_name, None, max(limit, self.history_cache.max_messages))
+        self.history_cache.put(peer_name, conversation, complete=next_cursor is None)
+        return conversation[-limit:] if limit > 0 else []
+
+    def get_conversation_page(
+            self,
+            peer_name: str,
+            before: Optional[str] = None,
+            limit: int = 50) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """one page of history older than the `before` cursor + the cursor for the next page
+
+        the first page comes from the history cache (a miss loads the conversation's tail into
+        it), older pages walk the store's per-peer index newest-first and only read/decrypt the
+        records that end up on the page.
+        """
+        if peer_name not in self.sessions:
+            return [], None
+        if before is None:
+            page = self.get_conversation_history(peer_name, limit)
+            next_cursor = page[0]["cursor"] if page and self.history_cache.has_older(peer_name, len(page)) else None
+        else:
+            page, next_cursor = self._read_conversation_page(peer_name, before, limit)
+        return page, next_cursor
+
+    async def get_conversation_page_async(
+            self,
+            peer_name: str,
+            before: Optional[str] = None,
+            limit: int = 50) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """get_conversation_page for the event loop --> store reads and decryption run in a thread"""
+        if peer_name not in self.sessions:
+            return [], None
+        # the cache is only touched here on the loop, the thread never sees it
+        if before is None:
+            page = self.history_cache.get(peer_name, limit)
+            if page is not None:
+                older = self.history_cache.has_older(peer_name, len(page))
+            else:
+                version = self.history_cache.version(peer_name)
+                conversation, store_cursor = await asyncio.to_thread(
+                    self._read_conversation_page, peer_name, None, max(limit, self.history_cache.max_messages)
+                )
+                self.history_cache.put(peer_name, conversation, complete=store_cursor is None, version=version)
+                page = conversation[-limit:]
+                older = store_cursor is not None or len(conversation) > len(page)
+            next_cursor = page[0]["cursor"] if page and older else None
+        else:
+            page, next_cursor = await asyncio.to_thread(self._read_conversation_page, peer_name, before, limit)
+        return page, next_cursor
+
+    def _read_conversation_page(
+            self,
+            peer_name: str,
+            before: Optional[str],
+            limit: int) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """read and decrypt up to `limit` messages older than `before` (None --> the newest ones)
+
+        returns (entries oldest first, store cursor of the next older page or None). the cursor
+        comes from the store, a record that fails to decrypt shortens the page but not the paging.
+        """
         session = self.sessions[peer_name]
-        for msg_data in stored_messages[-limit:]:
-            try:
-                packet = msg_data["message_packet"]
-                decrypted = session.receive_message(packet)
-                conversation.append({
-                    "from": packet["from"],
-                    "to": packet["to"],
-                    "message": decrypted,
-                    "timestamp": msg_data["stored_at"],
-                })
-            except Exception:
-                continue
-        return conversation
+        # the conversation namespace holds both directions, already in stored order
+        picked, next_cursor = self.message_store.query(conversation_key(self.name, peer_name), before, limit)
+        # one batch call instead of a receive_message (and a caught exception) per packet
+        decrypted, _errors = session.decrypt_many([msg_data["message_packet"] for msg_data in picked], include_outgoing=True)
+        page = [
+            {
+                "from": msg_data["message_packet"]["from"],
+                "to": msg_data["message_packet"]["to"],
+                "message": plaintext,
+                "timestamp": msg_data["stored_at"],
+                "cursor": msg_data["cursor"],
+            }
+            for msg_data, plaintext in zip(picked, decrypted) if plaintext is not None
+        ]
+        return page, next_cursor
 
 class P2PNetworkSimulator:
-    def __init__(self):
+    def __init__(
+            self,
+            durability: str = DURABILITY_NONE,
+            max_batch: int = 512,
+            max_delay: float = 0.0,
+            storage_backend: str = "log",
+            encrypted_dir: str = "encrypted",
+            transport: str = TRANSPORT_LOOPBACK):
+        if transport not in TRANSPORTS:
+            raise ValueError(f"Unknown transport: {transport}")
         self.peers: Dict[str, P2PPeer] = {}
+        self.transport = transport
+        self.storage_backend = storage_backend
+        self.encrypted_dir = encrypted_dir
         self.on_event: Optional[Callable[[Dict], Coroutine[Any, Any, None]]] = None
+        # one store (and group-commit writer) for every peer of the network, created with the first peer
+        self.durability = durability
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.message_store: Optional[Any] = None
+        self.store_writer: Optional[StoreWriter] = None
+        # set in sharded mode (shard_network): reaches peers that live in other worker processes
+        self.remote: Optional[Any] = None
+        # link graph of connect_peers + cached shortest paths for multi-hop delivery
+        self.routing = RoutingTable()
 
     def set_event_handler(self, handler: Callable[[Dict], Coroutine[Any, Any, None]]):
         #sets callback for network-wide events.
@@ -95,15 +433,29 @@ class P2PNetworkSimulator:
     def create_peer(self, name: str) -> P2PPeer:
         if name in self.peers:
             return self.peers[name]
-        peer = P2PPeer(name)
+        store = create_message_store(self.encrypted_dir, self.storage_backend)
+        if self.store_writer is None or self.store_writer.store is not store:
+            if self.store_writer is not None:
+                self.store_writer.close()
+            self.store_writer = StoreWriter(store, self.max_batch, self.max_delay, self.durability)
+        self.message_store = store
+        peer = P2PPeer(name, storage_backend=self.storage_backend, message_store=store)
         # hook message receiver to network-wide event handler --> solved error:17
         peer.on_message_received = self._handle_peer_event
+        peer.store_writer = self.store_writer
         self.peers[name] = peer
+        self.routing.add_peer(name)
         return peer
 
     def connect_peers(self, peer1_name: str, peer2_name: str) -> bool:
         if peer1_name not in self.peers or peer2_name not in self.peers:
             return False
+        if not self._exchange_keys(peer1_name, peer2_name):
+            return False
+        self.routing.add_link(peer1_name, peer2_name)
+        return True
+
+    def _exchange_keys(self, peer1_name: str, peer2_name: str) -> bool:
         peer1 = self.peers[peer1_name]
         peer2 = self.peers[peer2_name]
         key1 = peer1.get_my_public_key(peer2_name)
@@ -113,14 +465,285 @@ class P2PNetworkSimulator:
         res2 = peer2.connect_to_peer(peer1_name, key1)
         return res1 and res2
 
+    def _mesh_ready(self, from_peer: str, to_peer: str) -> bool:
+        """route + end-to-end session for two local peers that aren't linked
+
+        the session keys come from the local key directory (what a QR card exchange would
+        give), it only lets the two ends seal/open packets, it doesn't add a link.
+        """
+        if self.routing.next_hop(from_peer, to_peer) is None:
+            return False
+        if to_peer in self.peers[from_peer].sessions and from_peer in self.peers[to_peer].sessions:
+            return True
+        return self._exchange_keys(from_peer, to_peer)
+
+    async def listen(self, peer_name: str, host: str = "127.0.0.1", port: int = 0) -> Optional[Tuple[str, int]]:
+        """start a peer's tcp server (tcp mode), returns its address"""
+        if peer_name not in self.peers:
+            return None
+        return await self.peers[peer_name].listen(host, port)
+
+    def _tcp_address(self, from_peer: str, to_peer: str) -> Optional[Tuple[str, int]]:
+        """where to send from_peer's packets for to_peer over tcp, None --> in-process routing"""
+        if self.transport != TRANSPORT_TCP:
+            return None
+        receiver = self.peers.get(to_peer)
+        if receiver is not None:
+            return receiver.transport.address if receiver.transport is not None and receiver.transport.listening else None
+        return self.peers[from_peer].addresses.get(to_peer)
+
     async def route_message(self, from_peer: str, to_peer: str, message: str):
-        if from_peer in self.peers and to_peer in self.peers:
+        address = self._tcp_address(from_peer, to_peer) if from_peer in self.peers else None
+        if from_peer in self.peers and to_peer in self.peers and not self.routing.linked(from_peer, to_peer):
+            await self._route_mesh(from_peer, to_peer, message)
+        elif address is not None:
+            # real socket, also between two peers of this network
+            sender = self.peers[from_peer]
+            local = to_peer in self.peers
+            # a local receiver stores the one copy in the shared store when the frame arrives
+            message_packet = await sender.send_message_async(to_peer, message, store=not local)
+            if message_packet:
+                await sender.get_transport().send(address, encode_packet(message_packet))
+                if local:
+                    sender.history_cache.invalidate(to_peer)
+        elif from_peer in self.peers and to_peer in self.peers:
             sender = self.peers[from_peer]
             receiver = self.peers[to_peer]
-            message_packet = sender.send_message(to_peer, message)
+            message_packet = await sender.send_message_async(to_peer, message, store=False)
+            if message_packet:
+                # what goes over the (simulated) wire is the binary packet, the receiver stores it
+                # once in the shared store and the sender's history points at that same record
+                wire_packet = encode_packet(message_packet)
+                message_id = await receiver.receive_message(wire_packet)
+                if message_id is None:
+                    # not delivered, keep the sender's copy
+                    message_id = await sender._store_message(wire_packet, to_peer)
+                sender.record_sent(to_peer, message, message_id)
+        elif from_peer in self.peers and self.remote is not None:
+            # receiver lives in another shard --> it stores its own copy there, the sender keeps one here
+            message_packet = await self.peers[from_peer].send_message_async(to_peer, message)
             if message_packet:
-                import asyncio
-                await receiver.receive_message(message_packet)
+                await self.remote.deliver(to_peer, [encode_packet(message_packet)])
+
+    async def _route_mesh(self, from_peer: str, to_peer: str, message: str):
+        """multi-hop delivery: sealed end to end by the sender, relays only forward it"""
+        if not self._mesh_ready(from_peer, to_peer):
+            return
+        sender = self.peers[from_peer]
+        message_packet = await sender.send_message_async(to_peer, message, store=False)
+        if not message_packet:
+            return
+        wire_packet = encode_packet(message_packet)
+        hop = self.routing.next_hop(from_peer, to_peer)
+        while hop != to_peer:
+            # every relay reads the destination from the header and looks up its own next hop
+            hop = self.routing.next_hop(hop, self.peers[hop].relay_packet(wire_packet))
+        message_id = await self.peers[to_peer].receive_message(wire_packet)
+        if message_id is None:
+            message_id = await sender._store_message(wire_packet, to_peer)
+        sender.record_sent(to_peer, message, message_id)
+
+    async def route_messages(self, items: Iterable[Tuple[str, str, str]]) -> Dict[str, Any]:
+        """route many (from, to, message) tuples at once, returns one aggregated acknowledgement
+
+        messages are grouped per session pair: one batch encryption on the sender side and one
+        batch decryption on the receiver side per pair (off the event loop), then everything
+        delivered goes to the store as a single group commit, in input order.
+        """
+        groups: Dict[Tuple[str, str], List[Tuple[int, str]]] = {}
+        errors: Dict[int, str] = {}
+        total = 0
+        for i, (from_peer, to_peer, message) in enumerate(items):
+            total += 1
+            if from_peer not in self.peers or (
+                    to_peer not in self.peers and self.remote is None and self._tcp_address(from_peer, to_peer) is None):
+                errors[i] = "Unknown peer"
+            elif to_peer in self.peers and not self.routing.linked(from_peer, to_peer):
+                if self._mesh_ready(from_peer, to_peer):
+                    groups.setdefault((from_peer, to_peer), []).append((i, message))
+                else:
+                    errors[i] = "No route to peer"
+            elif to_peer not in self.peers[from_peer].sessions or (
+                    to_peer in self.peers and from_peer not in self.peers[to_peer].sessions):
+                errors[i] = "Peers not connected"
+            else:
+                groups.setdefault((from_peer, to_peer), []).append((i, message))
+        # (input index, from, to, message, wire packet)
+        delivered: List[Tuple[int, str, str, str, bytes]] = []
+        tcp_delivered = 0
+        for (from_peer, to_peer), group in groups.items():
+            messages = [message for _i, message in group]
+            try:
+                packets, encrypt_errors = await asyncio.to_thread(self.peers[from_peer].sessions[to_peer].encrypt_many, messages)
+            except Exception as e:
+                errors.update((i, str(e)) for i, _message in group)
+                continue
+            for j, error in encrypt_errors.items():
+                errors[group[j][0]] = error
+            sent = [(i, message, packet, encode_packet(packet)) for (i, message), packet in zip(group, packets) if packet is not None]
+            mesh = to_peer in self.peers and not self.routing.linked(from_peer, to_peer)
+            if mesh:
+                # not neighbours: the sealed packets are forwarded relay by relay
+                for relay in self.routing.path(from_peer, to_peer)[1:-1]:
+                    for _i, _message, _packet, wire_packet in sent:
+                        self.peers[relay].relay_packet(wire_packet)
+            address = None if mesh else self._tcp_address(from_peer, to_peer)
+            if address is not None and to_peer in self.peers:
+                # tcp to a local receiver: it stores the only copy as the frames arrive
+                await self.peers[from_peer].get_transport().send_many(
+                    address, [wire_packet for _i, _message, _packet, wire_packet in sent]
+                )
+                self.peers[from_peer].history_cache.invalidate(to_peer)
+                tcp_delivered += len(sent)
+                continue
+            if to_peer not in self.peers:
+                # remote receiver opens (and stores) its copy in its own shard, ours is stored below
+                delivered.extend((i, from_peer, to_peer, message, wire_packet) for i, message, _packet, wire_packet in sent)
+                continue
+            try:
+                # receiver opens what it got, exactly like receive_message does one by one
+                plaintexts, decrypt_errors = await asyncio.to_thread(
+                    self.peers[to_peer].sessions[from_peer].decrypt_many, [packet for _i, _message, packet, _wire in sent]
+                )
+            except Exception as e:
+                errors.update((i, str(e)) for i, _message, _packet, _wire in sent)
+                continue
+            for j, error in decrypt_errors.items():
+                errors[sent[j][0]] = error
+            for (i, _message, _packet, wire_packet), plaintext in zip(sent, plaintexts):
+                if plaintext is not None:
+                    delivered.append((i, from_peer, to_peer, plaintext, wire_packet))
+        delivered.sort(key=lambda item: item[0])
+        undelivered = 0
+        if delivered:
+            message_ids = await self._save_records(
+                [(wire_packet, conversation_key(from_peer, to_peer)) for _i, from_peer, to_peer, _m, wire_packet in delivered]
+            )
+            remote: Dict[Tuple[str, str], List[Tuple[int, bytes]]] = {}
+            received: Dict[Tuple[str, str], int] = {}
+            for (i, from_peer, to_peer, message, wire_packet), message_id in zip(delivered, message_ids):
+                self.peers[from_peer].record_sent(to_peer, message, message_id)
+                if to_peer in self.peers:
+                    self.peers[to_peer].record_received(from_peer, message, message_id, announce=False)
+                    received[(from_peer, to_peer)] = received.get((from_peer, to_peer), 0) + 1
+                else:
+                    remote.setdefault((from_peer, to_peer), []).append((i, wire_packet))
+            self._announce_bulk(received)
+            for (from_peer, to_peer), sent in remote.items():
+                address = self._tcp_address(from_peer, to_peer)
+                if address is not None:
+                    await self.peers[from_peer].get_transport().send_many(address, [wire_packet for _i, wire_packet in sent])
+                    continue
+                remote_ids = await self.remote.deliver(to_peer, [wire_packet for _i, wire_packet in sent], bulk=True)
+                for (i, _wire_packet), message_id in zip(sent, remote_ids):
+                    if message_id is None:
+                        errors[i] = "Delivery failed"
+                        undelivered += 1
+        return {
+            "total": total,
+            "delivered": len(delivered) + tcp_delivered - undelivered,
+            "failed": len(errors),
+            "errors": {str(i): error for i, error in sorted(errors.items())},
+        }
+
+    async def deliver_packets(self, packets: List[bytes], bulk: bool = False) -> List[Optional[str]]:
+        """receiving end of a cross-shard send: open and store wire packets addressed to local
+        peers as one group commit, returns their message ids (None = not delivered)
+
+        bulk=True (packets of a route_messages call) announces one resync per conversation,
+        otherwise every message gets its own new_message event like a local send.
+        """
+        message_ids: List[Optional[str]] = [None] * len(packets)
+        groups: Dict[Tuple[str, str], List[Tuple[int, Dict[str, Any], bytes]]] = {}
+        for i, wire_packet in enumerate(packets):
+            try:
+                packet = decode_packet(wire_packet)
+            except Exception as e:
+                print(f"Receive message error: {e}")
+                continue
+            sender, recipient = packet.get("from"), packet.get("to")
+            if recipient in self.peers and sender in self.peers[recipient].sessions:
+                groups.setdefault((sender, recipient), []).append((i, packet, wire_packet))
+        delivered: List[Tuple[int, str, str, str, bytes]] = []
+        for (sender, recipient), group in groups.items():
+            try:
+                plaintexts, _errors = await asyncio.to_thread(
+                    self.peers[recipient].sessions[sender].decrypt_many, [packet for _i, packet, _wire in group]
+                )
+            except Exception as e:
+                print(f"Receive message error: {e}")
+                continue
+            for (i, _packet, wire_packet), plaintext in zip(group, plaintexts):
+                if plaintext is not None:
+                    delivered.append((i, sender, recipient, plaintext, wire_packet))
+        delivered.sort(key=lambda item: item[0])
+        if delivered:
+            stored = await self._save_records(
+                [(wire_packet, conversation_key(sender, recipient)) for _i, sender, recipient, _m, wire_packet in delivered]
+            )
+            received: Dict[Tuple[str, str], int] = {}
+            for (i, sender, recipient, message, _wire_packet), message_id in zip(delivered, stored):
+                self.peers[recipient].record_received(sender, message, message_id, announce=not bulk)
+                received[(sender, recipient)] = received.get((sender, recipient), 0) + 1
+                message_ids[i] = message_id
+            if bulk:
+                self._announce_bulk(received)
+        return message_ids
+
+    async def _save_records(self, records: List[Tuple[bytes, str]]) -> List[str]:
+        if self.store_writer is not None:
+            return await self.store_writer.save_messages(records)
+        return self.message_store.save_messages(records)
+
+    def expire_messages(self, days_old: int = 30) -> int:
+        """apply retention to the network's store, returns messages removed"""
+        if self.message_store is None:
+            return 0
+        return self.message_store.cleanup_old_messages(days_old)
+
+    def get_storage_stats(self) -> Dict[str, Any]:
+        """counters of the network's store plus writer / history cache stats"""
+        store_stats = self.message_store.get_storage_stats() if self.message_store else None
+        if store_stats is not None:
+            # the store counts per conversation, peer_statistics stays per peer like it was
+            # with one store per peer
+            store_stats["conversation_statistics"] = store_stats["peer_statistics"]
+            store_stats["peer_statistics"] = peer_statistics(store_stats["peer_statistics"])
+        return {
+            "store": store_stats,
+            "writer": self.store_writer.stats() if self.store_writer else None,
+            "history_cache": {
+                name: {"hits": peer.history_cache.hits, "misses": peer.history_cache.misses}
+                for name, peer in self.peers.items()
+            },
+            "transport": {
+                name: peer.transport.stats() for name, peer in self.peers.items() if peer.transport is not None
+            },
+            "routing": dict(self.routing.stats(), relayed=sum(peer.relayed for peer in self.peers.values())),
+        }
+
+    async def close_transports(self):
+        """stop every peer's tcp server and pooled connections"""
+        for peer in self.peers.values():
+            if peer.transport is not None:
+                await peer.transport.close()
+
+    def invalidate_history(self):
+        """drop cached history everywhere (after retention removed stored messages)"""
+        for peer in self.peers.values():
+            peer.history_cache.invalidate()
+
+    def _announce_bulk(self, received: Dict[Tuple[str, str], int]):
+        # one resync notice per conversation instead of an event per message, a bulk send would
+        # overflow every client's outbox otherwise --> clients reload the conversation's history
+        if not self.on_event:
+            return
+        for (sender, recipient), count in received.items():
+            asyncio.create_task(self.on_event({
+                "type": "resync",
+                "conversation": conversation_key(sender, recipient),
+                "data": {"from": sender, "to": recipient, "count": count},
+            }))
 
     async def _handle_peer_event(self, event_data: Dict):
         #internal handler to propagate events up to the WebSocket server.
@@ -0,0 +1,151 @@
+# p2p_packet.py
+# compact binary encoding for message packets --> replaces base64-in-JSON on the wire and on disk.
+#
+# layout (version 1, big endian):
+#   header   magic "P2" | version u8 | algorithm u8 | flags u8 | timestamp_us i64
+#            | from_len u8 | to_len u8 | id_len u8 | nonce_len u8 | ciphertext_len u32
+#   body     from | to | message_id | nonce | ciphertext
+import base64
+import struct
+from datetime import datetime, timezone
+from typing import Dict, Any, Union
+
+PACKET_MAGIC = b"P2"
+PACKET_VERSION = 1
+HEADER = struct.Struct(">2sBBBqBBBBI")
+
+# algorithm ids carried in the header instead of the algorithm string
+ALGORITHM_IDS = {
+    "XChaCha20-Poly1305": 1,
+    "ChaCha20-Poly1305": 2,
+}
+ALGORITHM_NAMES = {v: k for k, v in ALGORITHM_IDS.items()}
+
+FLAG_SESSION_ESTABLISHED = 0x01
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+class PacketError(Exception):
+    """raised for truncated, unknown-version or otherwise malformed packets"""
+
+
+def timestamp_to_us(timestamp: Union[int, float, str, None]) -> int:
+    """normalise an ISO string / epoch seconds / epoch microseconds to integer microseconds"""
+    if timestamp is None:
+        return 0
+    if isinstance(timestamp, int):
+        return timestamp
+    if isinstance(timestamp, float):
+        return int(timestamp * 1_000_000)
+    dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp() * 1_000_000)
+
+
+def us_to_isoformat(timestamp_us: int) -> str:
+    """integer microseconds back to the ISO string used by the JSON API"""
+    return datetime.fromtimestamp(timestamp_us / 1_000_000, timezone.utc).isoformat()
+
+
+def _raw(value: Union[str, Buffer]) -> Buffer:
+    # legacy packets carry base64 text, binary ones carry the bytes themselves
+    if isinstance(value, str):
+        return base64.b64decode(value)
+    return value
+
+
+def encode_packet(message_packet: Dict[str, Any]) -> bytes:
+    """packet dict --> binary packet"""
+    encrypted_data = message_packet["encrypted_data"]
+    sender = message_packet["from"].encode('utf-8')
+    recipient = message_packet["to"].encode('utf-8')
+    message_id = message_packet.get("message_id", "").encode('utf-8')
+    nonce = _raw(encrypted_data["nonce"])
+    ciphertext = _raw(encrypted_data["ciphertext"])
+    algorithm = ALGORITHM_IDS.get(encrypted_data.get("algorithm", "XChaCha20-Poly1305"))
+    if algorithm is None:
+        raise PacketError(f"Unknown algorithm: {encrypted_data.get('algorithm')}")
+    if max(len(sender), len(recipient), len(message_id), len(nonce)) > 255:
+        raise PacketError("Packet field too long")
+    flags = FLAG_SESSION_ESTABLISHED if message_packet.get("session_established") else 0
+    header = HEADER.pack(
+        PACKET_MAGIC, PACKET_VERSION, algorithm, flags,
+        timestamp_to_us(encrypted_data.get("timestamp")),
+        len(sender), len(recipient), len(message_id), len(nonce), len(ciphertext)
+    )
+    return b"".join((header, sender, recipient, message_id, nonce, ciphertext))
+
+
+def decode_header(data: Buffer) -> Dict[str, Any]:
+    """parse only the header and addressing fields, enough for routing and indexing"""
+    view = memoryview(data)
+    if len(view) < HEADER.size:
+        raise PacketError("Packet truncated")
+    magic, version, algorithm, flags, timestamp_us, from_len, to_len, id_len, nonce_len, ct_len = HEADER.unpack_from(view)
+    if magic != PACKET_MAGIC:
+        raise PacketError("Bad packet magic")
+    if version != PACKET_VERSION:
+        raise PacketError(f"Unsupported packet version: {version}")
+    offset = HEADER.size
+    end = offset + from_len + to_len + id_len + nonce_len + ct_len
+    if len(view) < end:
+        raise PacketError("Packet truncated")
+    sender = str(view[offset:offset + from_len], 'utf-8')
+    offset += from_len
+    recipient = str(view[offset:offset + to_len], 'utf-8')
+    offset += to_len
+    message_id = str(view[offset:offset + id_len], 'utf-8')
+    offset += id_len
+    return {
+        "from": sender,
+        "to": recipient,
+        "message_id": message_id,
+        "algorithm": ALGORITHM_NAMES.get(algorithm, str(algorithm)),
+        "timestamp": timestamp_us,
+        "session_established": bool(flags & FLAG_SESSION_ESTABLISHED),
+        "nonce_offset": offset,
+        "nonce_len": nonce_len,
+        "ciphertext_len": ct_len,
+        "packet_size": end,
+    }
+
+
+def decode_packet(data: Buffer) -> Dict[str, Any]:
+    """binary packet --> packet dict, nonce/ciphertext are memoryview slices of data (no copy)"""
+    view = memoryview(data)
+    header = decode_header(view)
+    nonce_start = header["nonce_offset"]
+    ct_start = nonce_start + header["nonce_len"]
+    return {
+        "from": header["from"],
+        "to": header["to"],
+        "message_id": header["message_id"],
+        "encrypted_data": {
+            "ciphertext": view[ct_start:ct_start + header["ciphertext_len"]],
+            "nonce": view[nonce_start:ct_start],
+            "timestamp": header["timestamp"],
+            "algorithm": header["algorithm"],
+        },
+        "session_established": header["session_established"],
+    }
+
+
+def packet_to_json(message_packet: Dict[str, Any]) -> Dict[str, Any]:
+    """binary-field packet dict --> the JSON-safe base64 form (for metadata files and the WebSocket API)"""
+    encrypted_data = message_packet["encrypted_data"]
+    timestamp = encrypted_data.get("timestamp")
+    json_packet = dict(message_packet)
+    json_packet["encrypted_data"] = {
+        "ciphertext": base64.b64encode(_raw(encrypted_data["ciphertext"])).decode('utf-8'),
+        "nonce": base64.b64encode(_raw(encrypted_data["nonce"])).decode('utf-8'),
+        "timestamp": us_to_isoformat(timestamp) if isinstance(timestamp, int) else timestamp,
+        "algorithm": encrypted_data.get("algorithm", "XChaCha20-Poly1305"),
+    }
+    return json_packet
+
+
+def is_encoded_packet(data: Any) -> bool:
+    """true for a binary packet, false for a packet dict"""
+    return isinstance(data, (bytes, bytearray, memoryview))
@@ -0,0 +1,181 @@
+# peer_transport.py
+# real network transport for P2PPeer --> a listening asyncio server per peer and pooled,
+# persistent outgoing connections.
+#
+# frames are  u32 length (big endian) | binary packet (p2p_packet). writes are pipelined: a send
+# only waits when the socket buffer is above WRITE_HIGH_WATER, never for the receiver.
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Set, Tuple
+
+# how P2PNetworkSimulator moves packets between peers
+TRANSPORT_LOOPBACK = "loopback"  # in-process function call (the original simulator)
+TRANSPORT_TCP = "tcp"            # length-prefixed frames over TCP, works across processes
+TRANSPORTS = (TRANSPORT_LOOPBACK, TRANSPORT_TCP)
+
+_HEADER_SIZE = 4
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+# buffered bytes per connection before a sender waits for the socket to drain
+WRITE_HIGH_WATER = 1024 * 1024
+# received packets being decrypted/stored at once per transport, reading pauses beyond that
+MAX_INFLIGHT_RECEIVES = 1024
+
+Address = Tuple[str, int]
+
+
+class PeerTransport:
+    """tcp endpoint of one peer: optional listening server + one pooled connection per remote address"""
+
+    def __init__(self, on_packet: Callable[[bytes], Awaitable[Any]]):
+        self.on_packet = on_packet
+        self.address: Optional[Address] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: Dict[Address, asyncio.StreamWriter] = {}
+        self._connecting: Dict[Address, asyncio.Lock] = {}
+        self._readers: Set[asyncio.Task] = set()
+        self._inflight = asyncio.Semaphore(MAX_INFLIGHT_RECEIVES)
+        self._receives: Set[asyncio.Task] = set()
+        # metrics
+        self.frames_sent = 0
+        self.frames_received = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.connections_opened = 0
+
+    @property
+    def listening(self) -> bool:
+        return self._server is not None
+
+    async def listen(self, host: str = "127.0.0.1", port: int = 0) -> Address:
+        """start accepting frames, port 0 picks a free port --> returns the bound address"""
+        if self._server is None:
+            self._server = await asyncio.start_server(self._serve, host, port, limit=MAX_FRAME_SIZE)
+            bound = self._server.sockets[0].getsockname()
+            self.address = (host, bound[1])
+        return self.address
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self._readers.add(task)
+        try:
+            while True:
+                header = await reader.readexactly(_HEADER_SIZE)
+                size = int.from_bytes(header, 'big')
+                if size > MAX_FRAME_SIZE:
+                    print(f"Dropping connection: frame of {size} bytes")
+                    break
+                frame = await reader.readexactly(size)
+                self.frames_received += 1
+                self.bytes_received += size + _HEADER_SIZE
+                # started in arrival order, so the store writer sees them in order too
+                await self._inflight.acquire()
+                receive = asyncio.create_task(self._receive(frame))
+                self._receives.add(receive)
+                receive.add_done_callback(self._receives.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._readers.discard(task)
+            writer.close()
+
+    async def _receive(self, frame: bytes):
+        try:
+            await self.on_packet(frame)
+        except Exception as e:
+            print(f"Receive message error: {e}")
+        finally:
+            self._inflight.release()
+
+    async def _connection(self, address: Address) -> asyncio.StreamWriter:
+        writer = self._connections.get(address)
+        if writer is not None and not writer.is_closing():
+            return writer
+        lock = self._connecting.setdefault(address, asyncio.Lock())
+        async with lock:
+            writer = self._connections.get(address)
+            if writer is None or writer.is_closing():
+                reader, writer = await asyncio.open_connection(*address)
+                self._connections[address] = writer
+                self.connections_opened += 1
+                watch = asyncio.create_task(self._watch(address, reader, writer))
+                self._readers.add(watch)
+                watch.add_done_callback(self._readers.discard)
+            return writer
+
+    async def _watch(self, address: Address, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # the remote never answers on an outgoing connection --> EOF means it closed (or restarted),
+        # so drop it from the pool before the next send writes into a dead socket
+        try:
+            while await reader.read(4096):
+                pass
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            if self._connections.get(address) is writer:
+                del self._connections[address]
+            writer.close()
+
+    async def send(self, address: Address, packet: bytes):
+        """queue one packet on the pooled connection to address"""
+        await self.send_many(address, [packet])
+
+    async def send_many(self, address: Address, packets: Iterable[bytes]):
+        """write several packets back to back (one syscall when they fit the buffer)"""
+        frames = []
+        for packet in packets:
+            frames.append(len(packet).to_bytes(_HEADER_SIZE, 'big'))
+            frames.append(packet)
+        if not frames:
+            return
+        data = b"".join(frames)
+        for attempt in range(2):
+            writer = await self._connection(address)
+            try:
+                writer.write(data)
+                if writer.transport.get_write_buffer_size() > WRITE_HIGH_WATER:
+                    await writer.drain()
+                # write() on a closed transport drops the data silently
+                if writer.is_closing():
+                    raise ConnectionResetError(f"connection to {address} closed")
+                break
+            except ConnectionError:
+                # stale pooled connection (remote restarted) --> reconnect once
+                self._connections.pop(address, None)
+                writer.close()
+                if attempt:
+                    raise
+        self.frames_sent += len(frames) // 2
+        self.bytes_sent += len(data)
+
+    async def flush(self):
+        """wait until everything written so far has left the socket buffers"""
+        for writer in list(self._connections.values()):
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+    async def close(self):
+        for writer in self._connections.values():
+            writer.close()
+        self._connections.clear()
+        for task in list(self._readers):
+            task.cancel()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._receives:
+            await asyncio.gather(*self._receives, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "address": list(self.address) if self.address else None,
+            "connections": len(self._connections),
+            "connections_opened": self.connections_opened,
+            "frames_sent": self.frames_sent,
+            "frames_received": self.frames_received,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+        }
@@ -0,0 +1,178 @@
+# segment_log.py
+# append-only record log split over rolling segment files --> storage engine under MessageStore.
+#
+# every record is framed as   length u32 | crc32 u32 | payload
+# and addressed by (segment id, offset, length), segments roll once they pass max_segment_bytes.
+import os
+import struct
+import zlib
+import threading
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+RECORD_HEADER = struct.Struct(">II")
+SEGMENT_PREFIX = "seg-"
+SEGMENT_SUFFIX = ".log"
+DEFAULT_SEGMENT_BYTES = 16 * 1024 * 1024
+
+# (segment id, offset of the record header, payload length)
+RecordLocation = Tuple[int, int, int]
+
+
+class SegmentLog:
+    """append-only log of byte records over rolling segment files"""
+
+    def __init__(
+            self,
+            log_dir: str,
+            max_segment_bytes: int = DEFAULT_SEGMENT_BYTES,
+            prefix: str = SEGMENT_PREFIX,
+            suffix: str = SEGMENT_SUFFIX):
+        self.log_dir = log_dir
+        self.max_segment_bytes = max_segment_bytes
+        self.prefix = prefix
+        self.suffix = suffix
+        self._lock = threading.RLock()
+        self._read_fds: Dict[int, int] = {}
+        os.makedirs(log_dir, exist_ok=True)
+        self.segments: List[int] = self._list_segments()
+        if not self.segments:
+            self.segments.append(1)
+        self.active_segment = self.segments[-1]
+        self._active_file = open(self.segment_path(self.active_segment), 'ab')
+        self._active_size = self._active_file.seek(0, os.SEEK_END)
+
+    def segment_path(self, segment_id: int) -> str:
+        return os.path.join(self.log_dir, f"{self.prefix}{segment_id:08d}{self.suffix}")
+
+    def _list_segments(self) -> List[int]:
+        segments = []
+        for name in os.listdir(self.log_dir):
+            if name.startswith(self.prefix) and name.endswith(self.suffix):
+                try:
+                    segments.append(int(name[len(self.prefix):-len(self.suffix)]))
+                except ValueError:
+                    continue
+        return sorted(segments)
+
+    def append(self, payload: bytes, sync: bool = False) -> RecordLocation:
+        """append one record, returns where it landed"""
+        return self.append_many([payload], sync)[0]
+
+    def append_many(self, payloads: Sequence[bytes], sync: bool = False) -> List[RecordLocation]:
+        """append a batch of records with a single write (and at most one fsync) per segment"""
+        locations: List[RecordLocation] = []
+        with self._lock:
+            pending: List[bytes] = []
+            for payload in payloads:
+                if self._active_size >= self.max_segment_bytes:
+                    self._write(pending, sync)
+                    pending = []
+                    self._roll()
+                record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+                locations.append((self.active_segment, self._active_size, len(payload)))
+                pending.append(record)
+                self._active_size += len(record)
+            self._write(pending, sync)
+        return locations
+
+    def _write(self, records: List[bytes], sync: bool):
+        if not records:
+            return
+        self._active_file.write(b"".join(records))
+        self._active_file.flush()
+        if sync:
+            os.fsync(self._active_file.fileno())
+
+    @property
+    def active_size(self) -> int:
+        return self._active_size
+
+    def roll(self):
+        """close the active segment and start the next one"""
+        with self._lock:
+            self._roll()
+
+    def _roll(self):
+        self._active_file.close()
+        self.active_segment += 1
+        self.segments.append(self.active_segment)
+        self._active_file = open(self.segment_path(self.active_segment), 'ab')
+        self._active_size = 0
+
+    def sync(self):
+        """fsync the active segment"""
+        with self._lock:
+            self._active_file.flush()
+            os.fsync(self._active_file.fileno())
+
+    def read(self, location: RecordLocation) -> bytes:
+        """read one record back, checking its length and crc"""
+        segment_id, offset, length = location
+        fd = self._read_fd(segment_id)
+        data = os.pread(fd, RECORD_HEADER.size + length, offset)
+        if len(data) != RECORD_HEADER.size + length:
+            raise Exception(f"Truncated record in segment {segment_id} at {offset}")
+        stored_length, crc = RECORD_HEADER.unpack_from(data)
+        payload = data[RECORD_HEADER.size:]
+        if stored_length != length or zlib.crc32(payload) != crc:
+            raise Exception(f"Corrupt record in segment {segment_id} at {offset}")
+        return payload
+
+    def _read_fd(self, segment_id: int) -> int:
+        fd = self._read_fds.get(segment_id)
+        if fd is None:
+            with self._lock:
+                fd = self._read_fds.get(segment_id)
+                if fd is None:
+                    fd = self._read_fds[segment_id] = os.open(self.segment_path(segment_id), os.O_RDONLY)
+        return fd
+
+    def scan(self, segment_id: Optional[int] = None) -> Iterator[Tuple[RecordLocation, bytes]]:
+        """iterate records in log order (optionally one segment), stopping at a torn tail"""
+        segments = [segment_id] if segment_id is not None else list(self.segments)
+        for seg in segments:
+            path = self.segment_path(seg)
+            if not os.path.exists(path):
+                continue
+            with open(path, 'rb') as f:
+                offset = 0
+                while True:
+                    header = f.read(RECORD_HEADER.size)
+                    if len(header) < RECORD_HEADER.size:
+                        break
+                    length, crc = RECORD_HEADER.unpack(header)
+                    payload = f.read(length)
+                    if len(payload) < length or zlib.crc32(payload) != crc:
+                        # half-written record from a crash, nothing valid follows it
+                        break
+                    yield (seg, offset, length), payload
+                    offset += RECORD_HEADER.size + length
+
+    def delete_segment(self, segment_id: int) -> bool:
+        """drop a whole (inactive) segment file"""
+        with self._lock:
+            if segment_id == self.active_segment or segment_id not in self.segments:
+                return False
+            fd = self._read_fds.pop(segment_id, None)
+            if fd is not None:
+                os.close(fd)
+            os.remove(self.segment_path(segment_id))
+            self.segments.remove(segment_id)
+            return True
+
+    def size_bytes(self) -> int:
+        """total bytes over all segments"""
+        total = 0
+        for seg in self.segments:
+            try:
+                total += os.path.getsize(self.segment_path(seg))
+            except OSError:
+                pass
+        return total
+
+    def close(self):
+        with self._lock:
+            self._active_file.close()
+            for fd in self._read_fds.values():
+                os.close(fd)
+            self._read_fds.clear()
@@ -0,0 +1,338 @@
+# shard_network.py
+# sharded mode --> peers are hash-partitioned across worker processes so crypto and storage use
+# more than one core.
+#
+# every worker runs its own P2PNetworkSimulator on its own store partition (encrypted/shard-<i>)
+# and answers requests for the peers it owns. the front process (main.py) keeps the websockets,
+# sends each action to the shard owning its peer and relays cross-shard deliveries and events.
+# front <-> worker traffic is length-prefixed msgpack over a unix socket pair.
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import socket
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+import msgpack
+
+# frame header: payload length, big endian
+_HEADER_SIZE = 4
+# largest IPC frame, bulk sends and file uploads travel in one frame
+MAX_IPC_FRAME = 64 * 1024 * 1024
+
+
+def shard_of(peer_name: str, shards: int) -> int:
+    """stable shard index of a peer (not hash(), that one is salted per process)"""
+    digest = hashlib.blake2b(peer_name.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % shards
+
+
+class ShardChannel:
+    """request/response + notifications over one stream, the same on both ends
+
+    requests are handled concurrently (one task each) so a shard waiting on another shard
+    never blocks the channel.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 handler: Callable[[str, Any], Awaitable[Any]]):
+        self.reader = reader
+        self.writer = writer
+        self.handler = handler
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._next_id = 0
+        self._tasks = set()
+        self.closed = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def call(self, op: str, args: Any = None) -> Any:
+        self._next_id += 1
+        request_id = self._next_id
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            await self._send({"id": request_id, "op": op, "args": args})
+            return await future
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def notify(self, op: str, args: Any = None):
+        """fire and forget, no response"""
+        await self._send({"op": op, "args": args})
+
+    async def _send(self, frame: Dict[str, Any]):
+        if self.closed.is_set():
+            raise ConnectionError("Shard channel closed")
+        data = msgpack.packb(frame, use_bin_type=True)
+        self.writer.write(len(data).to_bytes(_HEADER_SIZE, 'big') + data)
+        await self.writer.drain()
+
+    async def _run(self):
+        try:
+            while True:
+                header = await self.reader.readexactly(_HEADER_SIZE)
+                size = int.from_bytes(header, 'big')
+                if size > MAX_IPC_FRAME:
+                    raise ConnectionError(f"Shard frame too large: {size}")
+                frame = msgpack.unpackb(await self.reader.readexactly(size), raw=False)
+                if "op" in frame:
+                    task = asyncio.create_task(self._handle(frame))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+                    continue
+                future = self._pending.get(frame.get("id"))
+                if future is None or future.done():
+                    continue
+                if "error" in frame:
+                    future.set_exception(Exception(frame["error"]))
+                else:
+                    future.set_result(frame.get("result"))
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.closed.set()
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Shard channel closed"))
+
+    async def _handle(self, frame: Dict[str, Any]):
+        request_id = frame.get("id")
+        try:
+            result = await self.handler(frame["op"], frame.get("args"))
+            reply = {"id": request_id, "result": result}
+        except Exception as e:
+            reply = {"id": request_id, "error": str(e)}
+        if request_id is not None:
+            try:
+                await self._send(reply)
+            except ConnectionError:
+                pass
+
+    def close(self):
+        self._task.cancel()
+        self.writer.close()
+
+
+class ShardedNetwork:
+    """front-process side: owns the worker processes and routes work to them by peer"""
+
+    def __init__(self, shards: int, encrypted_dir: str = "encrypted", storage_backend: str = "log",
+                 transport: str = "loopback"):
+        if shards < 1:
+            raise ValueError("At least one shard is required")
+        self.shards = shards
+        self.encrypted_dir = encrypted_dir
+        self.storage_backend = storage_backend
+        self.transport = transport
+        self.on_event: Optional[Callable[[Dict], Awaitable[None]]] = None
+        self._processes: List[multiprocessing.Process] = []
+        self._channels: List[ShardChannel] = []
+        # counters for stats
+        self.forwarded = 0
+        self.relayed = 0
+
+    def set_event_handler(self, handler: Callable[[Dict], Awaitable[None]]):
+        self.on_event = handler
+
+    async def start(self):
+        # spawn, not fork: the front process already runs an event loop and threads
+        context = multiprocessing.get_context("spawn")
+        for index in range(self.shards):
+            front_sock, worker_sock = socket.socketpair()
+            process = context.Process(
+                target=run_shard,
+                args=(index, worker_sock, os.path.join(self.encrypted_dir, f"shard-{index}"),
+                      self.storage_backend, self.transport),
+                name=f"p2p-shard-{index}",
+                daemon=True,
+            )
+            process.start()
+            worker_sock.close()
+            reader, writer = await asyncio.open_connection(sock=front_sock, limit=MAX_IPC_FRAME)
+            self._processes.append(process)
+            self._channels.append(ShardChannel(reader, writer, self._handle_worker))
+        print(f"Started {self.shards} shard workers")
+
+    async def close(self):
+        for channel in self._channels:
+            try:
+                await channel.notify("close")
+            except ConnectionError:
+                pass
+        for process in self._processes:
+            await asyncio.to_thread(process.join, 5)
+            if process.is_alive():
+                process.terminate()
+        for channel in self._channels:
+            channel.close()
+        self._channels.clear()
+        self._processes.clear()
+
+    def shard_for(self, peer_name: str) -> ShardChannel:
+        return self._channels[shard_of(peer_name, self.shards)]
+
+    async def forward(self, action: str, payload: Dict[str, Any], peer_name: str) -> Dict[str, Any]:
+        """run a websocket action on the shard that owns peer_name"""
+        self.forwarded += 1
+        return await self.shard_for(str(peer_name)).call("handle", {"action": action, "payload": payload})
+
+    async def connect_peers(self, peer1_name: str, peer2_name: str) -> bool:
+        shard1, shard2 = self.shard_for(peer1_name), self.shard_for(peer2_name)
+        if shard1 is shard2:
+            return await shard1.call("connect_peers", [peer1_name, peer2_name])
+        # peers in different shards --> swap public keys through the front process
+        key1, key2 = await asyncio.gather(
+            shard1.call("public_key", [peer1_name, peer2_name]),
+            shard2.call("public_key", [peer2_name, peer1_name]),
+        )
+        if not key1 or not key2:
+            return False
+        res1, res2 = await asyncio.gather(
+            shard1.call("accept_key", [peer1_name, peer2_name, key2]),
+            shard2.call("accept_key", [peer2_name, peer1_name, key1]),
+        )
+        return res1 and res2
+
+    async def route_messages(self, items: Iterable[Tuple[str, str, str]]) -> Dict[str, Any]:
+        """bulk send split by sender shard, the shards run in parallel, results are merged back"""
+        by_shard: Dict[int, List[Tuple[int, Tuple[str, str, str]]]] = {}
+        total = 0
+        for i, item in enumerate(items):
+            total += 1
+            by_shard.setdefault(shard_of(item[0], self.shards), []).append((i, item))
+        results = await asyncio.gather(*(
+            self._channels[index].call("route_messages", [list(item) for _i, item in entries])
+            for index, entries in by_shard.items()
+        ))
+        delivered = 0
+        errors: Dict[int, str] = {}
+        for (index, entries), result in zip(by_shard.items(), results):
+            delivered += result["delivered"]
+            for local_index, error in result["errors"].items():
+                errors[entries[int(local_index)][0]] = error
+        return {
+            "total": total,
+            "delivered": delivered,
+            "failed": len(errors),
+            "errors": {str(i): error for i, error in sorted(errors.items())},
+        }
+
+    async def get_storage_stats(self) -> Dict[str, Any]:
+        stats = await asyncio.gather(*(channel.call("stats") for channel in self._channels))
+        return {
+            "shards": stats,
+            "front": {"shards": self.shards, "forwarded": self.forwarded, "relayed": self.relayed},
+        }
+
+    async def expire_messages(self, days_old: int = 30) -> int:
+        removed = await asyncio.gather(*(channel.call("expire", days_old) for channel in self._channels))
+        return sum(removed)
+
+    async def _handle_worker(self, op: str, args: Any) -> Any:
+        if op == "deliver":
+            # cross-shard message: hand the packets to the receiver's shard
+            peer_name, packets, bulk = args
+            self.relayed += len(packets)
+            return await self.shard_for(peer_name).call("deliver", [packets, bulk])
+        if op == "event":
+            if self.on_event:
+                await self.on_event(args)
+            return None
+        raise Exception(f"Unknown shard request: {op}")
+
+
+class FrontLink:
+    """worker-process side of P2PNetworkSimulator.remote: delivers to peers of other shards"""
+
+    def __init__(self, channel: ShardChannel):
+        self.channel = channel
+
+    async def deliver(self, peer_name: str, packets: List[bytes], bulk: bool = False) -> List[Optional[str]]:
+        """bulk=True --> the receiving shard announces one resync per conversation, not one event per message"""
+        try:
+            return await self.channel.call("deliver", [peer_name, packets, bulk])
+        except Exception as e:
+            print(f"Cross-shard delivery to {peer_name} failed: {e}")
+            return [None] * len(packets)
+
+
+def run_shard(index: int, sock: socket.socket, encrypted_dir: str, storage_backend: str, transport: str):
+    """worker process entry point"""
+    try:
+        asyncio.run(_shard_main(index, sock, encrypted_dir, storage_backend, transport))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _shard_main(index: int, sock: socket.socket, encrypted_dir: str, storage_backend: str, transport: str):
+    # the websocket actions are main.py's own handlers, run against this shard's network
+    import main as app
+    from p2p_engine import P2PNetworkSimulator
+
+    os.makedirs(encrypted_dir, exist_ok=True)
+    network = P2PNetworkSimulator(storage_backend=storage_backend, encrypted_dir=encrypted_dir, transport=transport)
+    app.NETWORK = network
+    done = asyncio.Event()
+
+    async def handle(op: str, args: Any) -> Any:
+        if op == "handle":
+            handler = app.HANDLERS.get(args["action"])
+            if handler is None:
+                return {"success": False, "error": "Unknown action"}
+            try:
+                return await handler(args.get("payload") or {})
+            except Exception as e:
+                return {"success": False, "error": str(e)}
+        if op == "deliver":
+            packets, bulk = args
+            return await network.deliver_packets(packets, bulk)
+        if op == "route_messages":
+            return await network.route_messages([tuple(item) for item in args])
+        if op == "connect_peers":
+            return network.connect_peers(*args)
+        if op == "public_key":
+            peer_name, other = args
+            peer = network.peers.get(peer_name)
+            return peer.get_my_public_key(other) if peer is not None else None
+        if op == "accept_key":
+            peer_name, other, key = args
+            peer = network.peers.get(peer_name)
+            return peer.connect_to_peer(other, key) if peer is not None else False
+        if op == "stats":
+            stats = network.get_storage_stats()
+            stats["shard"] = index
+            stats["peers"] = len(network.peers)
+            return stats
+        if op == "expire":
+            removed = await asyncio.to_thread(network.expire_messages, args)
+            if removed:
+                network.invalidate_history()
+            return removed
+        if op == "close":
+            done.set()
+            return None
+        raise Exception(f"Unknown shard op: {op}")
+
+    reader, writer = await asyncio.open_connection(sock=sock, limit=MAX_IPC_FRAME)
+    channel = ShardChannel(reader, writer, handle)
+    network.remote = FrontLink(channel)
+
+    async def forward_event(event):
+        try:
+            await channel.notify("event", event)
+        except ConnectionError:
+            pass
+    network.set_event_handler(forward_event)
+
+    # stop on "close" or when the front process goes away
+    closed = asyncio.create_task(channel.closed.wait())
+    stop = asyncio.create_task(done.wait())
+    await asyncio.wait([closed, stop], return_when=asyncio.FIRST_COMPLETED)
+    closed.cancel()
+    stop.cancel()
+    await network.close_transports()
+    if network.store_writer is not None:
+        network.store_writer.close()
+    channel.close()
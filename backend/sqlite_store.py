@@ -0,0 +1,361 @@
+# sqlite_store.py
+# SQLite storage backend --> same API as MessageStore, selectable with create_message_store(backend="sqlite").
+#
+# one table of messages (binary packet as a blob) in WAL mode, indexed on (peer_name, stored_us).
+# per-peer statistics are kept by triggers, attachment data goes to the same ChunkStore as the log backend.
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from typing import List, Dict, Any, Optional, Union, Iterable, Iterator, Tuple, BinaryIO
+
+from p2p_packet import encode_packet, decode_packet, is_encoded_packet
+from chunk_store import ChunkStore
+from file_store import BaseMessageStore, PeerKey, encode_cursor, decode_cursor, PARTITION_US
+
+DB_FILE = "messages.db"
+# rows fetched per round trip while walking a peer's history
+PEER_PAGE_ROWS = 64
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    seq INTEGER PRIMARY KEY,
+    message_id TEXT NOT NULL UNIQUE,
+    peer_name TEXT NOT NULL,
+    message_type TEXT NOT NULL,
+    stored_us INTEGER NOT NULL,
+    packet BLOB NOT NULL,
+    filename TEXT,
+    file_path TEXT,
+    file_size INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS messages_peer_time ON messages (peer_name, stored_us);
+CREATE INDEX IF NOT EXISTS messages_time ON messages (stored_us);
+CREATE TABLE IF NOT EXISTS peer_stats (
+    peer_name TEXT NOT NULL,
+    message_type TEXT NOT NULL,
+    messages INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    PRIMARY KEY (peer_name, message_type)
+);
+CREATE TRIGGER IF NOT EXISTS messages_stats_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO peer_stats VALUES (NEW.peer_name, NEW.message_type, 1, length(NEW.packet) + NEW.file_size)
+    ON CONFLICT (peer_name, message_type) DO UPDATE SET messages = messages + 1, bytes = bytes + excluded.bytes;
+END;
+CREATE TRIGGER IF NOT EXISTS messages_stats_delete AFTER DELETE ON messages BEGIN
+    UPDATE peer_stats SET messages = messages - 1, bytes = bytes - (length(OLD.packet) + OLD.file_size)
+    WHERE peer_name = OLD.peer_name AND message_type = OLD.message_type;
+    DELETE FROM peer_stats WHERE peer_name = OLD.peer_name AND message_type = OLD.message_type AND messages <= 0;
+END;
+"""
+
+# statements are constant strings so sqlite3's statement cache keeps them prepared
+_COLUMNS = "seq, message_id, peer_name, message_type, stored_us, packet, filename, file_path, file_size"
+SQL_INSERT = (
+    "INSERT INTO messages (message_id, peer_name, message_type, stored_us, packet, filename, file_path, file_size) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+)
+SQL_DELETE = "DELETE FROM messages WHERE message_id = ?"
+SQL_FILE_OF = "SELECT file_path FROM messages WHERE message_id = ? AND message_type = 'file'"
+SQL_BY_ID = f"SELECT {_COLUMNS} FROM messages WHERE message_id = ?"
+SQL_PEER_ALL = f"SELECT {_COLUMNS} FROM messages WHERE peer_name = ? ORDER BY stored_us, seq"
+SQL_PEER_BEFORE = (
+    f"SELECT {_COLUMNS} FROM messages WHERE peer_name = ? AND (stored_us, seq) < (?, ?) "
+    "ORDER BY stored_us DESC, seq DESC LIMIT ?"
+)
+SQL_PEER_OLDER = "SELECT 1 FROM messages WHERE peer_name = ? AND (stored_us, seq) < (?, ?) LIMIT 1"
+SQL_RECENT = f"SELECT {_COLUMNS} FROM messages ORDER BY stored_us DESC, seq DESC LIMIT ?"
+SQL_EXPIRED_FILES = "SELECT file_path FROM messages WHERE stored_us < ? AND message_type = 'file'"
+SQL_EXPIRE = "DELETE FROM messages WHERE stored_us < ?"
+SQL_STATS = "SELECT peer_name, message_type, messages, bytes FROM peer_stats"
+
+class SQLiteMessageStore(BaseMessageStore):
+    """MessageStore API on SQLite (WAL journal, batched transactions, one writer connection)
+
+    reads go through per-thread connections so they never wait on the writer.
+    """
+    LOG_SUBDIR = "sqlite"
+
+    def __init__(self, encrypted_dir: str = "encrypted"):
+        self.encrypted_dir = encrypted_dir
+        self.log_dir = os.path.join(encrypted_dir, self.LOG_SUBDIR)
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.db_path = os.path.join(self.log_dir, DB_FILE)
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._readers: List[sqlite3.Connection] = []
+        self._db = self._connect()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        # WAL + NORMAL: commits survive a process crash, save_messages(sync=True) upgrades to FULL
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self.chunks = ChunkStore(os.path.join(self.log_dir, "chunks"))
+        self.chunks.recover(
+            manifest for manifest in (
+                self.chunks.manifest_from_path(row[0])
+                for row in self._db.execute("SELECT file_path FROM messages WHERE message_type = 'file'")
+            ) if manifest is not None
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        # autocommit mode, transactions are opened explicitly
+        return sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None, cached_statements=64)
+
+    def _reader(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = self._connect()
+            with self._lock:
+                self._readers.append(db)
+        return db
+
+    def save_messages(self, items: Iterable[Tuple[Union[Dict[str, Any], bytes], str]], sync: bool = False) -> List[str]:
+        """save a batch of messages in one transaction, returns the message_ids"""
+        rows = []
+        for message_packet, peer_name in items:
+            packet_bytes, message_id = self._packet_and_id(message_packet)
+            rows.append((message_id, peer_name, "text", time.time_ns() // 1000, packet_bytes, None, None, 0))
+        self._write(rows, sync)
+        return [row[0] for row in rows]
+
+    def _write(self, rows: List[Tuple[Any, ...]], sync: bool = False):
+        """replace rows by message_id inside one transaction, file data of replaced rows is released"""
+        if not rows:
+            return
+        # a message_id saved twice in one batch keeps its last version, like the log backend
+        rows = list({row[0]: row for row in rows}.values())
+        with self._lock:
+            if sync:
+                self._db.execute("PRAGMA synchronous=FULL")
+            try:
+                self._db.execute("BEGIN IMMEDIATE")
+                try:
+                    replaced = self._files_of([row[0] for row in rows])
+                    self._db.executemany(SQL_DELETE, [(row[0],) for row in rows])
+                    self._db.executemany(SQL_INSERT, rows)
+                    self._db.execute("COMMIT")
+                except BaseException:
+                    self._db.execute("ROLLBACK")
+                    raise
+            finally:
+                if sync:
+                    self._db.execute("PRAGMA synchronous=NORMAL")
+            self._release_files(replaced)
+
+    def _files_of(self, message_ids: List[str]) -> List[str]:
+        paths = []
+        for message_id in message_ids:
+            row = self._db.execute(SQL_FILE_OF, (message_id,)).fetchone()
+            if row is not None:
+                paths.append(row[0])
+        return paths
+
+    def _release_files(self, file_paths: Iterable[str]):
+        for file_path in file_paths:
+            manifest = self.chunks.manifest_from_path(file_path)
+            if manifest is not None:
+                self.chunks.release(manifest)
+
+    def _finish_file_message(
+            self,
+            message_id: str,
+            message_packet: Union[Dict[str, Any], bytes],
+            manifest: str,
+            filename: str,
+            file_size: int,
+            peer_name: str) -> str:
+        packet_bytes = bytes(message_packet) if is_encoded_packet(message_packet) else encode_packet(message_packet)
+        file_path = self.chunks.manifest_path(manifest)
+        try:
+            self._write([(message_id, peer_name, "file", time.time_ns() // 1000, packet_bytes, filename, file_path, file_size)])
+        except Exception:
+            self.chunks.release(manifest)
+            raise
+        print(f"File message saved: {file_path}")
+        return message_id
+
+    def load_message(self, message_id: str) -> Optional[Dict[str, Any]]:
+        #load message by ID --> primary key lookup
+        row = self._reader().execute(SQL_BY_ID, (message_id,)).fetchone()
+        return self._row_to_message(row) if row else None
+
+    @staticmethod
+    def _row_key(row: Tuple[Any, ...]) -> PeerKey:
+        # (stored_us, 0, seq, length) --> same shape as the log backend's secondary keys
+        return (row[4], 0, row[0], len(row[5]))
+
+    def _row_to_message(self, row: Tuple[Any, ...]) -> Dict[str, Any]:
+        seq, message_id, peer_name, message_type, stored_us, packet, filename, file_path, file_size = row
+        message_data = {
+            "stored_at": self._stored_at(stored_us),
+            "file_path": file_path or self.db_path,
+            "message_packet": decode_packet(packet),
+            "peer_name": peer_name,
+            "message_type": message_type,
+            "cursor": encode_cursor(self._row_key(row)),
+        }
+        if message_type == "file":
+            message_data.update({"message_id": message_id, "original_filename": filename, "file_size": file_size})
+        return message_data
+
+    def _message_key(self, message_id: str) -> Optional[PeerKey]:
+        row = self._reader().execute(SQL_BY_ID, (message_id,)).fetchone()
+        return self._row_key(row) if row else None
+
+    def iter_file_data(self, message_id: str, block_size: int = 64 * 1024) -> Optional[Iterator[bytes]]:
+        """lazily read encrypted file data by message ID, one chunk at a time"""
+        row = self._reader().execute(SQL_FILE_OF, (message_id,)).fetchone()
+        manifest = self.chunks.manifest_from_path(row[0]) if row else None
+        if manifest is None or not os.path.exists(self.chunks.manifest_path(manifest)):
+            return None
+        return self.chunks.iter_file(manifest)
+
+    def get_messages_by_peer(self, peer_name: str) -> List[Dict[str, Any]]:
+        """gettting all messages from/to a specific peer (oldest first, via the peer/time index)"""
+        return [self._row_to_message(row) for row in self._reader().execute(SQL_PEER_ALL, (peer_name,))]
+
+    @staticmethod
+    def _position(before: Optional[str]) -> Tuple[int, int]:
+        # (stored_us, seq) to page back from, None --> past the newest row
+        if before is None:
+            return (2 ** 63 - 1, 0)
+        stored_us, _zero, seq = decode_cursor(before)
+        return (stored_us, seq)
+
+    def iter_peer(self, peer_name: str, before: Optional[str] = None) -> Iterator[Tuple[PeerKey, Dict[str, Any]]]:
+        """newest-first (key, message) pairs for a peer, strictly older than `before`; fetched in small pages"""
+        position = self._position(before)
+        while True:
+            rows = self._reader().execute(SQL_PEER_BEFORE, (peer_name, position[0], position[1], PEER_PAGE_ROWS)).fetchall()
+            for row in rows:
+                yield self._row_key(row), self._row_to_message(row)
+            if len(rows) < PEER_PAGE_ROWS:
+                return
+            position = (rows[-1][4], rows[-1][0])
+
+    def query(self, peer_name: str, before: Optional[str] = None, limit: int = 50) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """one page of a peer's messages older than `before` (oldest first) + cursor for the next page"""
+        position = self._position(before)
+        reader = self._reader()
+        page = [self._row_to_message(row) for row in reader.execute(SQL_PEER_BEFORE, (peer_name, position[0], position[1], max(limit, 0)))]
+        page.reverse()
+        next_cursor = None
+        if page:
+            # index-only probe for anything older than the page, no row is read for it
+            oldest = decode_cursor(page[0]["cursor"])
+            if reader.execute(SQL_PEER_OLDER, (peer_name, oldest[0], oldest[2])).fetchone():
+                next_cursor = page[0]["cursor"]
+        return page, next_cursor
+
+    def get_recent_messages(self, limit: int = 50) -> List[Dict[str, Any]]:
+        """get recent messages (all peers)"""
+        return [self._row_to_message(row) for row in self._reader().execute(SQL_RECENT, (limit,))]
+
+    def delete_message(self, message_id: str) -> bool:
+        """delete a message and its files"""
+        try:
+            with self._lock:
+                file_paths = self._files_of([message_id])
+                if self._db.execute(SQL_DELETE, (message_id,)).rowcount == 0:
+                    return False
+            self._release_files(file_paths)
+            print(f"Message {message_id} deleted")
+            return True
+        except Exception as e:
+            print(f"Error deleting message {message_id}: {e}")
+            return False
+
+    def get_storage_stats(self) -> Dict[str, Any]:
+        """storage statistics from the trigger-maintained peer_stats table"""
+        peer_stats: Dict[str, Dict[str, int]] = {}
+        for peer_name, message_type, messages, size in self._reader().execute(SQL_STATS):
+            counts = peer_stats.setdefault(peer_name, {"text": 0, "file": 0, "bytes": 0})
+            counts[message_type] = messages
+            counts["bytes"] += size
+        text_messages = sum(counts["text"] for counts in peer_stats.values())
+        file_messages = sum(counts["file"] for counts in peer_stats.values())
+        total_size = sum(counts["bytes"] for counts in peer_stats.values())
+        return {
+            "total_messages": text_messages + file_messages,
+            "text_messages": text_messages,
+            "file_messages": file_messages,
+            "total_size_bytes": total_size,
+            "total_size_mb": round(total_size / (1024 * 1024), 2),
+            "peer_statistics": peer_stats,
+            "chunk_store": self.chunks.stats(),
+            "last_updated": datetime.now(timezone.utc).isoformat()
+        }
+
+    def cleanup_old_messages(self, days_old: int = 30) -> int:
+        """removing messages older than specified days --> one ranged delete on the time index"""
+        cutoff_us = time.time_ns() // 1000 - days_old * PARTITION_US
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                file_paths = [row[0] for row in self._db.execute(SQL_EXPIRED_FILES, (cutoff_us,))]
+                deleted_count = self._db.execute(SQL_EXPIRE, (cutoff_us,)).rowcount
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        self._release_files(file_paths)
+        print(f"Cleaned up {deleted_count} old messages")
+        return deleted_count
+
+    def snapshot_files(self) -> Tuple[List[Tuple[str, BinaryIO, int, bool]], List[str]]:
+        """point-in-time view for backup_messages: a copy of the database plus its pinned chunks
+
+        the copy comes from a read transaction on its own connection, writers keep going on the WAL.
+        """
+        snapshot_path = f"{self.db_path}.{threading.get_ident()}.snapshot"
+        manifests: List[str] = []
+        handles: List[Tuple[str, BinaryIO, int, bool]] = []
+        db = self._connect()
+        try:
+            with self._lock:
+                # snapshot starts with the first read, pins are taken before any later delete releases
+                db.execute("BEGIN")
+                for (file_path,) in db.execute("SELECT file_path FROM messages WHERE message_type = 'file'"):
+                    manifest = self.chunks.manifest_from_path(file_path)
+                    if manifest is not None:
+                        self.chunks.retain(manifest)
+                        manifests.append(manifest)
+            target = sqlite3.connect(snapshot_path)
+            try:
+                db.backup(target)
+            finally:
+                target.close()
+            db.execute("COMMIT")
+            f = open(snapshot_path, 'rb')
+            os.remove(snapshot_path)
+            handles.append((os.path.relpath(self.db_path, self.encrypted_dir), f, os.fstat(f.fileno()).st_size, False))
+            seen = set()
+            for manifest in manifests:
+                if manifest in seen:
+                    continue
+                seen.add(manifest)
+                paths = [self.chunks.manifest_path(manifest)]
+                paths += [self.chunks.chunk_path(digest) for digest in self.chunks.read_manifest(manifest) if digest not in seen]
+                seen.update(self.chunks.read_manifest(manifest))
+                for path in paths:
+                    f = open(path, 'rb')
+                    handles.append((os.path.relpath(path, self.encrypted_dir), f, os.fstat(f.fileno()).st_size, True))
+        except Exception:
+            for _relpath, f, _size, _immutable in handles:
+                f.close()
+            for manifest in manifests:
+                self.chunks.release(manifest)
+            if os.path.exists(snapshot_path):
+                os.remove(snapshot_path)
+            raise
+        finally:
+            db.close()
+        return handles, manifests
+
+    def close(self):
+        with self._lock:
+            for db in self._readers:
+                db.close()
+            self._readers.clear()
+            self._db.close()
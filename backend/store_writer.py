@@ -0,0 +1,144 @@
+# store_writer.py
+# group-commit writer --> moves MessageStore writes off the asyncio event loop.
+#
+# callers queue records and await a future, a dedicated thread drains the queue and commits
+# everything it finds as one batch (one log write, one index write, one fsync at most).
+import asyncio
+import queue
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+from file_store import MessageStore
+
+# durability modes
+DURABILITY_NONE = "none"    # flushed to the OS page cache, lost on power failure
+DURABILITY_FSYNC = "fsync"  # one fsync per batch before callers are acknowledged
+DURABILITY_MODES = (DURABILITY_NONE, DURABILITY_FSYNC)
+
+_STOP = object()
+
+
+class StoreWriter:
+    """batches MessageStore saves on a dedicated thread, callers get awaitable completion
+
+    a batch is committed when max_batch records are queued or max_delay seconds have passed
+    since its first record (max_delay=0 commits whatever is queued right away, batching
+    comes from records piling up while the previous commit runs).
+    """
+
+    def __init__(
+            self,
+            store: MessageStore,
+            max_batch: int = 512,
+            max_delay: float = 0.0,
+            durability: str = DURABILITY_NONE):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode: {durability}")
+        self.store = store
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.durability = durability
+        self._queue: "queue.Queue[Any]" = queue.Queue()
+        self._closed = False
+        # counters for benchmarks / monitoring
+        self.batches = 0
+        self.records = 0
+        self.largest_batch = 0
+        self._thread = threading.Thread(target=self._run, name="store-writer", daemon=True)
+        self._thread.start()
+
+    def save_message(self, message_packet: Union[Dict[str, Any], bytes], peer_name: str) -> "asyncio.Future[str]":
+        """queue one message, the future resolves to its message_id once committed"""
+        return self._submit([(message_packet, peer_name)], single=True)
+
+    def save_messages(self, items: Sequence[Tuple[Union[Dict[str, Any], bytes], str]]) -> "asyncio.Future[List[str]]":
+        """queue several messages, resolved together with the batch that commits the last of them"""
+        return self._submit(list(items), single=False)
+
+    def _submit(self, items: List[Tuple[Any, str]], single: bool) -> asyncio.Future:
+        if self._closed:
+            raise Exception("Store writer is closed")
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.put((items, single, future, loop))
+        return future
+
+    async def flush(self):
+        """wait until everything queued so far is committed"""
+        await self.save_messages([])
+
+    def close(self, timeout: Optional[float] = None):
+        """commit what is queued and stop the thread"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            request = self._queue.get()
+            if request is _STOP:
+                break
+            batch = [request]
+            pending = len(request[0])
+            deadline = time.monotonic() + self.max_delay
+            while pending < self.max_batch:
+                try:
+                    if self.max_delay > 0:
+                        timeout = deadline - time.monotonic()
+                        if timeout <= 0:
+                            break
+                        request = self._queue.get(timeout=timeout)
+                    else:
+                        request = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is _STOP:
+                    stopping = True
+                    break
+                batch.append(request)
+                pending += len(request[0])
+            self._commit(batch)
+
+    def _commit(self, batch: List[Tuple[List[Tuple[Any, str]], bool, asyncio.Future, asyncio.AbstractEventLoop]]):
+        items = [item for request in batch for item in request[0]]
+        try:
+            message_ids = self.store.save_messages(items, sync=self.durability == DURABILITY_FSYNC) if items else []
+            error = None
+        except Exception as e:
+            message_ids = []
+            error = e
+        self.batches += 1
+        self.records += len(items)
+        self.largest_batch = max(self.largest_batch, len(items))
+        position = 0
+        for request_items, single, future, loop in batch:
+            count = len(request_items)
+            if error is not None:
+                result: Any = Exception(f"Store write failed: {error}")
+            else:
+                ids = message_ids[position:position + count]
+                result = ids[0] if single else ids
+            position += count
+            loop.call_soon_threadsafe(_resolve, future, result)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "batches": self.batches,
+            "records": self.records,
+            "largest_batch": self.largest_batch,
+            "queued": self._queue.qsize(),
+            "durability": self.durability,
+        }
+
+
+def _resolve(future: asyncio.Future, result: Any):
+    if future.done():
+        return
+    if isinstance(result, Exception):
+        future.set_exception(result)
+    else:
+        future.set_result(result)
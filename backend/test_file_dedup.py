@@ -0,0 +1,43 @@
+# test_file_dedup.py
+# file attachments sent to several peers or resent share their chunks in the chunk store
+import io
+import os
+
+import pytest
+
+from p2p_engine import P2PNetworkSimulator
+
+
+@pytest.mark.parametrize("backend", ["log", "sqlite"])
+def test_same_file_to_many_peers_is_stored_once(tmp_path, monkeypatch, backend):
+    monkeypatch.chdir(tmp_path)
+    network = P2PNetworkSimulator(storage_backend=backend)
+    for name in ("alice", "bob", "carol"):
+        network.create_peer(name)
+    network.connect_peers("alice", "bob")
+    network.connect_peers("alice", "carol")
+    alice = network.peers["alice"]
+    data = os.urandom(300 * 1024)
+    sent = [
+        ("bob", alice.send_file("bob", io.BytesIO(data), "a.bin")),
+        ("carol", alice.send_file("carol", io.BytesIO(data), "a.bin")),
+        ("bob", alice.send_file("bob", io.BytesIO(data), "a.bin")),
+    ]
+    stats = network.message_store.chunks.stats()
+    # 5 data chunks per send, only the first send writes them
+    assert stats["chunks_deduplicated"] >= 10
+    for peer, message_id in sent:
+        assert b"".join(network.peers[peer].read_file("alice", message_id)) == data
+
+
+def test_key_frame_only_opens_for_its_conversation(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    network = P2PNetworkSimulator()
+    for name in ("alice", "bob", "carol"):
+        network.create_peer(name)
+    network.connect_peers("alice", "bob")
+    network.connect_peers("alice", "carol")
+    message_id = network.peers["alice"].send_file("bob", io.BytesIO(b"secret" * 1000), "s.txt")
+    blocks = network.message_store.iter_file_data(message_id)
+    with pytest.raises(Exception, match="Decryption failed"):
+        list(network.peers["carol"].sessions["alice"].decrypt_file(blocks))
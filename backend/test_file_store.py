@@ -0,0 +1,46 @@
+# test_file_store.py
+# day partitions of the log backend: a segment never holds records of two days
+import itertools
+import time
+
+import pytest
+
+from file_store import CompactMessageStore, MessageStore, PARTITION_US
+from sqlite_store import SQLiteMessageStore
+
+
+def packet(i):
+    return {
+        "from": "alice",
+        "to": "bob",
+        "message_id": f"m{i}",
+        "encrypted_data": {"ciphertext": "AAAA", "nonce": "AAAA", "algorithm": "XChaCha20-Poly1305"},
+    }
+
+
+def test_batch_across_midnight_rolls_the_segment(tmp_path, monkeypatch):
+    store = MessageStore(str(tmp_path / "encrypted"))
+    midnight_ns = (time.time_ns() // 1000 // PARTITION_US + 1) * PARTITION_US * 1000
+    # two records just before midnight, two just after, all in one group commit
+    clock = itertools.chain([midnight_ns - 2000, midnight_ns - 1000, midnight_ns], itertools.repeat(midnight_ns + 1000))
+    monkeypatch.setattr(time, "time_ns", lambda: next(clock))
+    store.save_messages([(packet(i), "alice<->bob") for i in range(4)])
+    segments = [store._index[f"m{i}"]["location"][0] for i in range(4)]
+    assert segments[0] == segments[1]
+    assert segments[2] == segments[3]
+    assert segments[1] != segments[2]
+    store.close()
+
+
+@pytest.mark.parametrize("store_class", [MessageStore, CompactMessageStore, SQLiteMessageStore])
+def test_file_messages_and_cursors_behave_the_same_on_every_backend(tmp_path, store_class):
+    # shared BaseMessageStore code on top of each backend's storage
+    store = store_class(str(tmp_path / "encrypted"))
+    data = bytes(range(256)) * 1000
+    message_id = store.save_file_message(data, "a.bin", packet(0), "alice<->bob")
+    assert store.load_file_data(message_id) == data
+    assert store.load_file_data("missing") is None
+    page, _cursor = store.query("alice<->bob", None, 10)
+    assert store.get_cursor(message_id) == page[-1]["cursor"]
+    assert store.get_cursor("missing") is None
+    store.close()
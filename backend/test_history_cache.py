@@ -0,0 +1,119 @@
+# test_history_cache.py
+# the get_history path (get_conversation_page*) fills the history cache and serves repeat reads from it
+import asyncio
+
+import pytest
+
+from p2p_engine import P2PNetworkSimulator
+
+
+@pytest.fixture
+def network(tmp_path, monkeypatch):
+    # keys/ and encrypted/ are created relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    network = P2PNetworkSimulator()
+    network.create_peer("alice")
+    network.create_peer("bob")
+    network.connect_peers("alice", "bob")
+    return network
+
+
+def send(network, count, start=0):
+    asyncio.run(network.route_messages([("alice", "bob", f"m{i}") for i in range(start, start + count)]))
+
+
+def test_first_page_fills_cache(network):
+    send(network, 30)
+    bob = network.peers["bob"]
+    bob.history_cache.invalidate()
+    page, _cursor = bob.get_conversation_page("alice", None, 10)
+    assert [entry["message"] for entry in page] == [f"m{i}" for i in range(20, 30)]
+    hits = bob.history_cache.hits
+    page, _cursor = bob.get_conversation_page("alice", None, 10)
+    assert bob.history_cache.hits == hits + 1
+    assert page[-1]["message"] == "m29"
+
+
+def test_async_first_page_fills_cache(network):
+    send(network, 30)
+    bob = network.peers["bob"]
+    bob.history_cache.invalidate()
+
+    async def reads():
+        first, _cursor = await bob.get_conversation_page_async("alice", None, 10)
+        hits = bob.history_cache.hits
+        second, _cursor = await bob.get_conversation_page_async("alice", None, 10)
+        return first, second, bob.history_cache.hits - hits
+
+    first, second, new_hits = asyncio.run(reads())
+    assert new_hits == 1
+    assert first == second
+
+
+def test_cached_conversation_sees_new_messages(network):
+    send(network, 5)
+    bob = network.peers["bob"]
+    bob.history_cache.invalidate()
+    bob.get_conversation_page("alice", None, 10)
+    send(network, 1, start=5)
+    hits = bob.history_cache.hits
+    page, _cursor = bob.get_conversation_page("alice", None, 10)
+    assert bob.history_cache.hits == hits + 1
+    assert [entry["message"] for entry in page] == [f"m{i}" for i in range(6)]
+
+
+def test_load_racing_a_write_is_not_cached(network):
+    send(network, 5)
+    bob = network.peers["bob"]
+    bob.history_cache.invalidate()
+    version = bob.history_cache.version("alice")
+    stale, _cursor = bob._read_conversation_page("alice", None, 100)
+    send(network, 1, start=5)
+    bob.history_cache.put("alice", stale, complete=True, version=version)
+    assert bob.history_cache.get("alice", 10) is None
+
+
+def pages(peer, limit, read=None):
+    read = read or peer.get_conversation_page
+    page, cursor = read("alice", None, limit)
+    found = [page]
+    while cursor:
+        page, cursor = read("alice", cursor, limit)
+        found.append(page)
+    return found
+
+
+@pytest.mark.parametrize("backend", ["log", "sqlite"])
+def test_no_cursor_after_the_oldest_page(tmp_path, monkeypatch, backend):
+    monkeypatch.chdir(tmp_path)
+    network = P2PNetworkSimulator(storage_backend=backend)
+    network.create_peer("alice")
+    network.create_peer("bob")
+    network.connect_peers("alice", "bob")
+    send(network, 40)
+    bob = network.peers["bob"]
+    # 40 messages in pages of 10 --> exactly 4 pages, no empty fifth one
+    assert [len(page) for page in pages(bob, 10)] == [10, 10, 10, 10]
+    bob.history_cache.invalidate()
+    assert [len(page) for page in pages(bob, 10, bob._read_conversation_page)] == [10, 10, 10, 10]
+    page, cursor = network.message_store.query("alice<->bob", None, 40)
+    assert len(page) == 40 and cursor is None
+
+
+def test_undecryptable_record_does_not_end_paging(network, monkeypatch):
+    send(network, 30)
+    bob = network.peers["bob"]
+    session = bob.sessions["alice"]
+    decrypt_many = session.decrypt_many
+
+    def failing(packets, *args, **kwargs):
+        plaintexts, errors = decrypt_many(packets, *args, **kwargs)
+        # pretend the newest record of every batch is corrupt
+        plaintexts[-1] = None
+        return plaintexts, errors
+    monkeypatch.setattr(session, "decrypt_many", failing)
+    bob.history_cache.invalidate()
+    page, cursor = bob.get_conversation_page("alice", "9" * 20 + ".0.0", 10)
+    assert len(page) == 9 and cursor is not None
+    older, _cursor = bob.get_conversation_page("alice", cursor, 10)
+    assert older[0]["message"] == "m10"
@@ -0,0 +1,34 @@
+# test_peer_transport.py
+# pooled outgoing connections: a remote that restarts on the same port gets a fresh connection
+import asyncio
+
+from peer_transport import PeerTransport
+
+
+def test_send_after_remote_restart_reconnects():
+    async def run():
+        got = []
+
+        async def on_packet(frame):
+            got.append(frame)
+        receiver = PeerTransport(on_packet)
+        address = await receiver.listen()
+        sender = PeerTransport(on_packet=None)
+        await sender.send(address, b"before")
+        while len(got) < 1:
+            await asyncio.sleep(0.01)
+        # restart the remote on the same port --> the pooled connection is now dead
+        await receiver.close()
+        await asyncio.sleep(0.05)
+        receiver = PeerTransport(on_packet)
+        await receiver.listen(*address)
+        await sender.send(address, b"after")
+        for _ in range(100):
+            if len(got) == 2:
+                break
+            await asyncio.sleep(0.01)
+        assert got == [b"before", b"after"]
+        assert sender.connections_opened == 2
+        await sender.close()
+        await receiver.close()
+    asyncio.run(run())
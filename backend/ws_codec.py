@@ -0,0 +1,58 @@
+# ws_codec.py
+# websocket frame encodings --> JSON text frames (default, what the React frontend speaks) or
+# msgpack binary frames for clients that negotiate the msgpack sub-protocol.
+#
+# with msgpack, bytes values (ciphertext, file data) travel as raw msgpack bin, with JSON they
+# are base64 strings.
+import base64
+import json
+from typing import Any, Dict, Optional, Union
+
+import msgpack
+
+# Sec-WebSocket-Protocol names, in server preference order
+SUBPROTOCOL_MSGPACK = "p2p.msgpack.v1"
+SUBPROTOCOL_JSON = "p2p.json.v1"
+SUBPROTOCOLS = [SUBPROTOCOL_MSGPACK, SUBPROTOCOL_JSON]
+
+
+def _json_default(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(bytes(value)).decode('ascii')
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def is_binary(protocol: Optional[str]) -> bool:
+    return protocol == SUBPROTOCOL_MSGPACK
+
+
+def encode_frame(obj: Dict[str, Any], protocol: Optional[str] = None) -> Union[str, bytes]:
+    """serialize one request/response/event for a connection that negotiated `protocol`"""
+    if is_binary(protocol):
+        return msgpack.packb(obj, use_bin_type=True)
+    # no sub-protocol (plain browser WebSocket) --> JSON
+    return json.dumps(obj, default=_json_default)
+
+
+def decode_frame(message: Union[str, bytes]) -> Dict[str, Any]:
+    """parse one incoming frame --> binary frames are msgpack, text frames JSON (on any protocol)"""
+    binary = isinstance(message, (bytes, bytearray))
+    try:
+        data = msgpack.unpackb(message, raw=False) if binary else json.loads(message)
+    except Exception:
+        data = None
+    if not isinstance(data, dict):
+        raise ValueError("Invalid msgpack" if binary else "Invalid JSON")
+    return data
+
+
+def payload_bytes(value: Any) -> bytes:
+    """binary payload field --> raw bytes from msgpack, base64 text from JSON"""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value)
+    if isinstance(value, str):
+        try:
+            return base64.b64decode(value, validate=True)
+        except ValueError:
+            raise ValueError("Binary fields must be base64 encoded in JSON frames.")
+    raise ValueError("Expected binary data.")
@@ -24,6 +24,10 @@ function useP2PWebSocket(url) {
           if (message.data.success) {
             setMessages(message.data.history);
           }
+        } else if (message.type === 'resync') {
+          // server skipped events while this client was behind, reload that conversation
+          const [peer_a, peer_b] = message.conversation.split('<->');
+          socket.send(JSON.stringify({ action: 'get_history', payload: { peer_a, peer_b } }));
         }
       } catch (error) {
           console.error("Failed to parse WebSocket message:", error);
@@ -105,6 +109,8 @@ function App() {
       sendCommand('create_peer', { name: peerName });
       sendCommand('create_peer', { name: chattingPeer });
       sendCommand('connect_peers', { peer1: peerName, peer2: chattingPeer });
+      // server only pushes messages of subscribed conversations
+      sendCommand('subscribe', { conversations: [[peerName, chattingPeer]] });
       sendCommand('get_history', { peer_a: peerName, peer_b: chattingPeer });
       setupCompleted.current = true;
     }